@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+"""announcements.py
+
+The "nearly sold out" announcement, maintained incrementally.
+
+The websafe key of every conference with between 1 and NEARLY_SOLD_OUT
+seats left maps to its name and seats in one of NUM_SHARDS NearlySoldOut
+entities, chosen by a hash of the key, so seat changes of different
+conferences rarely contend on the same entity. A shard holds at most
+MAX_SHARD_CONFERENCES entries, dropping those with most seats left, which
+keeps it far below the entity size limit. The announcement names the
+ANNOUNCEMENT_LIMIT conferences with the fewest seats left, and counts the
+rest.
+
+Code that changes a conference's seatsAvailable calls seatsChangedAsync
+afterwards; an update that fails on contention is retried by a push task.
+The hourly cron job rebuilds the shards from the conferences' seat totals,
+correcting anything missed. Reads of the announcement are a memcache get,
+falling back to one batch get of the shards.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import logging
+import zlib
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Conference, NearlySoldOut
+
+MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
+                    'are nearly sold out: %s')
+ANNOUNCEMENT_MORE_TPL = '%s and %d more'
+
+# Conferences with at most this many seats left are nearly sold out.
+NEARLY_SOLD_OUT = 5
+# Most conferences named in the announcement.
+ANNOUNCEMENT_LIMIT = 10
+
+NUM_SHARDS = 10
+# Most conferences kept per shard; an entry is about 100 bytes.
+MAX_SHARD_CONFERENCES = 1000
+REBUILD_BATCH_SIZE = 500
+# Seconds before a push task retries an update that failed on contention.
+UPDATE_RETRY_DELAY = 5
+
+
+def shardKeys():
+    """Return the NearlySoldOut shard keys."""
+    return [ndb.Key(NearlySoldOut, 'shard-%d' % i) for i in range(NUM_SHARDS)]
+
+
+def shardKey(wsck):
+    """Return the key of the shard holding a conference's entry."""
+    return shardKeys()[(zlib.crc32(wsck) & 0xffffffff) % NUM_SHARDS]
+
+
+def isNearlySoldOut(seatsAvailable):
+    """Return whether a conference with seatsAvailable is nearly sold out."""
+    return 0 < seatsAvailable <= NEARLY_SOLD_OUT
+
+
+def cap(conferences):
+    """Drop the entries of a {wsck: {name, seats}} dict with most seats left
+    beyond MAX_SHARD_CONFERENCES; returns it."""
+    if len(conferences) > MAX_SHARD_CONFERENCES:
+        ranked = sorted(conferences, key=lambda wsck: (conferences[wsck]['seats'],
+                                                       conferences[wsck]['name']))
+        logging.warning('Dropping %d nearly sold out conferences from a full shard',
+                        len(ranked) - MAX_SHARD_CONFERENCES)
+        for wsck in ranked[MAX_SHARD_CONFERENCES:]:
+            del conferences[wsck]
+    return conferences
+
+
+def render(conferences):
+    """Return the announcement for a {wsck: {name, seats}} dict, naming the
+    conferences with fewest seats left first."""
+    if not conferences:
+        return ""
+    ranked = sorted(conferences.values(),
+                    key=lambda conf: (conf['seats'], conf['name']))
+    names = ', '.join(conf['name'] for conf in ranked[:ANNOUNCEMENT_LIMIT])
+    if len(ranked) > ANNOUNCEMENT_LIMIT:
+        names = ANNOUNCEMENT_MORE_TPL % (names, len(ranked) - ANNOUNCEMENT_LIMIT)
+    return ANNOUNCEMENT_TPL % names
+
+
+def renderShards(shards):
+    """Return the announcement for the entries of all shards."""
+    conferences = {}
+    for shard in shards:
+        if shard:
+            conferences.update(shard.conferences or {})
+    return render(conferences)
+
+
+@ndb.tasklet
+def seatsChangedAsync(conf_key, seatsAvailable):
+    """Update the nearly sold out set after a conference's seats changed;
+    seatsAvailable may be approximate, it only decides whether to look."""
+    wsck = conf_key.urlsafe()
+    if seatsAvailable > NEARLY_SOLD_OUT + 1:
+        # far from the threshold; only a listed conference needs a look.
+        shard = yield shardKey(wsck).get_async()
+        if not shard or wsck not in (shard.conferences or {}):
+            return
+    try:
+        changed = yield _updateTxn(conf_key)
+    except datastore_errors.TransactionFailedError:
+        logging.warning('Could not update nearly sold out set for %s', wsck)
+        yield updateLaterAsync(conf_key)
+        return
+    if changed:
+        yield publishAsync()
+
+
+@ndb.tasklet
+def updateLaterAsync(conf_key):
+    """Queue a push task updating the conference's entry."""
+    try:
+        yield taskqueue.Queue().add_async(taskqueue.Task(
+            url='/tasks/update_announcement', countdown=UPDATE_RETRY_DELAY,
+            params={'wsck': conf_key.urlsafe()}))
+    except taskqueue.Error:
+        # the hourly rebuild still corrects the entry.
+        logging.exception('Could not queue nearly sold out update for %s',
+                          conf_key.urlsafe())
+
+
+def update(wsck):
+    """Update the conference's entry and publish the announcement; used by
+    the update_announcement task. Errors propagate, so the task retries."""
+    if _updateTxn(ndb.Key(urlsafe=wsck)).get_result():
+        publishAsync().get_result()
+
+
+@ndb.transactional_tasklet(xg=True)
+def _updateTxn(conf_key):
+    """Set the conference's entry from its current seats; returns whether
+    its shard changed."""
+    wsck = conf_key.urlsafe()
+    conf, shard = yield conf_key.get_async(), shardKey(wsck).get_async()
+    if not shard:
+        # not built yet; the cron job's rebuild includes this conference.
+        raise ndb.Return(False)
+    conferences = shard.conferences or {}
+    if conf and isNearlySoldOut(conf.seatsAvailable):
+        entry = {'name': conf.name, 'seats': conf.seatsAvailable}
+    else:
+        entry = None
+    if conferences.get(wsck) == entry:
+        raise ndb.Return(False)
+    if entry:
+        conferences[wsck] = entry
+    else:
+        conferences.pop(wsck, None)
+    shard.conferences = cap(conferences)
+    yield shard.put_async()
+    raise ndb.Return(True)
+
+
+@ndb.tasklet
+def publishAsync():
+    """Render the announcement from the shards into memcache; returns it."""
+    shards = yield ndb.get_multi_async(shardKeys())
+    announcement = renderShards(shards)
+    yield ndb.get_context().memcache_set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    raise ndb.Return(announcement)
+
+
+def getAnnouncement():
+    """Return the announcement from memcache, or else the shards."""
+    announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+    if announcement is None:
+        announcement = renderShards(ndb.get_multi(shardKeys()))
+        memcache.add(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    return announcement
+
+
+def publish():
+    """Rebuild the shards from the conferences' seats and copy the
+    announcement into memcache; used by the hourly cron job. Returns it."""
+    shards = rebuild()
+    announcement = renderShards(shards)
+    memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    return announcement
+
+
+def rebuild():
+    """Rewrite every shard from a paged query of the nearly sold out
+    conferences; returns the shards. seatsAvailable of a conference with
+    seat shards is their synced total. The query is eventually consistent,
+    so a seat change committing meanwhile may be undone until the next
+    rebuild or the conference's next change."""
+    conferences = dict((key, {}) for key in shardKeys())
+    q = Conference.query(ndb.AND(Conference.seatsAvailable <= NEARLY_SOLD_OUT,
+                                 Conference.seatsAvailable > 0))
+    cursor, more = None, True
+    found = 0
+    while more:
+        confs, cursor, more = q.fetch_page(
+            REBUILD_BATCH_SIZE, start_cursor=cursor,
+            projection=[Conference.name, Conference.seatsAvailable])
+        for conf in confs:
+            wsck = conf.key.urlsafe()
+            conferences[shardKey(wsck)][wsck] = {'name': conf.name,
+                                                 'seats': conf.seatsAvailable}
+            found += 1
+    shards = [NearlySoldOut(key=key, conferences=cap(conferences[key]))
+              for key in shardKeys()]
+    ndb.put_multi(shards)
+    logging.info("Found %s nearly sold out conferences" % found)
+    return shards
@@ -0,0 +1,641 @@
+#!/usr/bin/env python
+
+"""benchmark.py
+
+Micro-benchmarks and a load harness for the conference API, run against
+the ndb testbed stubs.
+
+Run with the App Engine SDK on the python path, e.g.:
+    PYTHONPATH=$SDK:$SDK/lib/protorpc-1.0:$SDK/lib/webapp2-2.5.2 \\
+        python benchmark.py serializers
+
+The 'load' benchmark seeds the stubs and drives every ConferenceApi method,
+reporting throughput, latency percentiles and RPC counts per method:
+    python benchmark.py load --conferences 10000 --sessions 200000 \\
+        --profiles 50000 --iterations 100 --json load.json
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import argparse
+import collections
+import json
+import os
+import random
+import time
+import timeit
+from datetime import date
+
+# Key.urlsafe() needs an application id, even outside a request.
+os.environ.setdefault('APPLICATION_ID', 'dev~conference-benchmark')
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from protorpc import message_types
+
+import instrumentation
+import schedule
+import search
+import seats
+from models import Profile, ProfileForm, ProfileMiniForm, TeeShirtSize
+from models import Conference, ConferenceForm
+from models import ConferenceQueryForm, ConferenceQueryForms
+from models import Session, SessionForm, SessionForms
+from models import SessionQueryForm, SessionQueryForms
+from models import SessionTypeQuery, SessionSpeakerQuery, WebsafeKeysForm
+from models import SearchForm
+from models import ConflictException
+from serializers import SERIALIZERS
+
+
+# - - - Local testbed - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def setUpTestbed():
+    """Activate fresh datastore, memcache, taskqueue and user stubs."""
+    tb = testbed.Testbed()
+    tb.activate()
+    # high replication stub that always applies writes, like a warm datastore.
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    tb.init_datastore_v3_stub(consistency_policy=policy)
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+    tb.init_user_stub()
+    ndb.get_context().clear_cache()
+    return tb
+
+
+def actAs(email):
+    """Make endpoints.get_current_user() return the user for email."""
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'gmail.com'
+
+
+# - - - Legacy reflection copies, kept as the "before" baseline - - - - - -
+
+def reflectionCopyConference(conf, displayName):
+    """Per-field reflection copy, as _copyConferenceToForm used to do."""
+    cf = ConferenceForm()
+    for field in cf.all_fields():
+        if hasattr(conf, field.name):
+            if field.name.endswith('Date'):
+                setattr(cf, field.name, str(getattr(conf, field.name)))
+            else:
+                setattr(cf, field.name, getattr(conf, field.name))
+        elif field.name == "websafeKey":
+            setattr(cf, field.name, conf.key.urlsafe())
+    if displayName:
+        setattr(cf, 'organizerDisplayName', displayName)
+    cf.check_initialized()
+    return cf
+
+
+def reflectionCopySession(sesh, displayName):
+    """Per-field reflection copy, as _copySessionToForm used to do."""
+    sf = SessionForm()
+    for field in sf.all_fields():
+        if hasattr(sesh, field.name):
+            if field.name == 'date':
+                setattr(sf, field.name, str(getattr(sesh, field.name)))
+            else:
+                setattr(sf, field.name, getattr(sesh, field.name))
+        elif field.name == "websafeKey":
+            setattr(sf, field.name, sesh.key.urlsafe())
+    if displayName:
+        setattr(sf, 'creatorDisplayName', displayName)
+    sf.check_initialized()
+    return sf
+
+
+def reflectionCopyProfile(prof, displayName=None):
+    """Per-field reflection copy, as _copyProfileToForm used to do."""
+    pf = ProfileForm()
+    for field in pf.all_fields():
+        if hasattr(prof, field.name):
+            if field.name == 'teeShirtSize':
+                setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
+            else:
+                setattr(pf, field.name, getattr(prof, field.name))
+    pf.check_initialized()
+    return pf
+
+
+# - - - Fixtures - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def makeConferences(count):
+    """Build in-memory Conference entities with complete keys."""
+    return [Conference(
+        key=ndb.Key(Profile, 'user%d' % (i % 50), Conference, i + 1),
+        name='Conference %d' % i,
+        description='A conference about things number %d' % i,
+        organizerUserId='user%d' % (i % 50),
+        topics=['Topic %d' % (i % 7), 'Web'],
+        city='City %d' % (i % 20),
+        startDate=date(2016, i % 12 + 1, 1),
+        month=i % 12 + 1,
+        endDate=date(2016, i % 12 + 1, 3),
+        maxAttendees=100,
+        seatsAvailable=i % 100) for i in range(count)]
+
+
+def makeSessions(count):
+    """Build in-memory Session entities with complete keys."""
+    return [Session(
+        key=ndb.Key(Profile, 'user1', Conference, 1, Session, i + 1),
+        name='Session %d' % i,
+        highlights='Highlights of session %d' % i,
+        speaker='Speaker %d' % (i % 30),
+        date=date(2016, 6, i % 28 + 1),
+        duration=60,
+        startTime='%02d:00' % (i % 24),
+        typeOfSession='lecture',
+        creatorUserId='user1') for i in range(count)]
+
+
+def makeProfiles(count):
+    """Build in-memory Profile entities with complete keys."""
+    return [Profile(
+        key=ndb.Key(Profile, 'user%d' % i),
+        displayName='User %d' % i,
+        mainEmail='user%d@example.com' % i,
+        teeShirtSize='M_M') for i in range(count)]
+
+
+# - - - Benchmarks - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def timePerItem(copy, entities, repeat):
+    """Return the best per-item copy cost in microseconds."""
+    best = min(timeit.repeat(
+        lambda: [copy(entity, 'Display Name') for entity in entities],
+        number=1, repeat=repeat))
+    return best / len(entities) * 1e6
+
+
+def benchSerializers(count=1000, repeat=5):
+    """Compare reflection copies against the precompiled copy plans."""
+    cases = (
+        ('Conference', makeConferences(count), reflectionCopyConference),
+        ('Session', makeSessions(count), reflectionCopySession),
+        ('Profile', makeProfiles(count), reflectionCopyProfile),
+    )
+    results = []
+    for kind, entities, legacy_copy in cases:
+        serializer = SERIALIZERS[type(entities[0])]
+        before = timePerItem(legacy_copy, entities, repeat)
+        after = timePerItem(serializer.toForm, entities, repeat)
+        results.append((kind, before, after))
+        print '%-10s reflection %8.1f us/item   copy plan %8.1f us/item   (%.1fx)' % (
+            kind, before, after, before / after)
+    return results
+
+
+def benchRegistration(attendees=300, maxAttendees=200):
+    """Load test: drive concurrent registerForConference calls at a single
+    counter conference and a sharded one, checking neither oversells."""
+    from conference import ConferenceApi, CONF_GET_REQUEST
+
+    results = []
+    for num_shards in (0, seats.SEAT_SHARDS):
+        tb = setUpTestbed()
+        try:
+            conf_key = ndb.Key(Profile, 'organizer', Conference, 1)
+            entities = [Conference(key=conf_key, name='Load test',
+                                   organizerUserId='organizer',
+                                   maxAttendees=maxAttendees,
+                                   seatsAvailable=maxAttendees,
+                                   seatShards=num_shards)]
+            if num_shards:
+                entities += seats.createShards(conf_key, maxAttendees, num_shards)
+            ndb.put_multi(entities)
+            request = CONF_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=conf_key.urlsafe())
+
+            # start every registration before waiting on any, so their
+            # transactions interleave on the ndb event loop.
+            start = time.time()
+            futures = []
+            for i in range(attendees):
+                actAs('attendee%d@example.com' % i)
+                futures.append(ConferenceApi()._conferenceRegistration(request))
+            ndb.Future.wait_all(futures)
+            elapsed = time.time() - start
+
+            registered = sold_out = failed = 0
+            for future in futures:
+                exc = future.get_exception()
+                if exc is None:
+                    registered += 1
+                elif isinstance(exc, ConflictException):
+                    sold_out += 1
+                else:
+                    failed += 1
+
+            ndb.get_context().clear_cache()
+            if num_shards:
+                remaining = seats.getSeatsAvailableAsync(conf_key, num_shards).get_result()
+            else:
+                remaining = conf_key.get().seatsAvailable
+            oversold = registered > maxAttendees or registered + remaining != maxAttendees
+            results.append((num_shards, registered, sold_out, failed, elapsed, oversold))
+            print ('shards=%-3d registered=%-5d sold_out=%-5d contention_failures=%-5d '
+                   '%.1f registrations/s oversold=%s' % (
+                       num_shards, registered, sold_out, failed,
+                       registered / elapsed, oversold))
+        finally:
+            tb.deactivate()
+    return results
+
+
+def benchQueryModes(sessions=2000, repeat=20):
+    """Compare full-entity queries against keys-only + get_multi on repeated
+    queries, each run with a cold in-context cache like a new request."""
+    from conference import ConferenceApi
+
+    tb = setUpTestbed()
+    try:
+        entities = makeSessions(sessions)
+        ndb.put_multi(entities)
+        conf_key = entities[0].key.parent()
+        queries = (
+            ('conference sessions', lambda: Session.query(ancestor=conf_key)),
+            ('sessions by speaker', lambda: Session.query(Session.speaker == 'Speaker 1')),
+        )
+        api = ConferenceApi()
+        results = []
+        for name, makeQuery in queries:
+            timings = {}
+            for keys_only in (False, True):
+                # warm memcache once, then time queries from fresh contexts.
+                api._runQuery(makeQuery(), keys_only)
+                elapsed = 0.0
+                for _ in range(repeat):
+                    ndb.get_context().clear_cache()
+                    start = time.time()
+                    api._runQuery(makeQuery(), keys_only)
+                    elapsed += time.time() - start
+                timings[keys_only] = elapsed / repeat * 1e3
+            results.append((name, timings[False], timings[True]))
+            print '%-20s full entities %8.2f ms/query   keys-only + get_multi %8.2f ms/query' % (
+                name, timings[False], timings[True])
+        return results
+    finally:
+        tb.deactivate()
+
+
+def benchSessionImport(sessions=100):
+    """Compare importing a schedule with one createSession call per session
+    against a single createSessionsBulk call."""
+    from conference import ConferenceApi, SESSION_CREATE_REQUEST, SESSIONS_BULK_REQUEST
+
+    forms = [SessionForm(name='Session %d' % i,
+                         speaker='Speaker %d' % (i % 30),
+                         date='2016-06-%02d' % (i % 28 + 1),
+                         duration=60,
+                         startTime='%02d:00' % (i % 24),
+                         typeOfSession='lecture') for i in range(sessions)]
+    results = []
+    for mode in ('per-item', 'bulk'):
+        tb = setUpTestbed()
+        try:
+            actAs('organizer@example.com')
+            conf_key = ndb.Key(Profile, 'organizer', Conference, 1)
+            ndb.put_multi([Conference(key=conf_key, name='Import test',
+                                      organizerUserId='organizer'),
+                           schedule.newSchedule(conf_key)])
+            wsck = conf_key.urlsafe()
+            api = ConferenceApi()
+
+            start = time.time()
+            if mode == 'bulk':
+                request = SESSIONS_BULK_REQUEST.combined_message_class(
+                    items=forms, websafeConferenceKey=wsck)
+                api._createSessionsBulk(request).get_result()
+            else:
+                for form in forms:
+                    request = SESSION_CREATE_REQUEST.combined_message_class(
+                        websafeConferenceKey=wsck,
+                        **dict((field.name, getattr(form, field.name))
+                               for field in form.all_fields()))
+                    api._createSessionObject(request).get_result()
+            elapsed = time.time() - start
+
+            created = Session.query(ancestor=conf_key).count()
+            results.append((mode, created, elapsed))
+            print '%-9s %4d sessions in %7.1f ms   (%.2f ms/session)' % (
+                mode, created, elapsed * 1e3, elapsed / sessions * 1e3)
+        finally:
+            tb.deactivate()
+    return results
+
+
+# - - - Load harness - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+Seed = collections.namedtuple('Seed', 'emails conferences sessions speakers')
+
+CITIES = 50
+SPEAKERS = 500
+
+
+def seedDatastore(conferences, sessions, profiles, batch_size=500):
+    """Seed the datastore stub with profiles, and conferences with their seat
+    shards, schedules, sessions and search documents, as the API would have
+    created them.
+    Returns a Seed of emails, (conference key, organizer email) and
+    (session key, creator email) lists, and speaker names."""
+    emails = ['user%d@example.com' % i for i in range(profiles)]
+    pending = []
+
+    def put(entities):
+        pending.extend(entities)
+        if len(pending) >= batch_size:
+            ndb.put_multi(pending)
+            del pending[:]
+
+    put(Profile(key=ndb.Key(Profile, email), displayName='User %d' % i,
+                mainEmail=email, teeShirtSize='M_M')
+        for i, email in enumerate(emails))
+
+    conf_refs, session_refs = [], []
+    per_conference, extra = divmod(sessions, conferences) if conferences else (0, 0)
+    for i in range(conferences):
+        organizer = emails[i % profiles]
+        c_key = ndb.Key(Profile, organizer, Conference, i + 1)
+        num_shards = seats.shardCount(1000)
+        conf = Conference(key=c_key, name='Conference %d' % i,
+                          description='A conference about things number %d' % i,
+                          organizerUserId=organizer,
+                          topics=['Topic %d' % (i % 7), 'Web'],
+                          city='City %d' % (i % CITIES),
+                          startDate=date(2016, i % 12 + 1, 1), month=i % 12 + 1,
+                          endDate=date(2016, i % 12 + 1, 3),
+                          maxAttendees=1000, seatsAvailable=1000,
+                          seatShards=num_shards)
+        conf_sessions = [Session(
+            key=ndb.Key(Session, j + 1, parent=c_key),
+            name='Session %d-%d' % (i, j),
+            highlights='Highlights of session %d' % j,
+            speaker='Speaker %d' % ((i + j) % SPEAKERS),
+            date=date(2016, i % 12 + 1, j % 3 + 1),
+            duration=60,
+            startTime='%02d:00' % (j % 24),
+            typeOfSession=('lecture', 'workshop', 'keynote')[j % 3],
+            creatorUserId=organizer)
+            for j in range(per_conference + (1 if i < extra else 0))]
+        groups = schedule.buildGroups(c_key, [SERIALIZERS[Session].toForm(sesh)
+                                              for sesh in conf_sessions])
+        put([conf, schedule.newSchedule(c_key)] + groups +
+            seats.createShards(c_key, 1000, num_shards) + conf_sessions +
+            [search.document(entity) for entity in [conf] + conf_sessions])
+        conf_refs.append((c_key, organizer))
+        session_refs.extend((sesh.key, organizer) for sesh in conf_sessions)
+    ndb.put_multi(pending)
+    speakers = ['Speaker %d' % i for i in range(min(SPEAKERS, sessions))]
+    return Seed(emails, conf_refs, session_refs, speakers)
+
+
+def loadCases(seed, rand):
+    """Return (method name, call(i)) for every ConferenceApi endpoint method,
+    each call acting as a user and using a new ConferenceApi, as a request
+    would."""
+    from conference import ConferenceApi
+    from conference import CONF_GET_REQUEST, CONF_POST_REQUEST
+    from conference import SESSION_CREATE_REQUEST, SESSIONS_BULK_REQUEST
+    from conference import SESH_GET_REQUEST, SESH_POST_REQUEST
+    from conference import SESSION_TYPE_REQUEST, SESSION_SPEAKER_REQUEST
+
+    void = message_types.VoidMessage()
+    registered, wished = [], []
+
+    def anyUser():
+        return rand.choice(seed.emails)
+
+    def call(email, method, request):
+        actAs(email)
+        return getattr(ConferenceApi(), method)(request)
+
+    def confRequest(container=CONF_GET_REQUEST, **kwargs):
+        c_key, organizer = rand.choice(seed.conferences)
+        return organizer, container.combined_message_class(
+            websafeConferenceKey=c_key.urlsafe(), **kwargs)
+
+    def seshRequest(container=SESH_GET_REQUEST, **kwargs):
+        s_key, creator = rand.choice(seed.sessions)
+        return creator, container.combined_message_class(
+            websafeSessionKey=s_key.urlsafe(), **kwargs)
+
+    def asOwner(method, makeRequest):
+        """Return a call of method acting as the owner of its request's
+        conference or session."""
+        def run(i):
+            owner, request = makeRequest(i)
+            return call(owner, method, request)
+        return run
+
+    def newSessionForm(i):
+        return dict(name='Load session %d' % i, speaker=rand.choice(seed.speakers),
+                    date='2016-06-01', duration=45, startTime='10:00',
+                    typeOfSession='lecture')
+
+    def register(i):
+        email, request = anyUser(), confRequest()[1]
+        call(email, 'registerForConference', request)
+        registered.append((email, request))
+
+    def unregister(i):
+        email, request = registered.pop() if registered else (anyUser(), confRequest()[1])
+        call(email, 'unregisterForConference', request)
+
+    def wish(i):
+        email, request = anyUser(), seshRequest()[1]
+        call(email, 'addSessionToWishlist', request)
+        wished.append((email, request))
+
+    def unwish(i):
+        email, request = wished.pop() if wished else (anyUser(), seshRequest()[1])
+        call(email, 'removeSessionFromWishlist', request)
+
+    def attendee():
+        return registered[-1][0] if registered else anyUser()
+
+    def wisher():
+        return wished[-1][0] if wished else anyUser()
+
+    return [
+        ('getProfile', lambda i: call(anyUser(), 'getProfile', void)),
+        ('saveProfile', lambda i: call(anyUser(), 'saveProfile', ProfileMiniForm(
+            displayName='Renamed %d' % i))),
+        ('createConference', lambda i: call(anyUser(), 'createConference', ConferenceForm(
+            name='Load conference %d' % i, city='City %d' % (i % CITIES),
+            topics=['Web'], maxAttendees=100, startDate='2016-07-01',
+            endDate='2016-07-02'))),
+        ('queryConferences', lambda i: call(anyUser(), 'queryConferences', ConferenceQueryForms(
+            filters=[ConferenceQueryForm(field='CITY', operator='EQ',
+                                         value='City %d' % rand.randrange(CITIES))],
+            pageSize=20))),
+        ('updateConference', asOwner('updateConference', lambda i: confRequest(
+            CONF_POST_REQUEST, description='Updated %d' % i))),
+        ('getConference', lambda i: call(anyUser(), 'getConference', confRequest()[1])),
+        ('getConferencesBatch', lambda i: call(anyUser(), 'getConferencesBatch', WebsafeKeysForm(
+            websafeKeys=[c_key.urlsafe() for c_key, _ in rand.sample(
+                seed.conferences, min(10, len(seed.conferences)))]))),
+        ('getConferencesCreated', lambda i: call(rand.choice(seed.conferences)[1],
+                                                 'getConferencesCreated', void)),
+        ('queryPlayground', lambda i: call(anyUser(), 'queryPlayground', void)),
+        ('queryPlaygrondExtra', lambda i: call(anyUser(), 'queryPlaygrondExtra', void)),
+        ('createSession', lambda i: call(anyUser(), 'createSession', confRequest(
+            SESSION_CREATE_REQUEST, **newSessionForm(i))[1])),
+        ('createSessionsBulk', lambda i: call(anyUser(), 'createSessionsBulk', confRequest(
+            SESSIONS_BULK_REQUEST,
+            items=[SessionForm(**newSessionForm(i * 10 + j)) for j in range(10)])[1])),
+        ('querySessions', lambda i: call(anyUser(), 'querySessions', SessionQueryForms(
+            filters=[SessionQueryForm(field='SPEAKER', operator='EQ',
+                                      value=rand.choice(seed.speakers))],
+            pageSize=20))),
+        ('getSessionsCreated', lambda i: call(rand.choice(seed.sessions)[1],
+                                              'getSessionsCreated', void)),
+        ('updateSession', asOwner('updateSession', lambda i: seshRequest(
+            SESH_POST_REQUEST, highlights='Updated %d' % i))),
+        ('getSession', lambda i: call(anyUser(), 'getSession', seshRequest()[1])),
+        ('getSessionsBatch', lambda i: call(anyUser(), 'getSessionsBatch', WebsafeKeysForm(
+            websafeKeys=[s_key.urlsafe() for s_key, _ in rand.sample(
+                seed.sessions, min(10, len(seed.sessions)))]))),
+        ('getConferenceSessions', lambda i: call(anyUser(), 'getConferenceSessions',
+                                                 confRequest()[1])),
+        ('getConferenceSessionsByType', lambda i: call(anyUser(), 'getConferenceSessionsByType',
+            confRequest(SESSION_TYPE_REQUEST, session_type='workshop')[1])),
+        ('getSessionsBySpeaker', lambda i: call(anyUser(), 'getSessionsBySpeaker',
+            SessionSpeakerQuery(speaker=rand.choice(seed.speakers)))),
+        ('getConferenceFacets', lambda i: call(anyUser(), 'getConferenceFacets', void)),
+        ('searchConferences', lambda i: call(anyUser(), 'searchConferences', SearchForm(
+            query='topic %d' % rand.randrange(7), pageSize=20))),
+        ('searchSessions', lambda i: call(anyUser(), 'searchSessions', SearchForm(
+            query='speak %d' % rand.randrange(SPEAKERS), pageSize=20))),
+        ('getConferenceSessionsBySpeaker', lambda i: call(anyUser(), 'getConferenceSessionsBySpeaker',
+            confRequest(SESSION_SPEAKER_REQUEST, speaker=rand.choice(seed.speakers))[1])),
+        ('registerForConference', register),
+        ('getConferencesToAttend', lambda i: call(attendee(), 'getConferencesToAttend', void)),
+        ('unregisterForConference', unregister),
+        ('addSessionToWishlist', wish),
+        ('getSessionsInWishlist', lambda i: call(wisher(), 'getSessionsInWishlist', void)),
+        ('removeSessionFromWishlist', unwish),
+        ('getAnnouncement', lambda i: call(anyUser(), 'getAnnouncement', void)),
+        ('getCacheStats', lambda i: call(anyUser(), 'getCacheStats', void)),
+        ('getFeaturedSpeaker', lambda i: call(anyUser(), 'getFeaturedSpeaker',
+                                              confRequest()[1])),
+    ]
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, max(0, int(round(percent / 100.0 * len(values))) - 1))]
+
+
+def measure(name, call, iterations):
+    """Call a load case iterations times, each with a cold in-context cache
+    like a new request, and summarize its latency and RPC counts."""
+    latencies = []
+    totals = dict((metric, []) for metric in instrumentation.METRICS)
+    errors = collections.Counter()
+    for i in range(iterations):
+        ndb.get_context().clear_cache()
+        start = time.time()
+        with instrumentation.counting() as counters:
+            try:
+                call(i)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+        latencies.append((time.time() - start) * 1e3)
+        for metric in ('datastore_rpcs', 'memcache_hits', 'memcache_misses'):
+            totals[metric].append(counters[metric])
+    latencies.sort()
+    elapsed = sum(latencies) / 1e3
+    return {
+        'method': name,
+        'calls': iterations,
+        'errors': dict(errors),
+        'throughput_per_s': iterations / elapsed if elapsed else 0,
+        'latency_ms': dict([('mean', elapsed * 1e3 / iterations)] +
+                           [('p%d' % p, percentile(latencies, p))
+                            for p in instrumentation.PERCENTILES]),
+        'datastore_rpcs': sum(totals['datastore_rpcs']) / float(iterations),
+        'memcache_hits': sum(totals['memcache_hits']) / float(iterations),
+        'memcache_misses': sum(totals['memcache_misses']) / float(iterations),
+    }
+
+
+def benchLoad(conferences=200, sessions=4000, profiles=1000, iterations=50,
+              methods=None, random_seed=1):
+    """Seed the stubs, then drive every ConferenceApi method (or those in
+    methods) iterations times and report each one's throughput, latency
+    percentiles and mean RPCs per call."""
+    tb = setUpTestbed()
+    try:
+        start = time.time()
+        data = seedDatastore(conferences, sessions, profiles)
+        print 'seeded %d conferences, %d sessions, %d profiles in %.1f s' % (
+            conferences, sessions, profiles, time.time() - start)
+        results = []
+        for name, call in loadCases(data, random.Random(random_seed)):
+            if methods and name not in methods:
+                continue
+            result = measure(name, call, iterations)
+            results.append(result)
+            latency = result['latency_ms']
+            print ('%-28s %8.1f calls/s  p50 %7.2f  p90 %7.2f  p99 %7.2f ms  '
+                   '%5.1f datastore rpcs  %5.1f/%5.1f memcache hits/misses%s' % (
+                       name, result['throughput_per_s'], latency['p50'],
+                       latency['p90'], latency['p99'], result['datastore_rpcs'],
+                       result['memcache_hits'], result['memcache_misses'],
+                       '  errors %s' % result['errors'] if result['errors'] else ''))
+        return {'volumes': {'conferences': conferences, 'sessions': sessions,
+                            'profiles': profiles},
+                'iterations': iterations,
+                'results': results}
+    finally:
+        tb.deactivate()
+
+
+BENCHMARKS = {
+    'serializers': benchSerializers,
+    'registration': benchRegistration,
+    'queries': benchQueryModes,
+    'import': benchSessionImport,
+    'load': benchLoad,
+}
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='benchmarks to run: %s (default: all)' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--conferences', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=4000)
+    parser.add_argument('--profiles', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=50,
+                        help='calls per ConferenceApi method in the load benchmark')
+    parser.add_argument('--methods', help='comma separated ConferenceApi methods to load test')
+    parser.add_argument('--json', metavar='PATH', help='also write the results as JSON to PATH')
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r' % name)
+    return args
+
+
+if __name__ == '__main__':
+    args = parseArgs()
+    results = {}
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        if name == 'load':
+            results[name] = benchLoad(
+                conferences=args.conferences, sessions=args.sessions,
+                profiles=args.profiles, iterations=args.iterations,
+                methods=args.methods.split(',') if args.methods else None)
+        else:
+            results[name] = BENCHMARKS[name]()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Memcache caches for the conference API, with hit/miss counters:
+
+- a read-through cache of serialized ConferenceForm/SessionForm messages.
+  Each form has a generation counter, read with it; a reader that misses
+  stores the form it loads tagged with the generation it read before the
+  load, and the form is only served while the counter still matches. Writes
+  bump the counter after they commit, including saveProfile for the forms
+  showing the profile's display name, so a reader that loaded an entity
+  before a write commits cannot put the old form back. Entries are also
+  bounded by FORM_CACHE_TTL.
+- a query result cache of ordered key lists, keyed by a hash of the
+  normalized filters and a per-kind generation number. Bumping the
+  generation orphans every cached result set of that kind at once.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import hashlib
+import json
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from protorpc import protojson
+
+# Bump to orphan every cached form after a change to the form messages.
+FORM_CACHE_VERSION = 1
+FORM_CACHE_TTL = 600
+FORM_GENERATION_KEY = 'form-generation:%s:%s'
+
+# Query result sets are short lived; generations handle invalidation.
+QUERY_CACHE_TTL = 300
+GENERATION_KEY = 'generation:%s'
+
+# Caches with hit/miss counters, and their memcache counter keys.
+CACHE_NAMES = ('conference', 'session', 'conference-query')
+CACHE_STATS_KEY = 'cache-stats:%s:%s'
+
+
+def formCacheKey(kind, websafeKey):
+    """Return the versioned memcache key of a cached form."""
+    return 'form:v%d:%s:%s' % (FORM_CACHE_VERSION, kind, websafeKey)
+
+
+def formGenerationKey(kind, websafeKey):
+    """Return the memcache key of a cached form's generation counter."""
+    return FORM_GENERATION_KEY % (kind, websafeKey)
+
+
+def _initialGeneration():
+    # a counter evicted from memcache restarts from a value no cached form
+    # was tagged with.
+    return int(time.time() * 1000)
+
+
+@ndb.tasklet
+def getFormAsync(kind, websafeKey, form_class):
+    """Return the cached form for websafeKey, or None, and the generation to
+    fill the cache with, counting the hit or miss. The generation is None
+    when memcache can't give one."""
+    ctx = ndb.get_context()
+    generation_key = formGenerationKey(kind, websafeKey)
+    cached, generation = yield (ctx.memcache_get(formCacheKey(kind, websafeKey)),
+                                ctx.memcache_get(generation_key))
+    if generation is None:
+        yield ctx.memcache_add(generation_key, _initialGeneration())
+        generation = yield ctx.memcache_get(generation_key)
+    hit = generation is not None and cached is not None and cached[0] == generation
+    yield ctx.memcache_incr(CACHE_STATS_KEY % (kind, 'hit' if hit else 'miss'),
+                            initial_value=0)
+    if not hit:
+        raise ndb.Return(None, generation)
+    raise ndb.Return(protojson.decode_message(form_class, cached[1]), generation)
+
+
+@ndb.tasklet
+def fillFormAsync(kind, websafeKey, form, generation):
+    """Cache a form loaded from the datastore after getFormAsync returned
+    generation; it is served until a write bumps the generation."""
+    if generation is None:
+        # without a generation, a cached form could never be invalidated.
+        return
+    yield ndb.get_context().memcache_set(
+        formCacheKey(kind, websafeKey),
+        (generation, protojson.encode_message(form)), time=FORM_CACHE_TTL)
+
+
+@ndb.tasklet
+def invalidateFormAsync(kind, websafeKey):
+    """Invalidate the cached form; call after a write to it commits."""
+    ctx = ndb.get_context()
+    generation_key = formGenerationKey(kind, websafeKey)
+    generation = yield ctx.memcache_incr(generation_key,
+                                         initial_value=_initialGeneration())
+    if generation is None:
+        # a counter left behind would keep serving the old form; the next
+        # read starts a new one.
+        yield (ctx.memcache_delete(generation_key),
+               ctx.memcache_delete(formCacheKey(kind, websafeKey)))
+
+
+def recordOutcome(name, hit):
+    """Count a hit or miss of the named cache."""
+    memcache.incr(CACHE_STATS_KEY % (name, 'hit' if hit else 'miss'),
+                  initial_value=0)
+
+
+def getGeneration(kind):
+    """Return the current generation number of kind's cached result sets."""
+    generation = memcache.get(GENERATION_KEY % kind)
+    if generation is None:
+        # start from 1; if another request raced us, use whatever it stored.
+        memcache.add(GENERATION_KEY % kind, 1)
+        generation = memcache.get(GENERATION_KEY % kind) or 1
+    return int(generation)
+
+
+def bumpGeneration(kind):
+    """Invalidate every cached result set of kind."""
+    memcache.incr(GENERATION_KEY % kind, initial_value=1)
+
+
+def queryCacheKey(kind, filters, pageSize, pageToken):
+    """Return the cache key of a result page for the formatted filters;
+    filter order and value types do not change the key."""
+    normalized = sorted((f['field'], f['operator'], unicode(f['value']))
+                        for f in filters)
+    digest = hashlib.sha1(json.dumps(
+        [normalized, pageSize, pageToken or ''])).hexdigest()
+    return 'query:%s:%d:%s' % (kind, getGeneration(kind), digest)
+
+
+def getResultPage(kind, cache_key):
+    """Return the cached (websafe keys, next page token), or None."""
+    page = memcache.get(cache_key)
+    recordOutcome('%s-query' % kind, page is not None)
+    return page
+
+
+def setResultPage(cache_key, entities, nextPageToken):
+    """Cache the ordered keys of a result page with its next page token."""
+    memcache.set(cache_key,
+                 ([entity.key.urlsafe() for entity in entities], nextPageToken),
+                 time=QUERY_CACHE_TTL)
+
+
+def getStats():
+    """Return a list of (cache name, hits, misses) counters."""
+    keys = [CACHE_STATS_KEY % (name, outcome)
+            for name in CACHE_NAMES for outcome in ('hit', 'miss')]
+    counters = memcache.get_multi(keys)
+    return [(name,
+             int(counters.get(CACHE_STATS_KEY % (name, 'hit'), 0)),
+             int(counters.get(CACHE_STATS_KEY % (name, 'miss'), 0)))
+            for name in CACHE_NAMES]
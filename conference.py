@@ -13,7 +13,8 @@ created by wesc on 2014 apr 21
 __author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
 
 import logging
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 
 import endpoints
 from protorpc import messages
@@ -21,11 +22,15 @@ from protorpc import message_types
 from protorpc import remote
 
 from google.appengine.ext import ndb
-from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 
 # Gather all specified model classes for models.py
 from models import Profile
+from models import ConferenceRegistration
+from models import SessionWish
 from models import ProfileMiniForm
 from models import ProfileForm
 from models import TeeShirtSize
@@ -34,12 +39,28 @@ from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
-from models import Session, SessionForm, SessionForms
+from models import ScheduleGroup
+from models import Session, SessionForm, SessionForms, parseStartTime
 from models import SessionQueryForms, SessionTypeQuery, SessionSpeakerQuery
+from models import WebsafeKeysForm
 from models import BooleanMessage
 from models import ConflictException
 from models import StringMessage
-
+from models import CacheStatsForm, CacheStatsForms
+from models import SearchForm
+from models import FacetCountForm, FacetForm, FacetForms
+
+import announcements
+import cache
+import facets
+import planner
+import schedule
+import search
+import seats
+import session_index
+import speakers
+from serializers import SERIALIZERS
+from instrumentation import instrumented
 from settings import WEB_CLIENT_ID
 from utils import getUserId
 
@@ -76,21 +97,62 @@ CONF_FIELDS =    {
             'MAX_ATTENDEES': 'maxAttendees',
             }
 
-# Fields for session query options.
+# Fields for session query options. TIME compares 'HH:MM' start times,
+# START and END compare 'YYYY-MM-DD HH:MM' start & end datetimes.
 SESSION_FIELDS = {
     'SPEAKER': 'speaker',
     'DATE': 'date',
     'TYPE': 'typeOfSession',
-    'TIME': 'startTime',
+    'TIME': 'startMinutes',
+    'START': 'startDateTime',
+    'END': 'endDateTime',
+}
+
+# Seconds between syncs of a sharded conference's seatsAvailable total.
+SEAT_SYNC_INTERVAL = 5
+
+# Featured speaker refreshes are queued on a pull queue, and drained by at
+# most one push task per conference per FEATURED_SPEAKER_INTERVAL seconds.
+FEATURED_SPEAKER_QUEUE = 'featured-speakers'
+FEATURED_SPEAKER_INTERVAL = 5
+FEATURED_SPEAKER_LEASE = 60
+FEATURED_SPEAKER_BATCH = 100
+
+# Number of Profiles migrated per attendance migration task.
+MIGRATION_BATCH_SIZE = 100
+# Number of Sessions re-put per session times migration task.
+SESSION_MIGRATION_BATCH_SIZE = 200
+# Number of entities given search documents per reindex task, and the kinds
+# reindexed, in order.
+REINDEX_BATCH_SIZE = 200
+REINDEX_KINDS = (Conference, Session)
+
+# Page sizes for cursor paginated query endpoints.
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Most websafe keys accepted by one batch lookup.
+MAX_BATCH_KEYS = 100
+
+# Most sessions accepted by one bulk import, all written in one transaction:
+# with their search documents, schedule groups & speaker indexes, at most
+# 4 entities each, within the 500 entities a commit may write.
+MAX_BULK_SESSIONS = 100
+
+# Endpoints answered by a datastore query run it keys-only and then batch get
+# the entities, so that hot entities come out of ndb's in-context cache and
+# memcache; a conference's own sessions are served from its schedule instead.
+# Set an endpoint to False to run its query for full entities.
+KEYS_ONLY_QUERIES = {
+    'queryConferences': True,
+    'querySessions': True,
+    'getSessionsBySpeaker': True,
+    'getSessionsCreated': True,
 }
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
-                    'are nearly sold out: %s')
 
-MEMCACHE_FEAT_SPK_KEY = "CONFERENCE FEATURED SPEAKER"
 FEATURED_SESS_SPKR = ('%s is also a speaker at the following sessions '
                       'within this conference: %s')
 
@@ -128,12 +190,24 @@ SESH_POST_REQUEST =  endpoints.ResourceContainer(
     websafeSessionKey=messages.StringField(1),
 )
 
+# Create many sessions from SessionForms, with the websafeConferenceKey in the url.
+SESSIONS_BULK_REQUEST = endpoints.ResourceContainer(
+    SessionForms,
+    websafeConferenceKey=messages.StringField(1),
+)
+
 # session type request container for obtaining sessions of a certain type.
 SESSION_TYPE_REQUEST = endpoints.ResourceContainer(
     SessionTypeQuery,
     websafeConferenceKey=messages.StringField(1),
 )
 
+# session speaker request container for a conference's sessions by speaker.
+SESSION_SPEAKER_REQUEST = endpoints.ResourceContainer(
+    SessionSpeakerQuery,
+    websafeConferenceKey=messages.StringField(1),
+)
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
@@ -148,31 +222,61 @@ class ConferenceApi(remote.Service):
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
-
+        # the precompiled copy plan converts the t-shirt string to its Enum.
+        return SERIALIZERS[Profile].toForm(prof)
+
+
+    # Endpoints creates a ConferenceApi instance per request, so these
+    # memoize the current user and their Profile for a single request.
+    _user = None
+    _userId = None
+    _profileGetFuture = None
+    _profileFuture = None
+
+    def _getUser(self):
+        """Return the current (user, user id), resolved once per request."""
+        if self._user is None:
+            user = endpoints.get_current_user()
+            if not user:
+                raise endpoints.UnauthorizedException('Authorization required')
+            # get user id by calling getUserId(user)
+            self._userId = getUserId(user)
+            self._user = user
+        return self._user, self._userId
+
+    def _getProfileAsync(self):
+        """Return a Future of the current user's Profile, or None if they
+        have none yet; the Profile is fetched once per request."""
+        if self._profileGetFuture is None:
+            user, user_id = self._getUser()
+            self._profileGetFuture = ndb.Key(Profile, user_id).get_async()
+        return self._profileGetFuture
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-            
-        # get user id by calling getUserId(user)
-        user_id = getUserId(user)
+        return self._getProfileFromUserAsync().get_result()
+
+
+    def _getProfileFromUserAsync(self):
+        """Future version of _getProfileFromUser, so the Profile lookup can
+        overlap with other datastore RPCs. The user is resolved now, and the
+        Profile loaded once per request."""
+        if self._profileFuture is None:
+            user, user_id = self._getUser()
+            self._profileFuture = self._loadProfileAsync(user, user_id)
+        return self._profileFuture
+
+
+    @ndb.tasklet
+    def _loadProfileAsync(self, user, user_id):
+        """Tasklet returning the user's Profile, creating it if non-existent."""
         # create a new key of kind Profile from the id
         p_key = ndb.Key(Profile, user_id)
-        # get the entity from datastore by using get() on the key
-        profile = p_key.get()
+        # get the entity from datastore by yielding the (shared) profile get
+        profile = yield self._getProfileAsync()
+        # move any legacy attendance lists into child entities on first use.
+        if profile and (profile.conferenceKeysToAttend or profile.sessionKeysToAttend):
+            profile = yield self._migrateAttendanceAsync(p_key)
         # if no existing profile, create one.
         if not profile:
             profile = Profile(
@@ -181,8 +285,110 @@ class ConferenceApi(remote.Service):
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put() # save the profile to datastore
-        return profile      # return Profile
+            yield profile.put_async() # save the profile to datastore
+        raise ndb.Return(profile)      # return Profile
+
+
+    @staticmethod
+    @ndb.transactional_tasklet()
+    def _migrateAttendanceAsync(p_key):
+        """Move a Profile's legacy conference and session key lists into
+        ConferenceRegistration and SessionWish child entities."""
+        prof = yield p_key.get_async()
+        if not prof or not (prof.conferenceKeysToAttend or prof.sessionKeysToAttend):
+            raise ndb.Return(prof)
+        children = [ConferenceRegistration(id=wsck, parent=p_key)
+                    for wsck in set(prof.conferenceKeysToAttend)]
+        children += [SessionWish(id=wssk, parent=p_key)
+                     for wssk in set(prof.sessionKeysToAttend)]
+        prof.conferenceKeysToAttend = []
+        prof.sessionKeysToAttend = []
+        yield ndb.put_multi_async(children + [prof])
+        raise ndb.Return(prof)
+
+
+    @staticmethod
+    def _migrateAttendance(websafeCursor=None):
+        """Migrate one batch of Profiles to child entity attendance storage,
+        enqueuing the next batch until every Profile has been visited."""
+        cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+        profiles, next_cursor, more = Profile.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        futures = [ConferenceApi._migrateAttendanceAsync(prof.key)
+                   for prof in profiles
+                   if prof.conferenceKeysToAttend or prof.sessionKeysToAttend]
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+        logging.info("Migrated attendance for %d profiles." % len(futures))
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                url='/tasks/migrate_attendance')
+        return len(futures)
+
+
+    @staticmethod
+    @ndb.transactional_tasklet()
+    def _migrateSessionTimesAsync(s_keys):
+        """Re-put one conference's Sessions, storing their computed
+        startMinutes, startDateTime and endDateTime properties."""
+        sessions = yield ndb.get_multi_async(s_keys)
+        sessions = [sesh for sesh in sessions if sesh]
+        yield ndb.put_multi_async(sessions)
+        raise ndb.Return(len(sessions))
+
+
+    @staticmethod
+    def _migrateSessionTimes(websafeCursor=None):
+        """Migrate one batch of Sessions to typed start & end times, one
+        transaction per conference, enqueuing the next batch until every
+        Session has been visited."""
+        cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+        s_keys, next_cursor, more = Session.query().fetch_page(
+            SESSION_MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        groups = {}
+        for s_key in s_keys:
+            groups.setdefault(s_key.parent(), []).append(s_key)
+        futures = [ConferenceApi._migrateSessionTimesAsync(keys)
+                   for keys in groups.values()]
+        migrated = sum(future.get_result() for future in futures)
+        logging.info("Migrated times for %d sessions." % migrated)
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                url='/tasks/migrate_session_times')
+        return migrated
+
+
+    @staticmethod
+    def _reindexSearch(kind_index=0, websafeCursor=None):
+        """Put the search documents of one batch of Conferences or Sessions,
+        enqueuing the next batch until every entity of REINDEX_KINDS has
+        been visited."""
+        model = REINDEX_KINDS[kind_index]
+        cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+        entities, next_cursor, more = model.query().fetch_page(
+            REINDEX_BATCH_SIZE, start_cursor=cursor)
+        ndb.put_multi([search.document(entity) for entity in entities])
+        logging.info("Reindexed %d %s entities." % (len(entities), model.__name__))
+        if more and next_cursor:
+            taskqueue.add(params={'kind': kind_index, 'cursor': next_cursor.urlsafe()},
+                url='/tasks/reindex_search')
+        elif kind_index + 1 < len(REINDEX_KINDS):
+            taskqueue.add(params={'kind': kind_index + 1},
+                url='/tasks/reindex_search')
+        return len(entities)
+
+
+    def _getDisplayNames(self, profile_keys):
+        """Return a dict of Profile key to displayName, fetching all the
+        distinct Profiles in a single get_multi_async batch."""
+        profile_keys = list(set(profile_keys))
+        futures = ndb.get_multi_async(profile_keys)
+        names = {}
+        for p_key, future in zip(profile_keys, futures):
+            prof = future.get_result()
+            names[p_key] = getattr(prof, 'displayName', "") if prof else ""
+        return names
 
 
     def _doProfile(self, save_request=None):
@@ -191,6 +397,7 @@ class ConferenceApi(remote.Service):
         prof = self._getProfileFromUser()
 
         # if saveProfile(), process user-modifyable fields
+        displayName = prof.displayName
         if save_request:
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
@@ -202,13 +409,27 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, val)
                         setattr(prof, field, str(val))
                         prof.put()
+            if prof.displayName != displayName:
+                self._invalidateProfileFormsAsync(prof.key).get_result()
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
 
 
+    @ndb.tasklet
+    def _invalidateProfileFormsAsync(self, p_key):
+        """Invalidate the cached forms showing the Profile's display name:
+        of the conferences it organizes and the sessions it created."""
+        conf_keys, sesh_keys = yield (
+            Conference.query(ancestor=p_key).fetch_async(keys_only=True),
+            Session.query(Session.creatorUserId == p_key.id()).fetch_async(keys_only=True))
+        yield ([cache.invalidateFormAsync('conference', key.urlsafe()) for key in conf_keys] +
+               [cache.invalidateFormAsync('session', key.urlsafe()) for key in sesh_keys])
+
+
     @endpoints.method(message_types.VoidMessage, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
+    @instrumented
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
@@ -216,6 +437,7 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
             path='profile', http_method='POST', name='saveProfile')
+    @instrumented
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -225,29 +447,25 @@ class ConferenceApi(remote.Service):
 
     def _copyConferenceToForm(self, conf, displayName):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+        # the precompiled copy plan converts dates and adds the websafe key.
+        return SERIALIZERS[Conference].toForm(conf, displayName)
+
+
+    def _copyConferencesToForms(self, confs):
+        """Copy Conferences to ConferenceForms, resolving every organizer
+        display name with one batch Profile lookup."""
+        confs = [conf for conf in confs if conf]
+        names = self._getDisplayNames(conf.key.parent() for conf in confs)
+        serializer = SERIALIZERS[Conference]
+        return [serializer.toForm(conf, names.get(conf.key.parent()))
+                for conf in confs]
 
 
+    @ndb.tasklet
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user, user_id = self._getUser()
 
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
@@ -281,36 +499,79 @@ class ConferenceApi(remote.Service):
         # make Profile Key from user ID
         p_key = ndb.Key(Profile, user_id)
         # allocate new Conference ID with Profile key as parent
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
+        c_ids = yield Conference.allocate_ids_async(size=1, parent=p_key)
+        c_id = c_ids[0]
         # make Conference key from ID
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
-        # create Conference & return (modified) ConferenceForm
-        # send email confirmation to originator for conference.
-        Conference(**data).put()
-        # Create a default task queue to send an email confirmation.
-        taskqueue.add(params={'email': user.email(),
-            'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email'
-        )
-
-        return request
-
-    # Provide a transaction for updating a conference.
-    @ndb.transactional()
+        # split the seats over SeatShard counters, written with the conference.
+        data['seatShards'] = seats.shardCount(data['seatsAvailable'])
+        shards = []
+        if data['seatShards']:
+            shards = seats.createShards(c_key, data['seatsAvailable'], data['seatShards'])
+
+        # create Conference, with its empty session schedule and its search
+        # document, & return (modified) ConferenceForm; send email
+        # confirmation to originator for conference, enqueuing the default
+        # task queue email confirmation alongside the put.
+        conf = Conference(**data)
+        yield (ndb.put_multi_async([conf, schedule.newSchedule(c_key),
+                                    search.document(conf)] + shards),
+               self._addTaskAsync(params={'email': user.email(),
+                   'conferenceInfo': repr(request)},
+                   url='/tasks/send_confirmation_email'))
+        # cached query result sets may now be missing this conference, a
+        # small one may be nearly sold out from the start, and it counts
+        # towards the browse page facets.
+        cache.bumpGeneration('conference')
+        yield (announcements.seatsChangedAsync(c_key, data['seatsAvailable']),
+               facets.changedAsync([], facets.facetValues(conf)))
+
+        raise ndb.Return(request)
+
+    @ndb.tasklet
+    def _addTaskAsync(self, queue_name='default', **task_kwargs):
+        """Tasklet adding a push task, so enqueuing overlaps other RPCs."""
+        task = yield taskqueue.Queue(queue_name).add_async(
+            taskqueue.Task(**task_kwargs))
+        raise ndb.Return(task)
+
+    @ndb.tasklet
+    def _addTasksAsync(self, queue_name, tasks):
+        """Tasklet adding a batch of tasks, so several batches can be
+        yielded together."""
+        added = yield taskqueue.Queue(queue_name).add_async(tasks)
+        raise ndb.Return(added)
+
+    @ndb.tasklet
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-
-        # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-
+        user, user_id = self._getUser()
+
+        # the organizer Profile lives outside the conference entity group, so
+        # fetch it alongside the update transaction rather than inside it.
+        prof, (conf, facet_values) = yield (
+            self._getProfileAsync(),
+            self._updateConferenceTxn(request, user_id))
+        form = self._copyConferenceToForm(conf, getattr(prof, 'displayName', ""))
+        # invalidate the cached form, drop cached query result sets the
+        # update may have changed, move its facet counts, and refresh a
+        # sharded seat total.
+        cache.bumpGeneration('conference')
+        yield (cache.invalidateFormAsync('conference', request.websafeConferenceKey),
+               announcements.seatsChangedAsync(conf.key, conf.seatsAvailable),
+               facets.changedAsync(facet_values, facets.facetValues(conf)))
+        if conf.seatShards:
+            yield self._syncSeatsLaterAsync(conf.key)
+        raise ndb.Return(form)
+
+    # Provide a transaction for updating a conference; cross-group so that a
+    # sharded conference's seat shards follow changes to maxAttendees.
+    @ndb.transactional_tasklet(xg=True)
+    def _updateConferenceTxn(self, request, user_id):
         # update existing conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = yield ndb.Key(urlsafe=request.websafeConferenceKey).get_async()
         # check that conference exists
         if not conf:
             raise endpoints.NotFoundException(
@@ -321,12 +582,18 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        # a sharded conference's seatsAvailable is derived from its shards.
+        old_max = conf.maxAttendees or 0
+        facet_values = facets.facetValues(conf)
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
+                if field.name == 'seatsAvailable' and conf.seatShards:
+                    continue
                 # special handling for dates (convert string to Date)
                 if field.name in ('startDate', 'endDate'):
                     data = datetime.strptime(data, "%Y-%m-%d").date()
@@ -334,78 +601,124 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
-        conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+
+        # move the seat shards by the change in maxAttendees.
+        delta = (conf.maxAttendees or 0) - old_max
+        if conf.seatShards and delta:
+            yield seats.adjustSeatsAsync(conf.key, conf.seatShards, delta)
+            conf.seatsAvailable = max(0, (conf.seatsAvailable or 0) + delta)
+        yield ndb.put_multi_async([conf, search.document(conf)])
+        raise ndb.Return(conf, facet_values)
 
     # Create a new conference endpoint definition.
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
+    @instrumented
     def createConference(self, request):
         """Create new conference."""
-        return self._createConferenceObject(request)
+        return self._createConferenceObject(request).get_result()
 
     # Conference queries endpoint definition.
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
                 path='queryConferences',
                 http_method='POST',
                 name='queryConferences')
+    @instrumented
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
+        """Query for conferences, one page at a time."""
+        # serve the page's ordered keys from the query result cache when the
+        # same filters were run since conferences last changed.
+        filters = self._parseConferenceFilters(self._formatFilters(request.filters))
+        cache_key = cache.queryCacheKey('conference', filters,
+            request.pageSize or DEFAULT_PAGE_SIZE, request.pageToken)
+        page = cache.getResultPage('conference', cache_key)
+        if page is not None:
+            websafe_keys, next_token = page
+            conferences = ndb.get_multi([ndb.Key(urlsafe=k) for k in websafe_keys])
+        else:
+            conferences, next_token = self._fetchPlannedPage(
+                Conference, filters, request, KEYS_ONLY_QUERIES['queryConferences'])
+            cache.setResultPage(cache_key, conferences, next_token)
 
          # return individual ConferenceForm object per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") \
-            for conf in conferences]
+            items=self._copyConferencesToForms(conferences),
+            nextPageToken=next_token
         )
 
     # Endpoint for updating the conference selected.
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
+    @instrumented
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        return self._updateConferenceObject(request).get_result()
 
 
     # Return conference requested by websafeConferenceKey
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
+    @instrumented
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        return self._getConferenceAsync(request.websafeConferenceKey).get_result()
+
+    @ndb.tasklet
+    def _getConferenceAsync(self, websafeConferenceKey):
+        """Tasklet returning the ConferenceForm for websafeConferenceKey,
+        read through the memcache form cache."""
+        form, generation = yield cache.getFormAsync('conference', websafeConferenceKey,
+                                                    ConferenceForm)
+        if form:
+            raise ndb.Return(form)
+
+        conf_key = ndb.Key(urlsafe=websafeConferenceKey)
+        # the organizer Profile is the conference's parent, so both gets
+        # can be issued together; bail if the conference is not found.
+        conf, prof = yield conf_key.get_async(), conf_key.parent().get_async()
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
-        # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+                'No conference found with key: %s' % websafeConferenceKey)
+        # cache & return ConferenceForm
+        form = self._copyConferenceToForm(conf, getattr(prof, 'displayName', ""))
+        yield cache.fillFormAsync('conference', websafeConferenceKey, form, generation)
+        raise ndb.Return(form)
+
+    # Return the conferences requested by a list of websafeConferenceKeys.
+    @endpoints.method(WebsafeKeysForm, ConferenceForms,
+            path='conferences/batch',
+            http_method='POST', name='getConferencesBatch')
+    @instrumented
+    def getConferencesBatch(self, request):
+        """Return requested conferences, listing any not found in missingKeys."""
+        conferences, missing = self._getEntitiesBatch(request.websafeKeys, Conference)
+        return ConferenceForms(
+            items=self._copyConferencesToForms(conferences),
+            missingKeys=missing
+        )
 
     # Get conference created by the user endpoint definition.
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
         path='getConferencesCreated',
         http_method='POST', name='getConferencesCreated')
+    @instrumented
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user, user_id = self._getUser()
 
         # create ancestor query for all key matches for this user
         confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=self._copyConferencesToForms(confs)
         )
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='queryPlayground', http_method='GET', name='queryPlayground')
+    @instrumented
     def queryPlayground(self, request):
         """Return query search entered."""
         # Return a random search for conferences in London.
@@ -416,12 +729,12 @@ class ConferenceApi(remote.Service):
         f = ndb.query.FilterNode(field, operator, value)
         q = q.filter(f)
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") \
-            for conf in q]
+            items=self._copyConferencesToForms(q)
         )
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='queryPlaygroundExtra', http_method='GET', name='queryPlaygroundExtra')
+    @instrumented
     def queryPlaygrondExtra(self, request):
         """Return query search entered."""
         # Start by querying all conferences.
@@ -436,35 +749,87 @@ class ConferenceApi(remote.Service):
         q = q.filter(Conference.maxAttendees > 15)
         # Return the queried conferences as a ConferenceForm object.
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") \
-            for conf in q]
+            items=self._copyConferencesToForms(q)
         )
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        # obtain parsed and formatted user query filters from _formatFilters
-        inequality_filter, filters = self._formatFilters(request.filters)
-
-        # Sort inequality filter first if it exists from _formatFilters.
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-
+    def _parseConferenceFilters(self, filters):
+        """Convert formatted conference filter values to their property types."""
         for filtr in filters:
             if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            # create a filterNode object containing the custom query, and return it.
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Invalid value %r for conference filter %s." % (
+                            filtr["value"], filtr["field"]))
+        return filters
+
+    def _getEntitiesBatch(self, websafeKeys, kind):
+        """Fetch the entities of kind for websafeKeys with one get_multi,
+        returning them in request order with the keys that were not found."""
+        if len(websafeKeys) > MAX_BATCH_KEYS:
+            raise endpoints.BadRequestException(
+                "At most %d websafeKeys may be requested at once." % MAX_BATCH_KEYS)
+
+        # malformed keys, incomplete keys, and keys of another kind or of
+        # another application or namespace are reported as missing, as sent.
+        local = ndb.Key(kind, 1)
+        requested = []
+        for websafeKey in websafeKeys:
+            try:
+                key = ndb.Key(urlsafe=websafeKey)
+            except (TypeError, ValueError, ProtocolBufferDecodeError,
+                    datastore_errors.Error):
+                key = None
+            if (key and key.kind() == kind.__name__ and key.id() is not None and
+                    key.app() == local.app() and key.namespace() == local.namespace()):
+                requested.append((websafeKey, key))
+            else:
+                requested.append((websafeKey, None))
+
+        entities, missing = [], []
+        found = iter(ndb.get_multi([key for websafeKey, key in requested if key]))
+        for websafeKey, key in requested:
+            entity = next(found) if key else None
+            if entity:
+                entities.append(entity)
+            else:
+                missing.append(websafeKey)
+        return entities, missing
+
+    def _runQuery(self, q, keys_only):
+        """Run q for its entities, either directly or keys-only followed by
+        one get_multi that can be served from ndb's caches."""
+        if keys_only:
+            return ndb.get_multi(q.fetch(keys_only=True))
+        return q.fetch()
+
+    def _pageSize(self, request):
+        """Return the request's pageSize, or the default if it has none."""
+        page_size = request.pageSize or DEFAULT_PAGE_SIZE
+        if page_size < 1 or page_size > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "pageSize must be between 1 and %d." % MAX_PAGE_SIZE)
+        return page_size
+
+    def _fetchPlannedPage(self, model, filters, request, keys_only=False):
+        """Fetch one page of results for formatted filters of any number of
+        inequality fields, planned by planner.plan, returning the entities
+        and the token for the next page."""
+        page_size = self._pageSize(request)
+        try:
+            field, start_cursor = planner.parseToken(request.pageToken)
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+        plan = planner.plan(model, filters, field)
+        results, next_cursor = planner.fetchPage(model, plan, page_size,
+                                                 start_cursor, keys_only)
+        return results, planner.makeToken(plan, next_cursor)
 
     def _formatFilters(self, filters, queryType='conference'):
-        """Parse, check validity and format user supplied filters."""
+        """Parse, check validity and format user supplied filters; filters
+        may have inequalities on several fields, see planner.plan."""
         formatted_filters = []
-        inequality_field = None
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
@@ -485,90 +850,32 @@ class ConferenceApi(remote.Service):
                     raise endpoints.BadRequestException(
                         "Filter contains invalid field or operator for sessions.")
 
-
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
-
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return formatted_filters
 
 # - - - Session objects - - - - - - - - - - - - - - - - -
 
     def _copySessionToForm(self, theSession, displayName):
         """Copy relevant fields from Session to SessionForm."""
-        # create an instance of SessionForm
-        sesh = SessionForm()
-        for field in sesh.all_fields():
-            # to get/set properties with names defined in strings use getattr/setattr.
-            if hasattr(theSession, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(sesh, field.name, str(getattr(theSession, field.name)))
-                else:
-                    setattr(sesh, field.name, getattr(theSession, field.name))
-            elif field.name == "websafeKey":
-                setattr(sesh, field.name, theSession.key.urlsafe())
-        if displayName:
-            setattr(sesh, 'creatorDisplayName', displayName)
-        sesh.check_initialized()
-        return sesh
-
-    def _copySessionToFormAfterCreation(self, data, theSession):
-        """Copy data fields from Session object creation to SessionForm."""
-
-        # get the session object, create urlsafe key and place in data.
-        extracted_session = theSession.get()
-        urlsafe_session_key = extracted_session.key.urlsafe()
-        data['websafeKey'] = urlsafe_session_key
-
-        # obtain the creators display name from the user id.
-        prof = ndb.Key(Profile, data['creatorUserId']).get()
-        data['creatorDisplayName'] = prof.displayName
-
-        # create an instance of SessionForm
-        sesh = SessionForm(
-            name="",
-            highlights="",
-            speaker="",
-            date="",
-            duration=60,
-            startTime="",
-            typeOfSession="",
-            creatorUserId="",
-            websafeKey="",
-            creatorDisplayName="")
-        sesh.check_initialized()
-
-        # Pass all fields from data into the instance of SessionForm and return.
-        for field in sesh.all_fields():
-            if data[field.name] and data[field.name] != 'websafeKey':
-                if field.name == 'date':
-                    setattr(sesh, field.name, str(data[field.name]))
-                elif field.name == 'duration':
-                    setattr(sesh, field.name, int(data[field.name]))
-                else:
-                    setattr(sesh, field.name, data[field.name])
-            elif field.name == 'websafeKey':
-                setattr(sesh, field.name, str(session_object_key))
-        sesh.check_initialized()
-
-        return sesh
-
-
+        # the precompiled copy plan converts dates and adds the websafe key.
+        return SERIALIZERS[Session].toForm(theSession, displayName)
+
+    def _copySessionsToForms(self, sessions):
+        """Copy Sessions to SessionForms, resolving every creator display
+        name with one batch Profile lookup."""
+        sessions = [sesh for sesh in sessions if sesh]
+        creator_keys = [ndb.Key(Profile, sesh.creatorUserId) if sesh.creatorUserId
+                        else None for sesh in sessions]
+        names = self._getDisplayNames(key for key in creator_keys if key)
+        serializer = SERIALIZERS[Session]
+        return [serializer.toForm(sesh, names.get(p_key))
+                for sesh, p_key in zip(sessions, creator_keys)]
+
+    @ndb.tasklet
     def _createSessionObject(self, request):
         """Create or update Session object, returning SessionForm/request."""
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user, user_id = self._getUser()
 
         # Check for session name in request object - if not raise exception.
         if not request.name:
@@ -580,74 +887,165 @@ class ConferenceApi(remote.Service):
 
         # create a conference key from the given websafeConferenceKey request object.
         conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-
-        # fetch conference entity from datastore.
-        conf = conf_key.get()
+        # fetch the conference and creator profile, and allocate new Session ID
+        # with Conference key as parent; none depend on each other so overlap them.
+        conf, prof, s_ids = yield (conf_key.get_async(), self._getProfileAsync(),
+                                   Session.allocate_ids_async(size=1, parent=conf_key))
 
         # Check for conference with corresponding websafeConferenceKey - if not raise excep.
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
 
+        # create Session and add it to the conference schedule; once it has
+        # committed, queue a featured speaker notification in case the speaker
+        # features in more than 1 of the selected conference sessions.
+        theSession = self._sessionFromForm(
+            request, ndb.Key(Session, s_ids[0], parent=conf_key), user_id)
+        form = self._copySessionToForm(theSession, getattr(prof, 'displayName', ""))
+        yield self._putSessionsTxn(conf_key, [theSession], [form])
+        yield (self._featuredSpeakerLaterAsync(request.websafeConferenceKey,
+                                               [theSession.speaker]),
+               session_index.bumpGenerationAsync(request.websafeConferenceKey))
+
+        # return the SessionForm object.
+        raise ndb.Return(form)
+
+    def _sessionFromForm(self, form, s_key, user_id):
+        """Return a new Session with key s_key from a SessionForm."""
         # copy SessionForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-        del data['websafeKey']
-        del data['websafeConferenceKey']
-        del data['creatorDisplayName']
+        data = {field.name: getattr(form, field.name) for field in form.all_fields()}
+        for name in ('websafeKey', 'websafeConferenceKey', 'creatorDisplayName'):
+            data.pop(name, None)
 
         # add default values for those missing (both data model & outbound Message)
         for df in SESSION_DEFAULTS:
             if data[df] in (None, []):
                 data[df] = SESSION_DEFAULTS[df]
-                setattr(request, df, SESSION_DEFAULTS[df])
+                setattr(form, df, SESSION_DEFAULTS[df])
 
-        # convert dates from strings to Date objects; set month based on start_date
+        # convert dates from strings to Date objects
         if data['date']:
-            data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
+            try:
+                data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    "Session 'date' must be YYYY-MM-DD, not %s" % data['date'])
 
         # ensure input duration is an integer.
         if data['duration']:
-            logging.info("Converting duration into integer!!!!")
             data['duration'] = int(data['duration'])
 
-        # allocate new Session ID with Conference key as parent
-        s_id = Session.allocate_ids(size=1, parent=conf_key)[0]
-        # make Session key from ID
-        s_key = ndb.Key(Session, s_id, parent=conf_key)
         data['key'] = s_key
-        # make Profile Key from user ID for creatorUserId field in session
-        p_key = ndb.Key(Profile, user_id)
-        data['creatorUserId'] = request.creatorUserId = user_id
-
-        # create Session & return (modified) SessionForm
-        theSession = Session(**data).put()
-
-        # Create a task queue to set a featured speaker notification if the 
-        # speaker features in more than 1 of the selected conference sessions.
-        taskqueue.add(params={'speaker': data['speaker'],
-            'wsck': request.websafeConferenceKey},
-            url='/tasks/get_featured_speaker'
-        )
-
-        # create a SessionForm object and return.
-        session_object = self._copySessionToFormAfterCreation(data, theSession)
-
-        return session_object
+        data['creatorUserId'] = form.creatorUserId = user_id
+        return Session(**data)
+
+    @ndb.tasklet
+    def _createSessionsBulk(self, request):
+        """Create all the sessions of a SessionForms in one conference,
+        returning their SessionForms."""
+        user, user_id = self._getUser()
+
+        forms = request.items
+        if not forms:
+            raise endpoints.BadRequestException("At least one session is required")
+        if len(forms) > MAX_BULK_SESSIONS:
+            raise endpoints.BadRequestException(
+                'At most %d sessions can be created at once' % MAX_BULK_SESSIONS)
+        # validate every session before writing any of them.
+        for i, form in enumerate(forms):
+            if not form.name:
+                raise endpoints.BadRequestException(
+                    "Session 'name' field required (item %d)" % i)
 
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        # fetch the conference once, the creator profile, and allocate every
+        # new Session ID in one call; overlap all three.
+        conf, prof, (first, last) = yield (
+            conf_key.get_async(), self._getProfileAsync(),
+            Session.allocate_ids_async(size=len(forms), parent=conf_key))
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
 
-    # Provide a transaction for updating a session.
-    @ndb.transactional()
+        displayName = getattr(prof, 'displayName', "")
+        sessions = [self._sessionFromForm(form, ndb.Key(Session, s_id, parent=conf_key),
+                                          user_id)
+                    for form, s_id in zip(forms, range(first, last + 1))]
+        session_forms = [self._copySessionToForm(sesh, displayName) for sesh in sessions]
+
+        # write the sessions with their schedule & speaker index updates in
+        # one transaction, so either all of them are created or none is.
+        yield self._putSessionsTxn(conf_key, sessions, session_forms)
+        # then queue the featured speaker refreshes in one batch.
+        yield (self._featuredSpeakerLaterAsync(request.websafeConferenceKey,
+                                               [sesh.speaker for sesh in sessions]),
+               session_index.bumpGenerationAsync(request.websafeConferenceKey))
+        raise ndb.Return(session_forms)
+
+    @ndb.transactional_tasklet()
+    def _putSessionsTxn(self, conf_key, sessions, forms):
+        """Put sessions of a conference with their search documents, adding
+        their forms to its schedule and them to its speaker indexes."""
+        # conferences without a schedule get one built on their first read.
+        groups, indexes = yield (schedule.putFormsAsync(conf_key, forms),
+                                 speakers.indexSessionsAsync(conf_key,
+                                     added=[speakers.sessionEntry(sesh) for sesh in sessions]))
+        entities = list(sessions) + [search.document(sesh) for sesh in sessions]
+        yield ndb.put_multi_async(entities + groups + indexes)
+
+
+    @ndb.tasklet
     def _updateSessionObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-
-        # copy SessionForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-
+        user, user_id = self._getUser()
+
+        # the creator Profile lives outside the session entity group, so
+        # fetch it alongside the update transaction rather than inside it.
+        prof, (sesh, changed_speakers) = yield (
+            self._getProfileAsync(),
+            self._updateSessionTxn(request, user_id))
+        form = self._copySessionToForm(sesh, getattr(prof, 'displayName', ""))
+        # invalidate the cached form now the update has committed, and
+        # refresh the featured speaker of any speaker whose sessions changed.
+        yield (cache.invalidateFormAsync('session', request.websafeSessionKey),
+               self._featuredSpeakerLaterAsync(sesh.key.parent().urlsafe(),
+                                               changed_speakers),
+               session_index.bumpGenerationAsync(sesh.key.parent().urlsafe()))
+        raise ndb.Return(form)
+
+    @ndb.tasklet
+    def _featuredSpeakerLaterAsync(self, websafeConferenceKey, speaker_names):
+        """Queue featured speaker refreshes for a conference's speakers. They
+        are pull tasks tagged with the conference, drained by a push task
+        named per FEATURED_SPEAKER_INTERVAL window, so a burst of session
+        writes costs one worker run per conference."""
+        speaker_names = set(speaker for speaker in speaker_names if speaker)
+        if not speaker_names:
+            return
+        window = int(time.time() / FEATURED_SPEAKER_INTERVAL) + 1
+        pull_tasks = [taskqueue.Task(method='PULL', tag=websafeConferenceKey,
+                                     payload=speaker.encode('utf-8'))
+                      for speaker in sorted(speaker_names)]
+        # each add is wrapped in a tasklet, as ndb only accepts a list of
+        # Futures, not of the UserRPCs add_async returns.
+        yield [self._addTasksAsync(FEATURED_SPEAKER_QUEUE,
+                                   pull_tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+               for i in range(0, len(pull_tasks), taskqueue.MAX_TASKS_PER_ADD)]
+        try:
+            yield self._addTaskAsync(
+                name='featured-speaker-%s-%d' % (websafeConferenceKey, window),
+                eta=datetime.utcfromtimestamp(window * FEATURED_SPEAKER_INTERVAL),
+                params={'wsck': websafeConferenceKey},
+                url='/tasks/get_featured_speaker')
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    # Provide a transaction for updating a session and its schedule entry.
+    @ndb.transactional_tasklet()
+    def _updateSessionTxn(self, request, user_id):
         # update existing session
-        sesh = ndb.Key(urlsafe=request.websafeSessionKey).get()
+        s_key = ndb.Key(urlsafe=request.websafeSessionKey)
+        sesh = yield s_key.get_async()
         # check that session exists
         if not sesh:
             raise endpoints.NotFoundException(
@@ -657,6 +1055,8 @@ class ConferenceApi(remote.Service):
         if user_id != sesh.creatorUserId:
             raise endpoints.ForbiddenException(
                 'Only the owner can update the session.')
+        previous = speakers.sessionEntry(sesh)
+        before = self._copySessionToForm(sesh, None)
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from SessionForm to Session object
@@ -669,40 +1069,79 @@ class ConferenceApi(remote.Service):
                     data = datetime.strptime(data, "%Y-%m-%d").date()
                 # write to Session object
                 setattr(sesh, field.name, data)
-        sesh.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copySessionToForm(sesh, getattr(prof, 'displayName'))
+        entities = [sesh, search.document(sesh)]
+        # move the session's schedule entry, whose group may have changed.
+        entities += yield schedule.putFormsAsync(
+            s_key.parent(), [self._copySessionToForm(sesh, None)], previous=[before])
+        # move the session between speaker indexes if its speaker or name changed.
+        current = speakers.sessionEntry(sesh)
+        changed_speakers = []
+        if current != previous:
+            entities += yield speakers.indexSessionsAsync(
+                s_key.parent(), added=[current], removed=[previous])
+            changed_speakers = [speaker for speaker in set((previous[0], current[0]))
+                                if speaker]
+        yield ndb.put_multi_async(entities)
+        raise ndb.Return(sesh, changed_speakers)
 
 
     # Create a new Session endpoint definition.
     @endpoints.method(SESSION_CREATE_REQUEST, SessionForm,
             path='conference/{websafeConferenceKey}/session/create',
             http_method='POST', name='createSession')
+    @instrumented
     def createSession(self, request):
         """Create new session."""
-        return self._createSessionObject(request)
+        return self._createSessionObject(request).get_result()
 
 
-    def _getSessionQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Session.query()
-        # obtain parsed and formatted user query filters from _formatFilters
-        inequality_filter, filters = self._formatFilters(request.filters, queryType='conf_sessions')
+    # Create many sessions of a conference in one request.
+    @endpoints.method(SESSIONS_BULK_REQUEST, SessionForms,
+            path='conference/{websafeConferenceKey}/sessions/bulk',
+            http_method='POST', name='createSessionsBulk')
+    @instrumented
+    def createSessionsBulk(self, request):
+        """Create the given sessions in a conference, validating all of them
+        before any is written; either all are created or none is."""
+        return SessionForms(items=self._createSessionsBulk(request).get_result())
 
-        # Sort inequality filter first if it exists from _formatFilters.
-        if not inequality_filter:
-            q = q.order(Session.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Session.name)
 
+    def _parseSessionFilters(self, filters):
+        """Convert formatted session filter values to their property types,
+        and serve a start time range on one date as one startDateTime range,
+        which needs a single index scan."""
         for filtr in filters:
-            if filtr["field"] in ["date"]:
-                filtr["value"] = int(filtr["value"])
-            # create a filterNode object containing the custom query, and return it.
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+            value = filtr["value"]
+            try:
+                if filtr["field"] == "date":
+                    value = datetime.strptime(value[:10], "%Y-%m-%d").date()
+                elif filtr["field"] == "startMinutes":
+                    value = parseStartTime(value)
+                    if value is None:
+                        raise ValueError(filtr["value"])
+                elif filtr["field"] in ("startDateTime", "endDateTime"):
+                    value = datetime.strptime(value.strip()[:16].replace('T', ' '),
+                                              "%Y-%m-%d %H:%M")
+            except (TypeError, ValueError):
+                raise endpoints.BadRequestException(
+                    "Invalid value %r for session filter %s." % (
+                        filtr["value"], filtr["field"]))
+            filtr["value"] = value
+
+        days = [f for f in filters if f["field"] == "date" and f["operator"] == "="]
+        times = [f for f in filters if f["field"] == "startMinutes"]
+        if len(days) == 1 and times and all(f["operator"] != "!=" for f in times):
+            day = datetime.combine(days[0]["value"], datetime.min.time())
+            merged = set(id(f) for f in times + days)
+            filters = [f for f in filters if id(f) not in merged]
+            # keep the date itself, which a one-sided time range would lose.
+            filters.append({"field": "startDateTime", "operator": ">=", "value": day})
+            filters.append({"field": "startDateTime", "operator": "<",
+                            "value": day + timedelta(days=1)})
+            for f in times:
+                filters.append({"field": "startDateTime", "operator": f["operator"],
+                                "value": day + timedelta(minutes=f["value"])})
+        return filters
 
 
     # Session queries endpoint definition.
@@ -710,35 +1149,61 @@ class ConferenceApi(remote.Service):
                 path='querySessions',
                 http_method='POST',
                 name='querySessions')
+    @instrumented
     def querySessions(self, request):
-        """Query for sessions."""
-        sessions = self._getSessionQuery(request)
+        """Query for sessions, one page at a time."""
+        # obtain parsed and formatted user query filters from _formatFilters,
+        # with values of the types of the properties they filter
+        filters = self._parseSessionFilters(
+            self._formatFilters(request.filters, queryType='conf_sessions'))
+        if request.websafeConferenceKey:
+            # one conference's sessions are served from its in-memory index.
+            return self._queryConferenceSessions(request, filters)
+        sessions, next_token = self._fetchPlannedPage(
+            Session, filters, request, KEYS_ONLY_QUERIES['querySessions'])
+
+         # return individual SessionForm object per Session
+        return SessionForms(
+            items=self._copySessionsToForms(sessions),
+            nextPageToken=next_token
+        )
 
-         # return individual SessionForm object per Conference
+    def _queryConferenceSessions(self, request, filters):
+        """Return one page of a conference's sessions matching the filters
+        from its session index, in schedule order; page tokens are offsets
+        into the matches."""
+        page_size = self._pageSize(request)
+        try:
+            start = int(request.pageToken or 0)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+        if start < 0:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+        index = session_index.getIndex(request.websafeConferenceKey, self._getSchedule)
+        entries = index.find(filters)
+        end = start + page_size
         return SessionForms(
-            items=[self._copySessionToForm(sesh, "") \
-            for sesh in sessions]
+            items=self._copyEntriesToForms(entries[start:end]),
+            nextPageToken=str(end) if end < len(entries) else None
         )
 
     # Get session created by the user endpoint definition.
     @endpoints.method(message_types.VoidMessage, SessionForms,
         path='getSessionsCreated',
         http_method='POST', name='getSessionsCreated')
+    @instrumented
     def getSessionsCreated(self, request):
         """Return sessions created by user."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user, user_id = self._getUser()
         # create a datastore query for sessions created by user id.
         q = Session.query()
         # Filter this initial query through using .filter() method.
         q = q.filter(Session.creatorUserId == user_id)
         # Return the queried sessions as a SessionForm object.
         return SessionForms(
-            items=[self._copySessionToForm(sesh, "") \
-            for sesh in q]
+            items=self._copySessionsToForms(
+                self._runQuery(q, KEYS_ONLY_QUERIES['getSessionsCreated']))
         )
 
 
@@ -746,95 +1211,355 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESH_POST_REQUEST, SessionForm,
             path='session/{websafeSessionKey}/update',
             http_method='PUT', name='updateSession')
+    @instrumented
     def updateSession(self, request):
         """Update session w/provided fields & return w/updated info."""
-        return self._updateSessionObject(request)
+        return self._updateSessionObject(request).get_result()
 
 
     # Return session requested by websafeSessionKey
     @endpoints.method(SESH_GET_REQUEST, SessionForm,
             path='session/{websafeSessionKey}',
             http_method='GET', name='getSession')
+    @instrumented
     def getSession(self, request):
         """Return requested session (by websafeSessionKey)."""
+        return self._getSessionAsync(request.websafeSessionKey).get_result()
+
+    @ndb.tasklet
+    def _getSessionAsync(self, websafeSessionKey):
+        """Tasklet returning the SessionForm for websafeSessionKey, read
+        through the memcache form cache."""
+        form, generation = yield cache.getFormAsync('session', websafeSessionKey,
+                                                    SessionForm)
+        if form:
+            raise ndb.Return(form)
+
         # get Session object from request; bail if not found
-        sesh = ndb.Key(urlsafe=request.websafeSessionKey).get()
+        sesh = yield ndb.Key(urlsafe=websafeSessionKey).get_async()
         if not sesh:
             raise endpoints.NotFoundException(
-                'No session found with key: %s' % request.websafeSessionKey)
+                'No session found with key: %s' % websafeSessionKey)
         # fetch the creators display name using the session creator id.
-        prof = ndb.Key(Profile, sesh.creatorUserId).get()
-        creator_name = prof.displayName
-        # return SessionForm
-        return self._copySessionToForm(sesh, creator_name)
+        prof = yield ndb.Key(Profile, sesh.creatorUserId).get_async()
+        # cache & return SessionForm
+        form = self._copySessionToForm(sesh, getattr(prof, 'displayName', ""))
+        yield cache.fillFormAsync('session', websafeSessionKey, form, generation)
+        raise ndb.Return(form)
+
+    # Return the sessions requested by a list of websafeSessionKeys.
+    @endpoints.method(WebsafeKeysForm, SessionForms,
+            path='sessions/batch',
+            http_method='POST', name='getSessionsBatch')
+    @instrumented
+    def getSessionsBatch(self, request):
+        """Return requested sessions, listing any not found in missingKeys."""
+        sessions, missing = self._getEntitiesBatch(request.websafeKeys, Session)
+        return SessionForms(
+            items=self._copySessionsToForms(sessions),
+            missingKeys=missing
+        )
 
     # Return sessions for the selected conference by websafeConferenceKey
     @endpoints.method(CONF_GET_REQUEST, SessionForms,
             path='conference/{websafeConferenceKey}/sessions',
             http_method='GET', name='conferenceSessions')
+    @instrumented
     def getConferenceSessions(self, request):
         """ Return the requested conference's sessions. """
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        # query all sessions within the conference entity.
-        conf_sessions = Session.query(ancestor=conf.key)
-        # Return the queried sessions as a SessionForm object.
-        return SessionForms(
-            items=[self._copySessionToForm(sesh, "") \
-            for sesh in conf_sessions]
-        )
+        # serve the sessions from the conference's session index.
+        index = session_index.getIndex(request.websafeConferenceKey, self._getSchedule)
+        return SessionForms(items=self._copyEntriesToForms(index.find([])))
 
 
     @endpoints.method(SESSION_TYPE_REQUEST, SessionForms,
             path='conference/{websafeConferenceKey}/sessions/type',
             http_method='POST', name='conferenceSessionsByType')
+    @instrumented
     def getConferenceSessionsByType(self, request):
         """ Return the conferences sessions of chosen type. """
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        # query all sessions within the conference entity.
-        q = Session.query(ancestor=conf.key)
-        # refine the search by type of session chosen in the request.
-        session_by_type = q.filter(Session.typeOfSession == request.session_type)
-        # Return the queried sessions as a SessionForm object.
+        # the session index is bucketed by type, so this needs no query.
+        filters = []
+        if request.session_type is not None:
+            filters.append({'field': 'typeOfSession', 'operator': '=',
+                            'value': request.session_type})
+        index = session_index.getIndex(request.websafeConferenceKey, self._getSchedule)
         return SessionForms(
-            items=[self._copySessionToForm(sesh, "") \
-            for sesh in session_by_type]
+            items=self._copyEntriesToForms(index.find(filters))
         )
 
+    @endpoints.method(SESSION_SPEAKER_REQUEST, SessionForms,
+            path='conference/{websafeConferenceKey}/sessions/speaker',
+            http_method='POST', name='conferenceSpeakerSessions')
+    @instrumented
+    def getConferenceSessionsBySpeaker(self, request):
+        """ Return the conference's sessions featuring the chosen speaker. """
+        index = session_index.getIndex(request.websafeConferenceKey, self._getSchedule)
+        return SessionForms(items=self._copyEntriesToForms(index.find(
+            [{'field': 'speaker', 'operator': '=', 'value': request.speaker}])))
+
+    def _copyEntriesToForms(self, entries):
+        """Copy schedule entries to SessionForms, resolving every creator
+        display name with one batch Profile lookup."""
+        names = self._getDisplayNames(ndb.Key(Profile, entry['creatorUserId'])
+                                      for entry in entries if entry.get('creatorUserId'))
+        return [schedule.toForm(entry, names.get(ndb.Key(Profile, entry['creatorUserId']))
+                                if entry.get('creatorUserId') else None)
+                for entry in entries]
+
+    def _getSchedule(self, websafeConferenceKey):
+        """Return the groups of the conference's schedule, building it first
+        for conferences created before schedules existed."""
+        conf_key = ndb.Key(urlsafe=websafeConferenceKey)
+        groups = schedule.loadAsync(conf_key).get_result()
+        if groups is not None:
+            return groups
+        # get Conference object from request; bail if not found
+        if not conf_key.get():
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % websafeConferenceKey)
+        return self._buildScheduleTxn(conf_key).get_result()
+
+    @ndb.transactional_tasklet()
+    def _buildScheduleTxn(self, conf_key):
+        """Build and store the schedule of a conference from its sessions."""
+        groups = yield schedule.loadAsync(conf_key)
+        if groups is not None:
+            raise ndb.Return(groups)
+        # query inside the transaction, so sessions written since are
+        # included, and replace any groups left from an earlier schedule.
+        sessions, stale = yield (Session.query(ancestor=conf_key).fetch_async(),
+                                 ScheduleGroup.query(ancestor=conf_key).fetch_async(
+                                     keys_only=True))
+        groups = schedule.buildGroups(
+            conf_key, [self._copySessionToForm(sesh, None) for sesh in sessions])
+        obsolete = set(stale) - set(group.key for group in groups)
+        yield (ndb.put_multi_async([schedule.newSchedule(conf_key)] + groups),
+               ndb.delete_multi_async(list(obsolete)))
+        raise ndb.Return(groups)
+
 
     @endpoints.method(SessionSpeakerQuery, SessionForms,
             path='speakers/sessions',
             http_method='POST', name='conferenceSessionsBySpeaker')
+    @instrumented
     def getSessionsBySpeaker(self, request):
         """ Return all sessions featuring the chosen speaker. """
         # query all sessions with requested speaker.
         speaker_sessions = Session.query(Session.speaker == request.speaker)
         # Return the queried sessions as a SessionForm object.
         return SessionForms(
-            items=[self._copySessionToForm(sesh, "") \
-            for sesh in speaker_sessions]
+            items=self._copySessionsToForms(
+                self._runQuery(speaker_sessions, KEYS_ONLY_QUERIES['getSessionsBySpeaker']))
         )
 
 
 
+# - - - Facets - - - - - - - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(message_types.VoidMessage, FacetForms,
+            path='conferences/facets',
+            http_method='GET', name='getConferenceFacets')
+    @instrumented
+    def getConferenceFacets(self, request):
+        """Return the number of conferences per city, topic and month."""
+        return FacetForms(items=[
+            FacetForm(field=facet, counts=[FacetCountForm(value=value, count=count)
+                                           for value, count in counts])
+            for facet, counts in facets.getFacets()])
+
+
+# - - - Search - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _search(self, model, request):
+        """Return the keys of one page of the model's entities matching the
+        request's query, and the token for the next page."""
+        page_size = self._pageSize(request)
+        try:
+            offset = int(request.pageToken or 0)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+        if offset < 0:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+        keys, next_offset = search.search(model, request.query, offset, page_size)
+        return keys, str(next_offset) if next_offset is not None else None
+
+    @endpoints.method(SearchForm, ConferenceForms,
+            path='search/conferences',
+            http_method='POST', name='searchConferences')
+    @instrumented
+    def searchConferences(self, request):
+        """Search conference names, topics & descriptions, best match first;
+        words match as prefixes."""
+        keys, next_token = self._search(Conference, request)
+        return ConferenceForms(
+            items=self._copyConferencesToForms(ndb.get_multi(keys)),
+            nextPageToken=next_token
+        )
+
+    @endpoints.method(SearchForm, SessionForms,
+            path='search/sessions',
+            http_method='POST', name='searchSessions')
+    @instrumented
+    def searchSessions(self, request):
+        """Search session names, speakers & highlights, best match first;
+        words match as prefixes."""
+        keys, next_token = self._search(Session, request)
+        return SessionForms(
+            items=self._copySessionsToForms(ndb.get_multi(keys)),
+            nextPageToken=next_token
+        )
+
+
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
     
-    @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
-        """Register or unregister user for selected conference."""
+        """Register or unregister user for selected conference, returning a
+        Future. The user is resolved now, before any tasklet runs."""
+        self._getUser()
+        return self._conferenceRegistrationAsync(request.websafeConferenceKey, reg)
+
+
+    @ndb.tasklet
+    def _conferenceRegistrationAsync(self, wsck, reg):
+        """Tasklet registering or unregistering user for the conference."""
+        # get user Profile first, so it is created and any legacy attendance
+        # lists are migrated before the registration transaction runs; the
+        # conference is read alongside to find how its seats are counted.
+        prof, conf = yield (self._getProfileFromUserAsync(),
+                            ndb.Key(urlsafe=wsck).get_async())
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+
+        if conf.seatShards:
+            # seats live in shards; refresh the conference total shortly after.
+            if reg:
+                retval = yield self._shardedRegistrationAsync(prof.key, conf)
+            else:
+                retval = yield self._shardedUnregistrationTxn(prof.key, conf)
+            if retval:
+                yield self._syncSeatsLaterAsync(conf.key)
+        else:
+            retval = yield self._conferenceRegistrationTxn(prof.key, wsck, reg)
+            if retval:
+                # the seat count changed, so the cached form is stale and the
+                # conference may have crossed the nearly sold out threshold.
+                yield (cache.invalidateFormAsync('conference', wsck),
+                       announcements.seatsChangedAsync(
+                           conf.key, conf.seatsAvailable + (-1 if reg else 1)))
+        raise ndb.Return(BooleanMessage(data=retval))
+
+
+    @ndb.tasklet
+    def _shardedRegistrationAsync(self, p_key, conf):
+        """Register the Profile for a sharded conference, taking a seat from
+        one of the shards the read outside the transaction found seats on,
+        and moving on to the next if it ran out or is contended."""
+        shard_keys = yield seats.pickShardsAsync(conf.key, conf.seatShards)
+        contended = None
+        for shard_key in shard_keys:
+            try:
+                took_seat = yield self._shardedRegistrationTxn(p_key, conf, shard_key)
+            except datastore_errors.TransactionFailedError as e:
+                logging.info("Seat shard %s is contended" % shard_key.id())
+                contended = e
+                continue
+            if took_seat:
+                raise ndb.Return(True)
+        if contended:
+            raise contended
+        raise ConflictException(
+            "There are no seats available.")
+
+
+    @ndb.transactional_tasklet(xg=True, retries=0)
+    def _shardedRegistrationTxn(self, p_key, conf, shard_key):
+        """Register the Profile for a sharded conference, taking a seat from
+        the shard; returns False, registering nothing, if it has none left.
+        Doesn't retry, as the caller moves on to another shard."""
+        reg_key = ndb.Key(ConferenceRegistration, conf.key.urlsafe(), parent=p_key)
+        # check if user already registered otherwise add; the seat taken
+        # alongside is only written if the transaction commits.
+        registration, took_seat = yield (reg_key.get_async(),
+                                         seats.takeSeatAsync(shard_key))
+        if registration:
+            raise ConflictException(
+                "You have already registered for this conference")
+        if took_seat:
+            yield ConferenceRegistration(key=reg_key).put_async()
+        raise ndb.Return(took_seat)
+
+
+    @ndb.transactional_tasklet(xg=True)
+    def _shardedUnregistrationTxn(self, p_key, conf):
+        """Unregister the Profile from a sharded conference, adding back one
+        seat on a random shard if it was registered."""
+        reg_key = ndb.Key(ConferenceRegistration, conf.key.urlsafe(), parent=p_key)
+        registration = yield reg_key.get_async()
+        if not registration:
+            raise ndb.Return(False)
+        yield (reg_key.delete_async(),
+               seats.releaseSeatAsync(conf.key, conf.seatShards))
+        raise ndb.Return(True)
+
+
+    @ndb.tasklet
+    def _syncSeatsLaterAsync(self, conf_key):
+        """Schedule a sync of the conference's seatsAvailable total. Tasks are
+        named per SEAT_SYNC_INTERVAL window, so a burst of registrations
+        costs one sync."""
+        wsck = conf_key.urlsafe()
+        window = int(time.time() / SEAT_SYNC_INTERVAL) + 1
+        try:
+            yield self._addTaskAsync(name='sync-seats-%s-%d' % (wsck, window),
+                eta=datetime.utcfromtimestamp(window * SEAT_SYNC_INTERVAL),
+                params={'wsck': wsck},
+                url='/tasks/sync_seats')
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+
+    @staticmethod
+    def _syncSeats(websafeConferenceKey):
+        """Write the aggregated shard total to Conference.seatsAvailable."""
+        conf_key = ndb.Key(urlsafe=websafeConferenceKey)
+        conf = conf_key.get()
+        if not conf or not conf.seatShards:
+            return None
+        total = seats.getSeatsAvailableAsync(conf_key, conf.seatShards).get_result()
+        if ConferenceApi._setSeatsAvailable(conf_key, total):
+            # the seat count changed, so the cached form is stale and the
+            # conference may have crossed the nearly sold out threshold.
+            ndb.Future.wait_all([
+                cache.invalidateFormAsync('conference', websafeConferenceKey),
+                announcements.seatsChangedAsync(conf_key, total)])
+        return total
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _setSeatsAvailable(conf_key, total):
+        """Set Conference.seatsAvailable to total, returning whether it changed."""
+        conf = conf_key.get()
+        if conf.seatsAvailable == total:
+            return False
+        conf.seatsAvailable = total
+        conf.put()
+        return True
+
+
+    @ndb.transactional_tasklet(xg=True)
+    def _conferenceRegistrationTxn(self, p_key, wsck, reg):
+        """Register or unregister the Profile for the conference, returning
+        whether anything changed."""
         retval = None
-        prof = self._getProfileFromUser() # get user Profile
 
-        # check if conf exists given websafeConfKey
-        # get conference; check that it exists
-        wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        # check if conf exists given websafeConfKey and look up the user's
+        # registration; the gets are independent so issue them together.
+        reg_key = ndb.Key(ConferenceRegistration, wsck, parent=p_key)
+        conf, registration = yield (ndb.Key(urlsafe=wsck).get_async(),
+                                    reg_key.get_async())
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
@@ -842,7 +1567,7 @@ class ConferenceApi(remote.Service):
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if registration:
                 raise ConflictException(
                     "You have already registered for this conference")
 
@@ -852,38 +1577,47 @@ class ConferenceApi(remote.Service):
                     "There are no seats available.")
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
             conf.seatsAvailable -= 1
+            yield ConferenceRegistration(key=reg_key).put_async(), conf.put_async()
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if registration:
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
                 conf.seatsAvailable += 1
+                yield reg_key.delete_async(), conf.put_async()
                 retval = True
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+        raise ndb.Return(retval)
 
 
-    @ndb.transactional(xg=True)
+    @ndb.tasklet
     def _sessionWishlist(self, request, addToWishlist=True):
         """Add or remove session from user wishlist."""
+        # get user Profile first, so it is created and any legacy attendance
+        # lists are migrated before the wishlist transaction runs.
+        prof = yield self._getProfileFromUserAsync()
+        retval = yield self._sessionWishlistTxn(
+            prof, request.websafeSessionKey, addToWishlist)
+        raise ndb.Return(BooleanMessage(data=retval))
+
+
+    @ndb.transactional_tasklet(xg=True)
+    def _sessionWishlistTxn(self, prof, wssk, addToWishlist):
+        """Add or remove the session from the Profile's wishlist, returning
+        whether anything changed."""
         retval = None
-        prof = self._getProfileFromUser() # get user Profile
 
-        # check if conf exists given websafeSessionKey
-        # get session; check that it exists
-        wssk = request.websafeSessionKey
-        sess = ndb.Key(urlsafe=wssk).get()
+        # check if session exists given websafeSessionKey and look up the
+        # wishlist entry; the gets are independent so issue them together.
+        wish_key = ndb.Key(SessionWish, wssk, parent=prof.key)
+        sess, wish = yield (ndb.Key(urlsafe=wssk).get_async(),
+                            wish_key.get_async())
         if not sess:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % wssk)
@@ -891,172 +1625,178 @@ class ConferenceApi(remote.Service):
         # add to wishlist
         if addToWishlist:
             # check if user already has session in wishlist
-            if wssk in prof.sessionKeysToAttend:
+            if wish:
                 raise ConflictException(
                     "You have already added this session to your wishlist.")
 
             # add session to wishlist
-            prof.sessionKeysToAttend.append(wssk)
+            yield SessionWish(key=wish_key).put_async()
             logging.info("Successfully added {0} to {1}'s wishlist.".format(sess.name, prof.displayName))
             retval = True
 
         # remove from user wishlist.
         else:
             # check if user already has session in wishlist
-            if wssk in prof.sessionKeysToAttend:
-                # remove session key from users session keys.
-                prof.sessionKeysToAttend.remove(wssk)
+            if wish:
+                # remove the wishlist entry for the session.
+                yield wish_key.delete_async()
                 logging.info("Successfully removed {0} from {1}'s wishlist.".format(sess.name, prof.displayName))
                 retval = True
             else:
                 retval = False
 
-        prof.put()
-        sess.put()
-        return BooleanMessage(data=retval)
+        raise ndb.Return(retval)
 
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
+    @instrumented
     def registerForConference(self, request):
         """Register user for selected conference."""
-        return self._conferenceRegistration(request)
+        return self._conferenceRegistration(request).get_result()
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterForConference')
+    @instrumented
     def unregisterForConference(self, request):
         """unregister for the selected conference."""
-        return self._conferenceRegistration(request, reg=False)
+        return self._conferenceRegistration(request, reg=False).get_result()
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
+    @instrumented
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
-        # TODO:
         # step 1: get user profile
         prof = self._getProfileFromUser() # get user Profile
-        # step 2: get conferenceKeysToAttend from profile.
-        conferencesToAttendKeys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        # Make each key within conferencesToAttendKeys urlsafe.
-        # to make a ndb key from websafe key you can use:
-        # ndb.Key(urlsafe=my_websafe_key_string)
+        # step 2: get the registration child keys of the profile; each key id
+        # is the websafe key of a conference to attend.
+        reg_keys = ConferenceRegistration.query(ancestor=prof.key).fetch(keys_only=True)
+        conferencesToAttendKeys = [ndb.Key(urlsafe=key.id()) for key in reg_keys]
         # step 3: fetch conferences from datastore.
-        conferences = ndb.get_multi(conferencesToAttendKeys) 
+        conferences = ndb.get_multi(conferencesToAttendKeys)
         # Use get_multi(array_of_keys) to fetch all keys at once.
         # Do not fetch them one by one!
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, "")\
-         for conf in conferences]
-        )
+        return ConferenceForms(items=self._copyConferencesToForms(conferences))
 
 
     @endpoints.method(SESH_GET_REQUEST, BooleanMessage,
             path='session/{websafeSessionKey}/addToWishlist',
             http_method='POST', name='addSessionToWishlist')
+    @instrumented
     def addSessionToWishlist(self, request):
         """Add currently selected session to user wishlist."""
-        return self._sessionWishlist(request)
+        return self._sessionWishlist(request).get_result()
 
 
     @endpoints.method(SESH_GET_REQUEST, BooleanMessage,
             path='session/{websafeSessionKey}/removeFromWishlist',
             http_method='DELETE', name='removeSessionFromWishlist')
+    @instrumented
     def removeSessionFromWishlist(self, request):
         """Remove currently selected session from user wishlist."""
-        return self._sessionWishlist(request, addToWishlist=False)
+        return self._sessionWishlist(request, addToWishlist=False).get_result()
 
 
     @endpoints.method(message_types.VoidMessage, SessionForms,
         path='getSessionWishlist',
         http_method='POST', name='getSessionWishlist')
+    @instrumented
     def getSessionsInWishlist(self, request):
         """Return sessions within users wishlist."""
         # fetch user profile.
         prof = self._getProfileFromUser()
-        # obtain each session key within the users sessionKeysToAttend property.
-        sessionToAttendKeys = [ndb.Key(urlsafe=wssk) for wssk in prof.sessionKeysToAttend]
+        # obtain each session key from the ids of the users wishlist entries.
+        wish_keys = SessionWish.query(ancestor=prof.key).fetch(keys_only=True)
+        sessionToAttendKeys = [ndb.Key(urlsafe=key.id()) for key in wish_keys]
         # fetch sessions from datastore using get_multi(array_of_keys).
         wishlist_sessions = ndb.get_multi(sessionToAttendKeys)
         # Return the set of sessions as a SessionForm object.
         return SessionForms(
-            items=[self._copySessionToForm(sesh, "") \
-            for sesh in wishlist_sessions]
+            items=self._copySessionsToForms(wishlist_sessions)
         )
 
 
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
-    # Query for conferences that we want to assign to memcache and create announcement.
+    # Publish the maintained nearly sold out announcement to memcache.
     # We dont want to expose this as a endpoint, so we give it a private method.
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Rebuild the nearly sold out announcement from the conferences'
+        seats and assign it to memcache; used by memcache cron job. Between
+        runs it is kept up to date as seats change, see
+        announcements.seatsChangedAsync.
         """
-        # query for conferences that are almost full to announce.
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            logging.info("Found %s conferences" % len(confs))
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            logging.info("The announcement key has been deleted. %s" % MEMCACHE_ANNOUNCEMENTS_KEY)
-            print ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
+        announcement = announcements.publish()
+        logging.info("The announcement key contains: {0}".format(announcement))
         return announcement
 
 
+    @staticmethod
+    def _cacheFeaturedSpeakers(websafeConferenceKey):
+        """Drain the conference's queued featured speaker refreshes in leased
+        batches, updating each distinct speaker of a batch once; used by the
+        get_featured_speaker task queue. Returns the number of updates."""
+        queue = taskqueue.Queue(FEATURED_SPEAKER_QUEUE)
+        updates = 0
+        while True:
+            tasks = queue.lease_tasks_by_tag(FEATURED_SPEAKER_LEASE,
+                                             FEATURED_SPEAKER_BATCH,
+                                             tag=websafeConferenceKey)
+            if not tasks:
+                break
+            speaker_names = set(task.payload.decode('utf-8') for task in tasks)
+            logging.info("Refreshing {0} speakers from {1} queued updates".format(
+                len(speaker_names), len(tasks)))
+            try:
+                for speaker in speaker_names:
+                    ConferenceApi._cacheFeaturedSpeaker(speaker, websafeConferenceKey)
+            except Exception:
+                # release the leases, so the push task's retry can lease them again.
+                for task in tasks:
+                    queue.modify_task_lease(task, 0)
+                raise
+            queue.delete_tasks(tasks)
+            updates += len(speaker_names)
+        return updates
+
+
     @staticmethod
     def _cacheFeaturedSpeaker(featured_speaker, websafeConferenceKey):
-        """Query speaker for current conference and create a memcache
-        entry containing all the featured speakers sessions for that conference."""
-        # check if conf exists given websafeConfKey and fetch.
-        conf = ndb.Key(urlsafe=websafeConferenceKey).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % wsck)
-        # query for other sessions within the conference by the featured speaker.
-        conf_sessions = Session.query(ancestor=conf.key)
-        # query for sessions with the selected featured speaker.
-        speaker_conf_sessions = conf_sessions.filter(Session.speaker == featured_speaker).fetch(
-            projection=[Session.name])
-
-        if speaker_conf_sessions:
-            if len(speaker_conf_sessions) > 1:
-                # if the speaker is featured in more than 1 session within the conference,
-                # format the announcement of those sessions and set it in memcache.
-                logging.info("{0} was found to be featured in {1} sessions".format(
-                    featured_speaker, len(speaker_conf_sessions)))
-                featured_speak_msg = FEATURED_SESS_SPKR % (featured_speaker, ', '.join(
-                            sess.name for sess in speaker_conf_sessions))
-                logging.info(featured_speak_msg)
-                memcache.set(MEMCACHE_FEAT_SPK_KEY, featured_speak_msg)
-            else:
-                # There are no other sessions for this conference that the speaker is attending
-                # set featured speaker msg to its previous value.
-                featured_speak_msg = (memcache.get(MEMCACHE_FEAT_SPK_KEY) or "")
-                logging.info("There are no other sessions featured by the speaker.")
-        
-        # if no speaker sessions were found within the conference raise exception.
-        if not speaker_conf_sessions:
-            raise endpoints.NotFoundException(
-                'No sessions found for the speaker {0}'.format(featured_speaker))
+        """Update the conference's featured speaker message from the speaker's
+        session index."""
+        conf_key = ndb.Key(urlsafe=websafeConferenceKey)
+        # a single key get of the speaker's sessions within the conference.
+        index = speakers.speakerKey(conf_key, featured_speaker).get()
+        session_names = index.sessionNames if index else []
+
+        if len(session_names) > 1:
+            # if the speaker is featured in more than 1 session within the conference,
+            # format the announcement of those sessions and store it for the conference.
+            logging.info("{0} was found to be featured in {1} sessions".format(
+                featured_speaker, len(session_names)))
+            featured_speak_msg = FEATURED_SESS_SPKR % (
+                featured_speaker, ', '.join(session_names))
+            logging.info(featured_speak_msg)
+            speakers.setFeatured(conf_key, featured_speaker, featured_speak_msg)
+        elif speakers.getFeaturedSpeaker(conf_key) == featured_speaker:
+            # the featured speaker no longer has other sessions; drop the message.
+            logging.info("{0} is no longer featured in several sessions".format(
+                featured_speaker))
+            speakers.clearFeatured(conf_key)
+            featured_speak_msg = ""
+        else:
+            # There are no other sessions for this conference that the speaker is attending
+            # keep the conference's previous featured speaker msg.
+            featured_speak_msg = speakers.getFeatured(conf_key)
+            logging.info("There are no other sessions featured by the speaker.")
 
         return featured_speak_msg
 
@@ -1065,22 +1805,39 @@ class ConferenceApi(remote.Service):
     @endpoints.method(message_types.VoidMessage, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
+    @instrumented
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
         # Return announcement using StringMessage.
-        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        announcement = announcements.getAnnouncement()
         logging.info("The announcement key contains: {0}".format(announcement))
         return StringMessage(data=announcement or "")
 
 
+    # Endpoint for returning the read-through form cache counters.
+    @endpoints.method(message_types.VoidMessage, CacheStatsForms,
+            path='cache/stats', http_method='GET', name='getCacheStats')
+    @instrumented
+    def getCacheStats(self, request):
+        """Return hit/miss counters of the conference & session form caches."""
+        return CacheStatsForms(items=[
+            CacheStatsForm(cache=name, hits=hits, misses=misses)
+            for name, hits, misses in cache.getStats()])
+
+
     # Endpoint for returning memcache message for featured speaker sessions.
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @endpoints.method(CONF_GET_REQUEST, StringMessage,
             path='conference/session/featuredspeaker/get',
             http_method='GET', name='getFeaturedSpeaker')
+    @instrumented
     def getFeaturedSpeaker(self, request):
-        """Return featured speaker message from memcache."""
+        """Return the featured speaker message of a conference, or the latest
+        of any conference if no websafeConferenceKey is given."""
+        conf_key = None
+        if request.websafeConferenceKey:
+            conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
         # Return featured speaker message using StringMessage.
-        spkr_msg = memcache.get(MEMCACHE_FEAT_SPK_KEY)
+        spkr_msg = speakers.getFeatured(conf_key)
         logging.info("The featured speaker key contains: {0}".format(spkr_msg))
         return StringMessage(data=spkr_msg or "")
 
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+"""facets.py
+
+Conference counts per city, topic and month for the browse page.
+
+Counts are kept per facet value, as "CITY:London", "TOPIC:Web" or
+"MONTH:6". Every conference write applies the difference between its facet
+values before and after to one of NUM_SHARDS FacetShard root entities,
+chosen at random, in its own transaction, so concurrent writes rarely
+contend; a change that still fails on contention is retried by a push
+task. The shards start empty, so they only hold changes; a conference
+that predates them is counted by the baseline, which rebuild() recounts
+once from the conferences themselves. A shard value may therefore be
+negative, when an older conference moves out of it.
+
+A write then queues a push task named per SUMMARY_INTERVAL window, which
+adds the shards to the baseline into the FacetSummary entity and memcache;
+a burst of writes costs one summary. Reads are a memcache get, falling back
+to one key get, whatever the number of conferences. Until the baseline is
+built, reads return no counts and queue the rebuild task.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import json
+import logging
+import random
+import time
+from datetime import datetime
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Conference, FacetShard, FacetSummary
+
+# Facets and the Conference property counted for each.
+FACETS = (('CITY', 'city'), ('TOPIC', 'topics'), ('MONTH', 'month'))
+
+NUM_SHARDS = 20
+SUMMARY_ID = 1
+SUMMARY_INTERVAL = 10
+MEMCACHE_FACETS_KEY = 'conference-facets'
+
+REBUILD_BATCH_SIZE = 500
+# Seconds before a push task retries a change that failed on contention.
+COUNT_RETRY_DELAY = 5
+# Recounts tried per rebuild task before leaving it to the task's retry.
+REBUILD_ATTEMPTS = 3
+# At most one rebuild task is queued per REBUILD_INTERVAL seconds.
+REBUILD_INTERVAL = 3600
+
+
+class RebuildConflict(Exception):
+    """Facet counts changed during every recount of a rebuild."""
+
+
+def shardKeys():
+    """Return the FacetShard keys."""
+    return [ndb.Key(FacetShard, i + 1) for i in range(NUM_SHARDS)]
+
+
+def summaryKey():
+    """Return the key of the FacetSummary entity."""
+    return ndb.Key(FacetSummary, SUMMARY_ID)
+
+
+def facetValues(conf):
+    """Return the facet values a conference counts towards."""
+    if conf is None:
+        return []
+    values = []
+    for facet, name in FACETS:
+        value = getattr(conf, name)
+        for item in (value if isinstance(value, list) else [value]):
+            # conferences without a start date have month 0.
+            if item not in (None, '', 0):
+                values.append(u'%s:%s' % (facet, item))
+    return values
+
+
+def deltas(before, after):
+    """Return {facet value: change} between two lists of facet values."""
+    changes = {}
+    for value in before:
+        changes[value] = changes.get(value, 0) - 1
+    for value in after:
+        changes[value] = changes.get(value, 0) + 1
+    return dict((value, change) for value, change in changes.items() if change)
+
+
+def combine(*counts):
+    """Return the sum of {facet value: count} dicts, without zero counts."""
+    total = {}
+    for part in counts:
+        for value, count in (part or {}).items():
+            total[value] = total.get(value, 0) + count
+    return dict((value, count) for value, count in total.items() if count)
+
+
+@ndb.tasklet
+def changedAsync(before, after):
+    """Count conference writes that changed facet values from before to
+    after, and queue a summary."""
+    changes = deltas(before, after)
+    if not changes:
+        return
+    try:
+        yield _incrementTxn(random.choice(shardKeys()), changes)
+    except datastore_errors.TransactionFailedError:
+        logging.warning('Could not count facet changes %r', changes)
+        yield countLaterAsync(changes)
+        return
+    yield summarizeLaterAsync()
+
+
+@ndb.tasklet
+def countLaterAsync(changes):
+    """Queue a push task counting the {facet value: change} dict."""
+    try:
+        yield taskqueue.Queue().add_async(taskqueue.Task(
+            url='/tasks/count_facets', countdown=COUNT_RETRY_DELAY,
+            params={'changes': json.dumps(changes)}))
+    except taskqueue.Error:
+        # rebuild() still recounts from the conferences.
+        logging.exception('Could not queue facet changes %r', changes)
+
+
+def count(changes):
+    """Count the JSON {facet value: change} dict into a shard and queue a
+    summary; used by the count_facets task. Errors propagate, so the task
+    retries."""
+    _incrementTxn(random.choice(shardKeys()), json.loads(changes)).get_result()
+    summarizeLaterAsync().get_result()
+
+
+@ndb.transactional_tasklet()
+def _incrementTxn(shard_key, changes):
+    shard = yield shard_key.get_async()
+    if shard is None:
+        shard = FacetShard(key=shard_key)
+    shard.counts = combine(shard.counts, changes)
+    yield shard.put_async()
+
+
+@ndb.tasklet
+def summarizeLaterAsync():
+    """Queue a summary of the shards, one per SUMMARY_INTERVAL window."""
+    window = int(time.time() / SUMMARY_INTERVAL) + 1
+    try:
+        yield taskqueue.Queue().add_async(taskqueue.Task(
+            name='facet-summary-%d' % window,
+            eta=datetime.utcfromtimestamp(window * SUMMARY_INTERVAL),
+            url='/tasks/summarize_facets'))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def rebuildLater():
+    """Queue the rebuild task, one per REBUILD_INTERVAL window."""
+    try:
+        taskqueue.add(name='facet-rebuild-%d' % int(time.time() / REBUILD_INTERVAL),
+                      url='/tasks/rebuild_facets')
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def shardCounts():
+    """Return the sum of the shards."""
+    return combine(*[shard.counts for shard in ndb.get_multi(shardKeys()) if shard])
+
+
+def publishCounts(counts):
+    """Return the counts to serve: those above zero. A negative count means
+    a change was lost, and the next rebuild corrects it."""
+    negative = sorted(value for value, count in counts.items() if count < 0)
+    if negative:
+        logging.warning('Negative facet counts for %s', ', '.join(negative))
+    return dict((value, count) for value, count in counts.items() if count > 0)
+
+
+def summarize():
+    """Add the shards to the baseline into the summary entity and memcache;
+    returns the counts, or None before the baseline is built."""
+    summary = _summarizeTxn(shardCounts())
+    if summary.baseline is None:
+        return None
+    memcache.set(MEMCACHE_FACETS_KEY, summary.counts)
+    return summary.counts
+
+
+@ndb.transactional()
+def _summarizeTxn(shard_counts):
+    summary = summaryKey().get() or FacetSummary(key=summaryKey())
+    if summary.baseline is not None:
+        summary.counts = publishCounts(combine(summary.baseline, shard_counts))
+        summary.put()
+    return summary
+
+
+def getCounts():
+    """Return {facet value: count} from memcache, or else the summary; until
+    the baseline is built, returns {} and queues the rebuild task."""
+    counts = memcache.get(MEMCACHE_FACETS_KEY)
+    if counts is not None:
+        return counts
+    summary = summaryKey().get()
+    if summary is None or summary.baseline is None:
+        rebuildLater()
+        return {}
+    memcache.add(MEMCACHE_FACETS_KEY, summary.counts or {})
+    return summary.counts or {}
+
+
+def getFacets():
+    """Return [(facet, [(value, count), ...]), ...] in FACETS order, with
+    values by descending count."""
+    grouped = dict((facet, []) for facet, name in FACETS)
+    for key, count in getCounts().items():
+        facet, _, value = key.partition(':')
+        if facet in grouped:
+            grouped[facet].append((value, count))
+    return [(facet, sorted(grouped[facet], key=lambda item: (-item[1], item[0])))
+            for facet, name in FACETS]
+
+
+def countConferences():
+    """Return {facet value: count} of every conference, by paged query."""
+    counts = {}
+    cursor, more = None, True
+    while more:
+        confs, cursor, more = Conference.query().fetch_page(
+            REBUILD_BATCH_SIZE, start_cursor=cursor)
+        for conf in confs:
+            for value in facetValues(conf):
+                counts[value] = counts.get(value, 0) + 1
+    return counts
+
+
+def rebuild():
+    """Recount every conference, and store the baseline: the recount less
+    the shards. The shards are left alone, and read before and after the
+    recount; if a write changed them meanwhile, the recount is tried again.
+    Raises RebuildConflict if every attempt overlapped a write, so the task
+    is retried later. The recount is a global query, so a conference written
+    within a few seconds of it may be missed; run it at a quiet time. Only
+    needed once, for conferences that predate the shards, or to correct
+    lost changes."""
+    for attempt in range(REBUILD_ATTEMPTS):
+        before = shardCounts()
+        counts = countConferences()
+        after = shardCounts()
+        if before == after:
+            break
+        logging.info("Facet counts changed during recount %d" % (attempt + 1))
+    else:
+        raise RebuildConflict('Facet counts changed during every recount')
+    baseline = combine(counts, dict((value, -count) for value, count in after.items()))
+    _setBaselineTxn(baseline, publishCounts(counts))
+    memcache.delete(MEMCACHE_FACETS_KEY)
+    logging.info("Counted facets of conferences into %d values" % len(counts))
+    # summarize any write that committed since the recount.
+    return summarize()
+
+
+@ndb.transactional()
+def _setBaselineTxn(baseline, counts):
+    summary = summaryKey().get() or FacetSummary(key=summaryKey())
+    summary.baseline = baseline
+    summary.counts = counts
+    summary.put()
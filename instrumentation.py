@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""instrumentation.py
+
+Sampled per-call profiling of the endpoint methods and task handlers.
+
+A sampled call records its wall time, datastore RPC count, memcache get
+hits and misses, and serialized response size. Each value is counted in a
+log2 bucket of a per-method histogram held in memcache counters, so every
+instance adds to the same histograms at the cost of one offset_multi per
+sampled call. getStats() turns them into percentiles.
+
+RPCs are counted by apiproxy post-call hooks, for the calls made on the
+thread of the sampled request.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import contextlib
+import functools
+import logging
+import math
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from protorpc import messages
+from protorpc import protojson
+
+from settings import INSTRUMENTATION_SAMPLE_RATE
+
+METRICS = ('wall_ms', 'datastore_rpcs', 'memcache_hits', 'memcache_misses',
+           'response_bytes')
+PERCENTILES = (50, 90, 99)
+# bucket 0 counts values below 1, bucket b values in [2**(b-1), 2**b).
+BUCKETS = 25
+
+STATS_KEY = 'instrumentation:%s:%s'
+BUCKET_KEY = 'instrumentation:%s:%s:%d'
+STATS_NAMESPACE = 'instrumentation'
+
+# Names of every instrumented method, in definition order.
+_NAMES = []
+_local = threading.local()
+
+
+# - - - RPC hooks - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _datastoreHook(service, call, request, response):
+    counters = getattr(_local, 'counters', None)
+    if counters is not None:
+        counters['datastore_rpcs'] += 1
+
+
+def _memcacheHook(service, call, request, response):
+    counters = getattr(_local, 'counters', None)
+    if counters is not None and call == 'Get':
+        hits = response.item_size()
+        counters['memcache_hits'] += hits
+        counters['memcache_misses'] += request.key_size() - hits
+
+
+def installHooks():
+    """Add the RPC counting hooks to the current API proxy; adding them
+    again is a no-op."""
+    hooks = apiproxy_stub_map.apiproxy.GetPostCallHooks()
+    hooks.Append('instrumentation-datastore', _datastoreHook, 'datastore_v3')
+    hooks.Append('instrumentation-memcache', _memcacheHook, 'memcache')
+
+
+@contextlib.contextmanager
+def counting():
+    """Count the RPCs made on this thread within the block into a dict of
+    METRICS counters; instrumented calls inside it are not sampled."""
+    installHooks()
+    previous = getattr(_local, 'counters', None)
+    _local.counters = counters = dict((metric, 0) for metric in METRICS)
+    try:
+        yield counters
+    finally:
+        _local.counters = previous
+
+
+# - - - Decorators - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def instrumented(func):
+    """Profile a sample of the calls to an endpoint method."""
+    return _wrap(func, func.__name__)
+
+
+def instrumentedHandler(cls):
+    """Class decorator profiling a sample of a webapp2 handler's requests."""
+    for verb in ('get', 'post', 'put', 'delete'):
+        if verb in cls.__dict__:
+            setattr(cls, verb, _wrap(cls.__dict__[verb],
+                                     '%s.%s' % (cls.__name__, verb)))
+    return cls
+
+
+def _wrap(func, name):
+    _NAMES.append(name)
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        # nested calls are part of the outer call's profile.
+        if (getattr(_local, 'counters', None) is not None or
+                random.random() >= INSTRUMENTATION_SAMPLE_RATE):
+            return func(self, *args, **kwargs)
+        start = time.time()
+        failed = True
+        try:
+            with counting() as counters:
+                result = func(self, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            counters['wall_ms'] = (time.time() - start) * 1e3
+            if not failed:
+                counters['response_bytes'] = _responseSize(self, result)
+            try:
+                record(name, counters, failed)
+            except Exception:
+                # never fail a request over its statistics.
+                logging.exception('Could not record stats of %s', name)
+    return wrapper
+
+
+def _responseSize(instance, result):
+    """Return the serialized size of an endpoint or handler response."""
+    if isinstance(result, messages.Message):
+        return len(protojson.encode_message(result))
+    response = getattr(instance, 'response', None)
+    if response is not None:
+        return len(response.body)
+    return 0
+
+
+# - - - Histograms - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def bucket(value):
+    """Return the log2 histogram bucket of a value."""
+    if value < 1:
+        return 0
+    return min(BUCKETS - 1, int(math.log(value, 2)) + 1)
+
+
+def record(name, counters, failed=False):
+    """Add one call's counters to the method's histograms."""
+    deltas = {STATS_KEY % (name, 'calls'): 1}
+    if failed:
+        deltas[STATS_KEY % (name, 'errors')] = 1
+    for metric in METRICS:
+        deltas[BUCKET_KEY % (name, metric, bucket(counters[metric]))] = 1
+    memcache.offset_multi(deltas, initial_value=0, namespace=STATS_NAMESPACE)
+
+
+def _percentile(histogram, total, percent):
+    """Return the upper bound of the bucket holding the percentile."""
+    seen = 0
+    for b, count in enumerate(histogram):
+        seen += count
+        if seen * 100 >= total * percent:
+            return 0 if b == 0 else 2 ** b
+    return 2 ** (BUCKETS - 1)
+
+
+def getStats():
+    """Return {method name: {'calls', 'errors', metric: {'p50', ...}}} for
+    every instrumented method with sampled calls. Percentiles are bucket
+    upper bounds, so within a factor of 2."""
+    keys = []
+    for name in _NAMES:
+        keys += [STATS_KEY % (name, 'calls'), STATS_KEY % (name, 'errors')]
+        keys += [BUCKET_KEY % (name, metric, b)
+                 for metric in METRICS for b in range(BUCKETS)]
+    counts = memcache.get_multi(keys, namespace=STATS_NAMESPACE)
+    stats = {}
+    for name in _NAMES:
+        calls = int(counts.get(STATS_KEY % (name, 'calls'), 0))
+        if not calls:
+            continue
+        method = {'calls': calls,
+                  'errors': int(counts.get(STATS_KEY % (name, 'errors'), 0))}
+        for metric in METRICS:
+            histogram = [int(counts.get(BUCKET_KEY % (name, metric, b), 0))
+                         for b in range(BUCKETS)]
+            total = sum(histogram)
+            method[metric] = dict(('p%d' % percent,
+                                   _percentile(histogram, total, percent))
+                                  for percent in PERCENTILES)
+            method[metric]['histogram'] = histogram
+        stats[name] = method
+    return stats
+
+
+def resetStats():
+    """Clear every histogram."""
+    memcache.delete_multi([STATS_KEY % (name, 'calls') for name in _NAMES] +
+                          [STATS_KEY % (name, 'errors') for name in _NAMES] +
+                          [BUCKET_KEY % (name, metric, b) for name in _NAMES
+                           for metric in METRICS for b in range(BUCKETS)],
+                          namespace=STATS_NAMESPACE)
@@ -1,10 +1,22 @@
 #!/usr/bin/env python
+import json
+import logging
+
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
 from conference import ConferenceApi
+from instrumentation import instrumentedHandler
+import announcements
+import facets
+import instrumentation
+import transfer
+
+# Export batches written per /admin/export request.
+EXPORT_BATCHES_PER_REQUEST = 10
 
 # handler for using the cache announcements method in conference.py
+@instrumentedHandler
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
         """Set Announcement in Memcache."""
@@ -12,17 +24,30 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
         self.response.set_status(204)
         # use _cacheAnnouncement() to set announcement in Memcache
 
+# handler retrying a nearly sold out update that failed on contention.
+@instrumentedHandler
+class UpdateAnnouncementHandler(webapp2.RequestHandler):
+    def post(self):
+        """Update the conference's nearly sold out entry."""
+        announcements.update(self.request.get('wsck'))
+        self.response.set_status(204)
+
 # handlers for setting featured speaker for a conference session(s)
+@instrumentedHandler
 class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
     def post(self):
-        """Set featured speaker sessions message in memcache."""
-        # use _cacheFeaturedSpeaker to set announcement in Memcache, passing
-        # the request objects 'speaker' and 'wsck' (websafeConferenceKey) as args.
-        ConferenceApi._cacheFeaturedSpeaker(
-            self.request.get('speaker'), self.request.get('wsck'))
+        """Set featured speaker sessions messages in memcache."""
+        # tasks queued before coalescing carry a single 'speaker'.
+        if self.request.get('speaker'):
+            ConferenceApi._cacheFeaturedSpeaker(
+                self.request.get('speaker'), self.request.get('wsck'))
+        # use _cacheFeaturedSpeakers to refresh every speaker queued for the
+        # request's 'wsck' (websafeConferenceKey) in bulk.
+        ConferenceApi._cacheFeaturedSpeakers(self.request.get('wsck'))
         self.response.set_status(204)
 
 # handler and function for sending a confirmation email to creator of conference.
+@instrumentedHandler
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
         """Send email confirming Conference creation."""
@@ -37,12 +62,149 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
                 'conferenceInfo')
         )
 
+# handler for syncing a sharded conference's seatsAvailable total.
+@instrumentedHandler
+class SyncSeatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Aggregate the conference's seat shards into seatsAvailable."""
+        ConferenceApi._syncSeats(self.request.get('wsck'))
+        self.response.set_status(204)
+
+# handler for moving legacy Profile attendance lists into child entities.
+@instrumentedHandler
+class MigrateAttendanceHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start the attendance migration from the first Profile."""
+        ConferenceApi._migrateAttendance()
+        self.response.set_status(204)
+
+    def post(self):
+        """Migrate the next batch of Profiles from the task's cursor."""
+        ConferenceApi._migrateAttendance(self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+# handler for storing typed start & end times on existing Sessions.
+@instrumentedHandler
+class MigrateSessionTimesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start the session times migration from the first Session."""
+        ConferenceApi._migrateSessionTimes()
+        self.response.set_status(204)
+
+    def post(self):
+        """Migrate the next batch of Sessions from the task's cursor."""
+        ConferenceApi._migrateSessionTimes(self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+# handler for writing search documents of existing conferences & sessions.
+@instrumentedHandler
+class ReindexSearchHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start reindexing from the first Conference."""
+        ConferenceApi._reindexSearch()
+        self.response.set_status(204)
+
+    def post(self):
+        """Reindex the next batch from the task's kind and cursor."""
+        ConferenceApi._reindexSearch(int(self.request.get('kind') or 0),
+                                     self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+# handler retrying facet count changes that failed on contention.
+@instrumentedHandler
+class CountFacetsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Count the task's facet changes into a shard."""
+        facets.count(self.request.get('changes'))
+        self.response.set_status(204)
+
+# handler for summarizing the sharded conference facet counts.
+@instrumentedHandler
+class SummarizeFacetsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Add the facet count shards to the baseline into the summary."""
+        facets.summarize()
+        self.response.set_status(204)
+
+# handler for recounting the facet baseline from every conference; queued
+# by the first facet read, or visited by an admin to correct the counts.
+@instrumentedHandler
+class RebuildFacetsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Recount the facets of every conference."""
+        facets.rebuild()
+        self.response.set_status(204)
+
+    def post(self):
+        """Recount the facets of every conference, from the task queue."""
+        facets.rebuild()
+        self.response.set_status(204)
+
+# handlers for moving conferences between environments as JSON Lines.
+@instrumentedHandler
+class ExportHandler(webapp2.RequestHandler):
+    def get(self):
+        """Write the next batches of entities after the 'checkpoint' param as
+        JSON Lines; the X-Export-Checkpoint header continues the export, and
+        is empty once it is complete."""
+        checkpoint = self.request.get('checkpoint') or None
+        self.response.headers['Content-Type'] = 'application/x-ndjson'
+        for _ in range(EXPORT_BATCHES_PER_REQUEST):
+            lines, checkpoint = transfer.exportBatch(checkpoint)
+            for line in lines:
+                self.response.write(line + '\n')
+            if checkpoint is None:
+                break
+        self.response.headers['X-Export-Checkpoint'] = checkpoint or ''
+
+@instrumentedHandler
+class ImportHandler(webapp2.RequestHandler):
+    def post(self):
+        """Import the JSON Lines request body, skipping the lines before the
+        'checkpoint' param; responds with the checkpoint reached."""
+        checkpoint = done = int(self.request.get('checkpoint') or 0)
+        self.response.headers['Content-Type'] = 'application/json'
+        try:
+            for done in transfer.importLines(self.request.body_file, checkpoint):
+                pass
+        except Exception:
+            # report how far the import got, so it can be resumed from there.
+            logging.exception('Import failed after %d lines', done)
+            self.response.set_status(500)
+        self.response.write(json.dumps({'checkpoint': done}))
+
+# handler returning the sampled endpoint & handler profiles as JSON.
+class StatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return call counts and percentile histograms per method."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'sampleRate': instrumentation.INSTRUMENTATION_SAMPLE_RATE,
+            'methods': instrumentation.getStats()}, sort_keys=True))
+
+    def delete(self):
+        """Clear the recorded profiles."""
+        instrumentation.resetStats()
+        self.response.set_status(204)
+
+
 
 # create a url handler for the announcement handler.
 # create a url handler for the email confirmation
 # Note: These also need to be updated in app.yaml.
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/tasks/update_announcement', UpdateAnnouncementHandler),
     ('/tasks/get_featured_speaker', SetFeaturedSpeakerHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
+    ('/tasks/migrate_attendance', MigrateAttendanceHandler),
+    ('/tasks/migrate_session_times', MigrateSessionTimesHandler),
+    ('/tasks/reindex_search', ReindexSearchHandler),
+    ('/tasks/count_facets', CountFacetsHandler),
+    ('/tasks/summarize_facets', SummarizeFacetsHandler),
+    ('/tasks/rebuild_facets', RebuildFacetsHandler),
+    ('/tasks/sync_seats', SyncSeatsHandler),
+    ('/admin/export', ExportHandler),
+    ('/admin/import', ImportHandler),
+    ('/admin/stats', StatsHandler),
 ], debug=True)
@@ -13,6 +13,8 @@ created/forked from conferences.py by wesc on 2014 may 24
 __author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
 
 import httplib
+from datetime import datetime, timedelta
+
 import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
@@ -25,10 +27,25 @@ class Profile(ndb.Model):
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # legacy attendance lists, moved into ConferenceRegistration / SessionWish
+    # child entities by ConferenceApi._migrateAttendanceAsync.
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     sessionKeysToAttend = ndb.StringProperty(repeated=True)
 
 
+# Attendance is stored as Profile child entities keyed by the websafe key of
+# the conference or session, so membership is a single key get and toggling
+# writes one small entity, however many the user has.
+class ConferenceRegistration(ndb.Model):
+    """ConferenceRegistration -- Profile child marking a registered conference"""
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class SessionWish(ndb.Model):
+    """SessionWish -- Profile child marking a wishlisted session"""
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
     displayName = messages.StringField(1)
@@ -76,6 +93,36 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    # number of SeatShard counters holding the seats; 0 means seatsAvailable
+    # itself is the counter. When sharded, seatsAvailable is a synced total.
+    seatShards      = ndb.IntegerProperty(default=0)
+
+# Each shard is a root entity, so registrations taking seats from different
+# shards never contend on the same entity group.
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a conference's available seats"""
+    seatsAvailable  = ndb.IntegerProperty(default=0, indexed=False)
+
+# The nearly sold out conferences, kept up to date as their seats change,
+# sharded by conference key over root entities; see announcements.py.
+class NearlySoldOut(ndb.Model):
+    """NearlySoldOut -- one slice of the conferences with few seats left"""
+    conferences  = ndb.JsonProperty()
+
+# Conference counts per facet value ("CITY:London"), sharded over root
+# entities so concurrent conference writes rarely contend; see facets.py.
+class FacetShard(ndb.Model):
+    """FacetShard -- one slice of the conference counts per facet value"""
+    counts = ndb.JsonProperty()
+
+# The facet counts: a baseline recounted once from the conferences, plus the
+# sum of the facet shards, refreshed by a coalesced task. baseline is None
+# until facets.rebuild() has run.
+class FacetSummary(ndb.Model):
+    """FacetSummary -- conference counts per facet value"""
+    counts   = ndb.JsonProperty()
+    baseline = ndb.JsonProperty()
+    updated  = ndb.DateTimeProperty(auto_now=True)
 
 # Define a conference form class, allowing form conference creation
 class ConferenceForm(messages.Message):
@@ -99,6 +146,8 @@ class ConferenceForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    missingKeys = messages.StringField(3, repeated=True)
 
 class ConferenceQueryForm(messages.Message):
     """ConferenceQueryForm -- Conference query inbound form message"""
@@ -111,10 +160,34 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3)
 
 
 # - - - Session objects - - - - - - - - - - - - - - - - - - -
 
+def parseStartTime(startTime):
+    """Return the minutes since midnight of an 'HH:MM' start time, or None."""
+    try:
+        hours, minutes = startTime.strip().split(':')[:2]
+        hours, minutes = int(hours), int(minutes)
+    except (AttributeError, ValueError):
+        return None
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        return None
+    return hours * 60 + minutes
+
+def _startDateTime(session):
+    if session.date is None or session.startMinutes is None:
+        return None
+    return (datetime.combine(session.date, datetime.min.time()) +
+            timedelta(minutes=session.startMinutes))
+
+def _endDateTime(session):
+    if session.startDateTime is None:
+        return None
+    return session.startDateTime + timedelta(minutes=session.duration or 0)
+
 # define a session model to enable session objects. 
 class Session(ndb.Model):
     """Session -- Session object"""
@@ -126,6 +199,12 @@ class Session(ndb.Model):
     startTime       = ndb.StringProperty()
     typeOfSession   = ndb.StringProperty()
     creatorUserId   = ndb.StringProperty()
+    # typed start & end times derived from date, startTime and duration, for
+    # range queries; sessions written before they existed are filled in by
+    # ConferenceApi._migrateSessionTimes.
+    startMinutes    = ndb.ComputedProperty(lambda self: parseStartTime(self.startTime))
+    startDateTime   = ndb.ComputedProperty(_startDateTime)
+    endDateTime     = ndb.ComputedProperty(_endDateTime)
 
 # Define a session form class, allowing form conference creation
 class SessionForm(messages.Message):
@@ -141,10 +220,40 @@ class SessionForm(messages.Message):
     websafeKey      = messages.StringField(9)
     creatorDisplayName = messages.StringField(10)
 
+# Marks a conference's materialized session schedule as built; see
+# schedule.py. Stored as the conference's child, like its groups.
+class ConferenceSchedule(ndb.Model):
+    """ConferenceSchedule -- marker of a conference's built schedule"""
+    pass
+
+# A conference's sessions of one date and type, precomputed as compressed
+# SessionForm JSON; shares the sessions' entity group.
+class ScheduleGroup(ndb.Model):
+    """ScheduleGroup -- one date and type of a conference's schedule"""
+    date          = ndb.StringProperty(indexed=False)
+    typeOfSession = ndb.StringProperty(indexed=False)
+    entries       = ndb.JsonProperty(compressed=True)
+
+# Index of a speaker's sessions within a conference, kept as the conference's
+# child (id is the speaker) and updated in the session write transactions.
+class SpeakerSessions(ndb.Model):
+    """SpeakerSessions -- a speaker's sessions within one conference"""
+    sessionKeys  = ndb.StringProperty(repeated=True, indexed=False)
+    sessionNames = ndb.StringProperty(repeated=True, indexed=False)
+
+# A conference's featured speaker message, backing its memcache entry.
+class FeaturedSpeaker(ndb.Model):
+    """FeaturedSpeaker -- featured speaker message of a conference"""
+    speaker = ndb.StringProperty(indexed=False)
+    message = ndb.TextProperty()
+    updated = ndb.DateTimeProperty(auto_now=True)
+
 # Create SessionForms, for multiple sessions to be displayed.
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    missingKeys = messages.StringField(3, repeated=True)
 
 # Create a message for storing session queries.
 class SessionQueryForm(messages.Message):
@@ -157,6 +266,10 @@ class SessionQueryForm(messages.Message):
 class SessionQueryForms(messages.Message):
     """SessionQueryForms -- multiple SessionQueryForm inbound form message"""
     filters = messages.MessageField(SessionQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3)
+    # optionally limits the query to one conference's sessions.
+    websafeConferenceKey = messages.StringField(4)
 
 class SessionTypeQuery(messages.Message):
     """SessionTypeQuery -- Session type inbound form message."""
@@ -166,6 +279,11 @@ class SessionSpeakerQuery(messages.Message):
     """SessionSpeakerQuery -- Session speaker inbound form message."""
     speaker = messages.StringField(1)
 
+# Batch lookups of conferences or sessions by websafe key.
+class WebsafeKeysForm(messages.Message):
+    """WebsafeKeysForm -- multiple websafe keys inbound form message"""
+    websafeKeys = messages.StringField(1, repeated=True)
+
 # needed for conference registration
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
@@ -175,6 +293,50 @@ class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
+# - - - Search objects - - - - - - - - - - - - - - - - - - - -
+
+# The search tokens of a Conference or Session, kept as its child (id 1) and
+# written with it; the datastore index on tokens is the inverted index. See
+# search.py.
+class SearchDocument(ndb.Model):
+    """SearchDocument -- search tokens & weights of a conference or session"""
+    kind    = ndb.StringProperty()
+    tokens  = ndb.StringProperty(repeated=True)
+    weights = ndb.FloatProperty(repeated=True, indexed=False)
+
+# Full text search of conferences or sessions, one page at a time.
+class SearchForm(messages.Message):
+    """SearchForm -- search inbound form message"""
+    query = messages.StringField(1)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3)
+
+# Conference counts per value of a browse page facet (CITY, TOPIC or MONTH).
+class FacetCountForm(messages.Message):
+    """FacetCountForm -- outbound facet value count message"""
+    value = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+class FacetForm(messages.Message):
+    """FacetForm -- outbound facet counts message"""
+    field = messages.StringField(1)
+    counts = messages.MessageField(FacetCountForm, 2, repeated=True)
+
+class FacetForms(messages.Message):
+    """FacetForms -- multiple FacetForm outbound form message"""
+    items = messages.MessageField(FacetForm, 1, repeated=True)
+
+# Hit/miss counters of the memcache form caches.
+class CacheStatsForm(messages.Message):
+    """CacheStatsForm -- outbound form cache counters message"""
+    cache = messages.StringField(1)
+    hits = messages.IntegerField(2)
+    misses = messages.IntegerField(3)
+
+class CacheStatsForms(messages.Message):
+    """CacheStatsForms -- multiple CacheStatsForm outbound form message"""
+    items = messages.MessageField(CacheStatsForm, 1, repeated=True)
+
 # StringMessage message class for creating memcache announcements.
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+"""planner.py
+
+Query planning for conference and session queries with inequality filters
+on more than one field.
+
+The datastore allows inequalities on one property per query, so plan()
+pushes the equality filters and the range filters of a single field down
+to the datastore, and leaves the other filters as residual predicates.
+When several fields have range filters, the one estimated to match the
+fewest entities is pushed, from per-field stats sampled with a projection
+query and cached in memcache for STATS_TTL seconds. '!=' filters are always
+residual: ndb runs them as a merge of two queries, which can't be paged
+with cursors.
+
+fetchPage() runs the pushed query as a projection of the residual fields,
+applies the residual predicates to each row in memory, and fetches only
+the matching entities. A page stops at page_size matches or after
+MAX_SCAN rows, whichever comes first, so a page may hold fewer results
+than requested while a next page token remains.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import calendar
+import collections
+import logging
+import operator
+from datetime import date, datetime
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+# Property comparisons for query filter operators.
+COMPARISONS = {
+    '=': operator.eq,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '!=': operator.ne,
+}
+
+STATS_KEY = 'query-stats:%s:%s'
+STATS_TTL = 3600
+# Values sampled per field for its stats.
+STATS_SAMPLE_SIZE = 1000
+# Estimated fraction matched by a range filter without usable stats.
+DEFAULT_SELECTIVITY = 1 / 3.0
+
+# Most rows scanned for one page of a query with residual filters.
+MAX_SCAN = 1000
+SCAN_BATCH_SIZE = 200
+
+# Separates the pushed field from the cursor in page tokens of queries
+# with a choice of field; websafe cursors never contain it.
+TOKEN_SEPARATOR = '~'
+
+# field is the inequality field pushed to the datastore, or None; pinned is
+# whether it was chosen among several, and so must be kept across pages.
+Plan = collections.namedtuple('Plan', 'field pushed residual pinned')
+
+
+# - - - Planning - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def inequalityFields(filters):
+    """Return the fields with range filters, in filter order."""
+    fields = []
+    for filtr in filters:
+        if filtr['operator'] not in ('=', '!=') and filtr['field'] not in fields:
+            fields.append(filtr['field'])
+    return fields
+
+
+def plan(model, filters, field=None):
+    """Split formatted filters into those run by the datastore and those
+    applied in memory. field pins the pushed field, when continuing a
+    query whose first page chose it."""
+    candidates = inequalityFields(filters)
+    if field not in candidates:
+        field = None
+    if field is None and len(candidates) == 1:
+        field = candidates[0]
+    elif field is None and candidates:
+        stats = getStats(model, candidates)
+        field = min(candidates, key=lambda name: (
+            estimate([f for f in filters if f['field'] == name], stats.get(name)),
+            candidates.index(name)))
+    pushed, residual = [], []
+    for filtr in filters:
+        if filtr['operator'] == '=' or (filtr['field'] == field and
+                                        filtr['operator'] != '!='):
+            pushed.append(filtr)
+        else:
+            residual.append(filtr)
+    return Plan(field, pushed, residual, len(candidates) > 1)
+
+
+def buildQuery(model, plan):
+    """Return the datastore query of a plan, ordered by the pushed field
+    and then name."""
+    q = model.query()
+    if plan.field:
+        q = q.order(model._properties[plan.field])
+    q = q.order(model.name)
+    for filtr in plan.pushed:
+        # compare against the typed property, so values are converted to
+        # the property's datastore type.
+        prop = model._properties[filtr['field']]
+        q = q.filter(COMPARISONS[filtr['operator']](prop, filtr['value']))
+    return q
+
+
+# - - - Selectivity - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def getStats(model, fields):
+    """Return {field: stats} of the model's fields from memcache, sampling
+    the fields whose stats are missing."""
+    kind = model._get_kind()
+    keys = dict((STATS_KEY % (kind, field), field) for field in fields)
+    cached = memcache.get_multi(keys.keys())
+    stats = dict((keys[key], value) for key, value in cached.items())
+    sampled = {}
+    for key, field in keys.items():
+        if field not in stats:
+            stats[field] = sampled[key] = sampleStats(model, field)
+    if sampled:
+        memcache.set_multi(sampled, time=STATS_TTL)
+    return stats
+
+
+def sampleStats(model, field):
+    """Return the count, distinct count, min and max of a sample of a
+    field's indexed values."""
+    prop = model._properties[field]
+    rows = model.query().fetch(STATS_SAMPLE_SIZE, projection=[prop])
+    values = [getattr(row, prop._code_name) for row in rows]
+    values = [value for value in values if value is not None]
+    if not values:
+        return {'count': 0, 'distinct': 0, 'min': None, 'max': None}
+    return {'count': len(values), 'distinct': len(set(values)),
+            'min': min(values), 'max': max(values)}
+
+
+def _position(value):
+    """Return a number ordering a value on its field's axis, or None."""
+    if isinstance(value, datetime):
+        return calendar.timegm(value.timetuple())
+    if isinstance(value, date):
+        return value.toordinal()
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return value
+    return None
+
+
+def estimate(filters, stats):
+    """Return the estimated fraction of entities matching a field's range
+    filters."""
+    if not stats or not stats['count']:
+        return DEFAULT_SELECTIVITY
+    low, high = _position(stats['min']), _position(stats['max'])
+    fractions = []
+    for filtr in filters:
+        value = _position(filtr['value'])
+        if value is None or low is None or high is None or high <= low:
+            fractions.append(DEFAULT_SELECTIVITY)
+            continue
+        below = min(1.0, max(0.0, float(value - low) / (high - low)))
+        fractions.append(below if filtr['operator'] in ('<', '<=') else 1 - below)
+    # ranges on one axis intersect; a lower and an upper bound a and b
+    # match b - a = a' + b - 1, for a' = 1 - a the fraction above a.
+    return max(sum(fractions) - (len(fractions) - 1), 1.0 / (stats['count'] + 1))
+
+
+# - - - Execution - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def parseToken(pageToken):
+    """Return the (pinned field or None, Cursor or None) of a page token;
+    raises BadValueError for a malformed token."""
+    if not pageToken:
+        return None, None
+    field, _, cursor = pageToken.rpartition(TOKEN_SEPARATOR)
+    return field or None, Cursor(urlsafe=cursor)
+
+
+def makeToken(plan, cursor):
+    """Return the page token continuing a plan's query at cursor."""
+    if cursor is None:
+        return None
+    if plan.pinned:
+        return plan.field + TOKEN_SEPARATOR + cursor.urlsafe()
+    return cursor.urlsafe()
+
+
+def matcher(model, residual):
+    """Return a predicate testing an entity or projection row against the
+    residual filters, each compiled once into (attribute, test, value)."""
+    tests = []
+    for filtr in residual:
+        prop = model._properties[filtr['field']]
+        tests.append((prop._code_name, prop._repeated,
+                      COMPARISONS[filtr['operator']], filtr['value']))
+
+    def matches(row):
+        for name, repeated, compare, value in tests:
+            found = getattr(row, name)
+            # like the datastore, a repeated property matches if any of its
+            # values does, and a missing value matches nothing.
+            candidates = found if repeated else [found]
+            if not any(v is not None and compare(v, value) for v in candidates):
+                return False
+        return True
+    return matches
+
+
+def fetchPage(model, plan, page_size, start_cursor=None, keys_only=False):
+    """Fetch one page of a plan's results, returning the entities and the
+    cursor after the last row scanned, or None if there are no more."""
+    q = buildQuery(model, plan)
+    if not plan.residual:
+        results, next_cursor, more = q.fetch_page(
+            page_size, start_cursor=start_cursor, keys_only=keys_only)
+        if keys_only:
+            results = ndb.get_multi(results)
+        return results, next_cursor if more else None
+
+    # project the residual fields unless one is repeated, which would give
+    # a row per value, or has an equality filter, which datastore forbids.
+    fields = set(filtr['field'] for filtr in plan.residual)
+    equalities = set(filtr['field'] for filtr in plan.pushed
+                     if filtr['operator'] == '=')
+    props = [model._properties[field] for field in sorted(fields)]
+    projection = None
+    if not fields & equalities and not any(prop._repeated for prop in props):
+        projection = props
+    try:
+        rows, next_cursor = _scan(q, matcher(model, plan.residual), page_size,
+                                  start_cursor, projection)
+    except datastore_errors.NeedIndexError:
+        if projection is None:
+            raise
+        logging.warning('No index for projection of %s; scanning entities.',
+                        [prop._name for prop in props])
+        rows, next_cursor = _scan(q, matcher(model, plan.residual), page_size,
+                                  start_cursor, None)
+    if projection is not None:
+        rows = ndb.get_multi([row.key for row in rows])
+    return rows, next_cursor
+
+
+def _scan(q, matches, page_size, start_cursor, projection):
+    """Return up to page_size rows of q that match, scanning at most
+    MAX_SCAN rows, and the cursor after the last row scanned or None."""
+    it = q.iter(start_cursor=start_cursor, projection=projection,
+                batch_size=SCAN_BATCH_SIZE, produce_cursors=True)
+    rows = []
+    scanned = 0
+    for row in it:
+        scanned += 1
+        if matches(row):
+            rows.append(row)
+        if len(rows) >= page_size or scanned >= MAX_SCAN:
+            return rows, it.cursor_after() if it.has_next() else None
+    return rows, None
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""schedule.py
+
+Materialized per-conference session schedules.
+
+A conference's schedule is split into ScheduleGroup child entities, one per
+date and typeOfSession, each holding the SessionForm JSON entries of its
+sessions in start time order:
+
+    ScheduleGroup "2016-06-01|lecture": [{"name": ..., "websafeKey": ...}, ...]
+
+so a session write rewrites only its group, and no entity grows with the
+whole conference. The ConferenceSchedule child marks the schedule as
+built; conferences without it have theirs built from their sessions on
+first read. Session writes update their groups in the same transaction as
+the session itself, and the schedule is read with a key get and an
+ancestor query. Entries leave out the creator's display name, which may
+change at any time; readers resolve it from creatorUserId.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+from google.appengine.ext import ndb
+
+from models import ConferenceSchedule, ScheduleGroup, SessionForm, parseStartTime
+
+# id 1 held the single-entity schedules, now rebuilt as groups.
+SCHEDULE_ID = 2
+# group for sessions without a date.
+NO_DATE = ''
+# form fields not stored in entries.
+UNSTORED_FIELDS = ('creatorDisplayName',)
+
+
+def scheduleKey(conf_key):
+    """Return the key of the conference's schedule marker."""
+    return ndb.Key(ConferenceSchedule, SCHEDULE_ID, parent=conf_key)
+
+
+def groupKey(conf_key, date, typeOfSession):
+    """Return the key of the conference's group of a date and type."""
+    return ndb.Key(ScheduleGroup, u'%s|%s' % (date or NO_DATE, typeOfSession or ''),
+                   parent=conf_key)
+
+
+def _formKey(conf_key, form):
+    return groupKey(conf_key, form.date, form.typeOfSession)
+
+
+def _entry(form):
+    """Return the JSON entry stored for a SessionForm."""
+    return dict((field.name, getattr(form, field.name))
+                for field in form.all_fields()
+                if field.name not in UNSTORED_FIELDS
+                and getattr(form, field.name) is not None)
+
+
+def _sortKey(entry):
+    # "9:00" and "09:00" are both accepted, so compare minutes, not strings;
+    # sessions without a start time come first.
+    minutes = parseStartTime(entry.get('startTime'))
+    return (-1 if minutes is None else minutes, entry.get('name') or '')
+
+
+def newSchedule(conf_key):
+    """Return the schedule marker of a new conference, which has no groups."""
+    return ConferenceSchedule(key=scheduleKey(conf_key))
+
+
+def _newGroup(key):
+    date, _, typeOfSession = key.id().partition(u'|')
+    return ScheduleGroup(key=key, date=date, typeOfSession=typeOfSession, entries=[])
+
+
+def _putForms(groups, forms, conf_key):
+    """Add or replace the entries for forms in {key: group}, dropping them
+    from every group first, as dates or types may have changed."""
+    websafe_keys = set(form.websafeKey for form in forms)
+    for group in groups.values():
+        group.entries = [entry for entry in group.entries or []
+                         if entry.get('websafeKey') not in websafe_keys]
+    for form in forms:
+        key = _formKey(conf_key, form)
+        if key not in groups:
+            groups[key] = _newGroup(key)
+        groups[key].entries.append(_entry(form))
+    for group in groups.values():
+        group.entries.sort(key=_sortKey)
+
+
+def buildGroups(conf_key, forms):
+    """Return the groups of a schedule of forms."""
+    groups = {}
+    _putForms(groups, forms, conf_key)
+    return groups.values()
+
+
+@ndb.tasklet
+def putFormsAsync(conf_key, forms, previous=()):
+    """Add or replace the entries for forms, also dropping them from the
+    groups of previous, the forms of the same sessions before an update;
+    call in the transaction writing the sessions. Returns the groups to
+    put, or [] if the conference's schedule isn't built yet."""
+    keys = list(set(_formKey(conf_key, form) for form in list(forms) + list(previous)))
+    sched, found = yield scheduleKey(conf_key).get_async(), ndb.get_multi_async(keys)
+    if not sched:
+        raise ndb.Return([])
+    groups = dict((key, group or _newGroup(key)) for key, group in zip(keys, found))
+    _putForms(groups, forms, conf_key)
+    raise ndb.Return(groups.values())
+
+
+@ndb.tasklet
+def loadAsync(conf_key):
+    """Return the conference's groups, or None if its schedule isn't built."""
+    sched, groups = yield (scheduleKey(conf_key).get_async(),
+                           ScheduleGroup.query(ancestor=conf_key).fetch_async())
+    raise ndb.Return(groups if sched else None)
+
+
+def getEntries(groups, typeOfSession=None):
+    """Return the entries of a schedule's groups ordered by date and start
+    time, optionally only those of typeOfSession."""
+    days = {}
+    for group in groups:
+        if typeOfSession is None or group.typeOfSession == typeOfSession:
+            days.setdefault(group.date or NO_DATE, []).extend(group.entries or [])
+    ordered = []
+    for date in sorted(days):
+        ordered.extend(sorted(days[date], key=_sortKey))
+    return ordered
+
+
+def toForm(entry, displayName=None):
+    """Return the SessionForm of a stored entry, with its creator's
+    displayName."""
+    form = SessionForm(**dict((str(name), value) for name, value in entry.items()
+                              if name not in UNSTORED_FIELDS))
+    if displayName:
+        form.creatorDisplayName = displayName
+    return form
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""search.py
+
+Full text search of conferences and sessions, on the datastore alone.
+
+Every Conference and Session has a SearchDocument child listing the
+distinct tokens of its text fields, each with a weight: the sum, over its
+occurrences, of the weight of the field it occurs in. Writes of the entity
+put its document alongside, in the same entity group, so search stays
+consistent with what was written. The built-in index on the documents'
+repeated tokens property is the inverted index: a query term is looked up
+as a prefix, with a range filter on tokens.
+
+A search matches the entities whose documents have every query term as a
+prefix of some token. The documents of the rarest term, by a count of each
+term's matches up to MAX_MATCHES, are scanned and checked against the
+other terms in memory, until MAX_MATCHES documents match or MAX_SCAN were
+read. The matches are ranked by the sum, over the query terms, of the
+weight of the best token each term matches, counting prefix-only matches
+at PREFIX_WEIGHT, then by key, and paged by offset.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import logging
+import re
+
+from google.appengine.ext import ndb
+
+from models import SearchDocument
+
+DOCUMENT_ID = 1
+
+# Weighted text fields of each searchable kind.
+FIELD_WEIGHTS = {
+    'Conference': (('name', 3.0), ('topics', 2.0), ('description', 1.0)),
+    'Session': (('name', 3.0), ('speaker', 2.0), ('highlights', 1.0)),
+}
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+STOP_WORDS = frozenset(['a', 'an', 'and', 'at', 'for', 'in', 'of', 'on',
+                        'or', 'the', 'to', 'with'])
+MAX_TOKEN_LENGTH = 40
+MAX_TOKENS = 200
+MAX_QUERY_TERMS = 8
+
+# Score of a term matching a token only as a prefix, relative to exactly.
+PREFIX_WEIGHT = 0.5
+# Most documents matched, and read, per search.
+MAX_MATCHES = 1000
+MAX_SCAN = 10000
+SCAN_BATCH_SIZE = 200
+
+
+def tokenize(text):
+    """Return the lowercase words of a text, without stop words."""
+    return [token[:MAX_TOKEN_LENGTH] for token in TOKEN_RE.findall((text or u'').lower())
+            if token not in STOP_WORDS]
+
+
+def documentKey(key):
+    """Return the key of an entity's search document."""
+    return ndb.Key(SearchDocument, DOCUMENT_ID, parent=key)
+
+
+def document(entity):
+    """Return the search document of a Conference or Session, to be put with
+    it; its key must be complete."""
+    kind = entity._get_kind()
+    weights = {}
+    for field, weight in FIELD_WEIGHTS[kind]:
+        value = getattr(entity, field)
+        for text in (value if isinstance(value, list) else [value]):
+            for token in tokenize(text):
+                weights[token] = weights.get(token, 0) + weight
+    # keep the heaviest tokens of very long texts.
+    tokens = sorted(weights, key=lambda token: (-weights[token], token))[:MAX_TOKENS]
+    return SearchDocument(key=documentKey(entity.key), kind=kind, tokens=tokens,
+                          weights=[weights[token] for token in tokens])
+
+
+def _termQuery(kind, term):
+    """Return the query of the kind's documents with a token starting with
+    term."""
+    return SearchDocument.query(SearchDocument.kind == kind,
+                                SearchDocument.tokens >= term,
+                                SearchDocument.tokens < term + u'\ufffd')
+
+
+def hasTerms(doc, terms):
+    """Return whether every term is a prefix of one of a document's tokens."""
+    return all(any(token.startswith(term) for token in doc.tokens)
+               for term in terms)
+
+
+def matches(kind, terms):
+    """Return the kind's documents having every term, at most MAX_MATCHES,
+    scanning the documents of the rarest term."""
+    driver = terms[0]
+    if len(terms) > 1:
+        # count the terms together; counts stop past MAX_MATCHES.
+        futures = [_termQuery(kind, term).count_async(MAX_MATCHES + 1)
+                   for term in terms]
+        counts = dict((term, future.get_result()) for term, future in zip(terms, futures))
+        driver = min(terms, key=lambda term: (counts[term], -len(term), term))
+    docs, seen, scanned = [], set(), 0
+    for doc in _termQuery(kind, driver).iter(batch_size=SCAN_BATCH_SIZE):
+        scanned += 1
+        if doc.key not in seen and hasTerms(doc, terms):
+            seen.add(doc.key)
+            docs.append(doc)
+        if len(docs) >= MAX_MATCHES or scanned >= MAX_SCAN:
+            logging.info('Search for %r stopped after %d documents', terms, scanned)
+            break
+    return docs
+
+
+def score(doc, terms):
+    """Return a document's rank score for the query terms."""
+    total = 0.0
+    for term in terms:
+        best = 0.0
+        for token, weight in zip(doc.tokens, doc.weights):
+            if token.startswith(term):
+                best = max(best, weight if token == term else weight * PREFIX_WEIGHT)
+        total += best
+    return total
+
+
+def search(model, query, offset=0, limit=20):
+    """Return the keys of one page of the model's entities matching query,
+    best first, and the offset of the next page or None."""
+    terms = sorted(set(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return [], None
+    ranked = sorted(matches(model._get_kind(), terms),
+                    key=lambda doc: (-score(doc, terms), doc.key.pairs()))
+    page = ranked[offset:offset + limit]
+    next_offset = offset + limit if offset + limit < len(ranked) else None
+    return [doc.key.parent() for doc in page], next_offset
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Sharded seat counters for conference registration.
+
+A sharded conference splits its seats over SeatShard root entities. A
+registration reads the shards outside its transaction, then takes a seat
+from one with seats left, chosen at random, in a transaction touching that
+shard alone; if the shard has run out or is contended, it moves on to the
+next. Concurrent registrations so spread over several entity groups
+instead of queueing on the single Conference entity. A shard never drops
+below zero, so the total can never be oversold.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import random
+
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+# Shards given to new conferences. Adjusting maxAttendees touches every
+# shard plus the Conference group, so this stays below the XG limit of 25.
+SEAT_SHARDS = 10
+
+
+def shardCount(seats):
+    """Return the number of shards to use for a conference of seats."""
+    return max(0, min(SEAT_SHARDS, seats))
+
+
+def shardKeys(conf_key, num_shards):
+    """Return the SeatShard keys of a conference."""
+    wsck = conf_key.urlsafe()
+    return [ndb.Key(SeatShard, '%s-%d' % (wsck, i)) for i in range(num_shards)]
+
+
+def createShards(conf_key, seats, num_shards):
+    """Return SeatShard entities splitting seats evenly over num_shards."""
+    per_shard, extra = divmod(seats, num_shards)
+    return [SeatShard(key=key, seatsAvailable=per_shard + (1 if i < extra else 0))
+            for i, key in enumerate(shardKeys(conf_key, num_shards))]
+
+
+@ndb.tasklet
+def pickShardsAsync(conf_key, num_shards):
+    """Return the keys of the shards with seats left, in random order; a
+    read outside any transaction, so the counts are only a hint."""
+    keys = shardKeys(conf_key, num_shards)
+    shards = yield ndb.get_multi_async(keys, use_cache=False, use_memcache=False)
+    keys = [key for key, shard in zip(keys, shards)
+            if shard and shard.seatsAvailable > 0]
+    random.shuffle(keys)
+    raise ndb.Return(keys)
+
+
+@ndb.tasklet
+def takeSeatAsync(shard_key):
+    """Take one seat from a shard; must run inside a transaction. Returns
+    False when the shard is empty."""
+    shard = yield shard_key.get_async()
+    if not shard or shard.seatsAvailable <= 0:
+        raise ndb.Return(False)
+    shard.seatsAvailable -= 1
+    yield shard.put_async()
+    raise ndb.Return(True)
+
+
+@ndb.tasklet
+def releaseSeatAsync(conf_key, num_shards):
+    """Give one seat back to a random shard; must run inside a transaction."""
+    key = random.choice(shardKeys(conf_key, num_shards))
+    shard = yield key.get_async()
+    if not shard:
+        shard = SeatShard(key=key)
+    shard.seatsAvailable += 1
+    yield shard.put_async()
+
+
+@ndb.tasklet
+def adjustSeatsAsync(conf_key, num_shards, delta):
+    """Add (or, for a negative delta, remove up to) delta seats across the
+    shards; must run inside a cross-group transaction."""
+    if delta == 0:
+        return
+    shards = yield ndb.get_multi_async(shardKeys(conf_key, num_shards))
+    shards = [shard for shard in shards if shard]
+    if not shards:
+        return
+    if delta > 0:
+        random.choice(shards).seatsAvailable += delta
+    else:
+        remove = -delta
+        for shard in shards:
+            taken = min(remove, shard.seatsAvailable)
+            shard.seatsAvailable -= taken
+            remove -= taken
+    yield ndb.put_multi_async(shards)
+
+
+@ndb.tasklet
+def getSeatsAvailableAsync(conf_key, num_shards):
+    """Return the total seats available, aggregated over all shards."""
+    shards = yield ndb.get_multi_async(shardKeys(conf_key, num_shards))
+    raise ndb.Return(sum(shard.seatsAvailable for shard in shards if shard))
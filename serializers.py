@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""serializers.py
+
+Precompiled entity -> ProtoRPC form copy plans for the conference API.
+
+Each plan is built once at import time from the form's fields and the
+model's properties, so copying an entity no longer reflects over
+all_fields() or inspects field names for every item of a list.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+from google.appengine.ext import ndb
+
+from models import Profile, ProfileForm, TeeShirtSize
+from models import Conference, ConferenceForm
+from models import Session, SessionForm
+
+
+def dateToString(value):
+    """Convert a Date property value into its form string."""
+    if value is None:
+        return None
+    return str(value)
+
+
+def teeShirtSizeToEnum(value):
+    """Convert a stored t-shirt size string into its TeeShirtSize enum."""
+    if value is None:
+        return None
+    return getattr(TeeShirtSize, value)
+
+
+# Converters applied by property type when no per-field converter is given.
+PROPERTY_CONVERTERS = {
+    ndb.DateProperty: dateToString,
+}
+
+
+class FormSerializer(object):
+    """FormSerializer -- copies one model kind into its form message"""
+
+    def __init__(self, model_class, form_class, converters=None,
+                 key_field=None, name_field=None):
+        converters = converters or {}
+        self.form_class = form_class
+        self.key_field = key_field
+        self.name_field = name_field
+        # copy plan: (field name, converter or None) for every form field
+        # backed by a model property.
+        plan = []
+        for field in form_class.all_fields():
+            prop = model_class._properties.get(field.name)
+            if prop is None:
+                continue
+            convert = converters.get(field.name,
+                                     PROPERTY_CONVERTERS.get(type(prop)))
+            plan.append((field.name, convert))
+        self.plan = tuple(plan)
+
+    def toForm(self, entity, displayName=None):
+        """Copy entity into a new form, adding websafe key & display name."""
+        values = {}
+        for name, convert in self.plan:
+            value = getattr(entity, name)
+            values[name] = convert(value) if convert else value
+        if self.key_field:
+            values[self.key_field] = entity.key.urlsafe()
+        if self.name_field and displayName:
+            values[self.name_field] = displayName
+        form = self.form_class(**values)
+        form.check_initialized()
+        return form
+
+
+# Registry of serializers by model class, built once at import time.
+SERIALIZERS = {
+    Profile: FormSerializer(Profile, ProfileForm,
+                            converters={'teeShirtSize': teeShirtSizeToEnum}),
+    Conference: FormSerializer(Conference, ConferenceForm,
+                               key_field='websafeKey',
+                               name_field='organizerDisplayName'),
+    Session: FormSerializer(Session, SessionForm,
+                            key_field='websafeKey',
+                            name_field='creatorDisplayName'),
+}
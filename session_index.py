@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""session_index.py
+
+Instance-local, versioned in-memory index of each conference's sessions.
+
+An index is loaded lazily from the conference's materialized schedule, on
+the first lookup in a conference, and maps typeOfSession, speaker, date
+and start hour to the websafe keys of the sessions having them. Lookups
+then narrow the candidate sessions through those buckets, check them
+against the filters in memory, and return their SessionForms without a
+datastore query.
+
+Each conference has a generation counter in memcache, bumped after every
+committed session write in it. An index remembers the generation it was
+loaded at, and a lookup that finds the counter moved on loads it again,
+so a warm lookup costs one memcache get. The generation is read before
+the schedule is loaded, so a write committing meanwhile leaves the index
+stale for one lookup at most. When memcache can't give a generation, the
+index is loaded for the lookup alone and not kept. Indexes are held for at most
+SESSION_INDEX_SIZE conferences per instance, least recently used first
+out.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import collections
+import time
+from datetime import datetime
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import planner
+import schedule
+import utils
+from models import Session
+
+SESSION_INDEX_SIZE = 200
+GENERATION_KEY = 'session-index-generation:%s'
+
+# Fields with a bucket of session keys per value, for equality filters.
+BUCKET_FIELDS = ('typeOfSession', 'speaker', 'date')
+MINUTES_PER_BUCKET = 60
+
+
+class SessionIndex(object):
+    """SessionIndex -- one conference's sessions, bucketed for lookups"""
+
+    def __init__(self, generation, entries):
+        self.generation = generation
+        # websafe key -> schedule entry, and a transient Session holding
+        # the entry's typed & computed properties for filters to compare.
+        self.entries = collections.OrderedDict()
+        self.rows = {}
+        self.buckets = dict((field, {}) for field in BUCKET_FIELDS)
+        self.hours = {}
+        for entry in entries:
+            websafeKey = entry.get('websafeKey')
+            row = _row(entry)
+            self.entries[websafeKey] = entry
+            self.rows[websafeKey] = row
+            for field in BUCKET_FIELDS:
+                self.buckets[field].setdefault(getattr(row, field), []).append(websafeKey)
+            if row.startMinutes is not None:
+                self.hours.setdefault(row.startMinutes // MINUTES_PER_BUCKET,
+                                      []).append(websafeKey)
+
+    def find(self, filters):
+        """Return the schedule entries matching formatted, typed session
+        filters, in schedule order."""
+        candidates = None
+        for filtr in filters:
+            keys = self._bucket(filtr)
+            if keys is not None:
+                candidates = keys if candidates is None else candidates & keys
+        matches = planner.matcher(Session, filters)
+        return [entry for websafeKey, entry in self.entries.items()
+                if (candidates is None or websafeKey in candidates)
+                and matches(self.rows[websafeKey])]
+
+    def _bucket(self, filtr):
+        """Return the set of keys a filter can match, or None if it has no
+        bucket."""
+        field, op, value = filtr['field'], filtr['operator'], filtr['value']
+        if op == '=' and field in BUCKET_FIELDS:
+            return set(self.buckets[field].get(value, ()))
+        if field == 'startMinutes' and op not in ('=', '!='):
+            bound = value // MINUTES_PER_BUCKET
+            if op in ('<', '<='):
+                hours = [hour for hour in self.hours if hour <= bound]
+            else:
+                hours = [hour for hour in self.hours if hour >= bound]
+            return set(key for hour in hours for key in self.hours[hour])
+        return None
+
+
+def _row(entry):
+    """Return a transient Session of a schedule entry's filterable fields."""
+    date = entry.get('date')
+    return Session(speaker=entry.get('speaker'),
+                   typeOfSession=entry.get('typeOfSession'),
+                   date=datetime.strptime(date[:10], "%Y-%m-%d").date() if date else None,
+                   startTime=entry.get('startTime'),
+                   duration=entry.get('duration'))
+
+
+# websafe conference key -> SessionIndex
+_indexes = utils.LRUCache(SESSION_INDEX_SIZE)
+
+
+def _initialGeneration():
+    # a counter evicted from memcache restarts from a value no index was
+    # loaded at.
+    return int(time.time() * 1000)
+
+
+def getGeneration(websafeConferenceKey):
+    """Return the conference's current index generation, or None if
+    memcache is unavailable."""
+    key = GENERATION_KEY % websafeConferenceKey
+    generation = memcache.get(key)
+    if generation is None:
+        memcache.add(key, _initialGeneration())
+        generation = memcache.get(key)
+    return None if generation is None else int(generation)
+
+
+@ndb.tasklet
+def bumpGenerationAsync(websafeConferenceKey):
+    """Invalidate the conference's indexes on every instance; call after a
+    session write in it commits."""
+    ctx = ndb.get_context()
+    key = GENERATION_KEY % websafeConferenceKey
+    generation = yield ctx.memcache_incr(key, initial_value=_initialGeneration())
+    if generation is None:
+        # a counter left behind would keep stale indexes; the next lookup
+        # starts a new one.
+        yield ctx.memcache_delete(key)
+
+
+def bumpGenerations(websafeConferenceKeys):
+    """Invalidate the indexes of several conferences."""
+    ndb.Future.wait_all([bumpGenerationAsync(wsck)
+                         for wsck in set(websafeConferenceKeys)])
+
+
+def getIndex(websafeConferenceKey, loadSchedule):
+    """Return the conference's SessionIndex, loading it from the schedule
+    returned by loadSchedule(websafeConferenceKey) if it isn't loaded at
+    the current generation."""
+    generation = getGeneration(websafeConferenceKey)
+    if generation is None:
+        # without a generation, a kept index could never be invalidated.
+        sched = loadSchedule(websafeConferenceKey)
+        return SessionIndex(_initialGeneration(), schedule.getEntries(sched))
+    index = _indexes.get(websafeConferenceKey,
+                         lambda index: index.generation == generation)
+    if index is None:
+        sched = loadSchedule(websafeConferenceKey)
+        index = SessionIndex(generation, schedule.getEntries(sched))
+        _indexes.set(websafeConferenceKey, index)
+    return index
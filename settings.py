@@ -14,3 +14,6 @@ created/forked from conference.py by wesc on 2014 may 24
 # Console or Cloud Console.
 WEB_CLIENT_ID = '488912973237-np7imu9mp2jisev7apb1g8qom6h0e13h.apps.googleusercontent.com'
 
+# Fraction of endpoint and task handler calls profiled by instrumentation.py;
+# 0 turns profiling off.
+INSTRUMENTATION_SAMPLE_RATE = 0.05
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""speakers.py
+
+Per-conference speaker index and featured speaker messages.
+
+Each (conference, speaker) pair has a SpeakerSessions child of the
+conference listing the speaker's session keys and names. Session writes
+update it in their own transaction, so finding a speaker's other sessions
+is a single key get rather than a query.
+
+Featured speaker messages are stored per conference in a FeaturedSpeaker
+entity and cached in memcache under a per-conference key, with the most
+recent message of any conference under LATEST_FEATURED_KEY.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Session, SpeakerSessions, FeaturedSpeaker
+
+FEATURED_ID = 1
+FEATURED_KEY = 'featured-speaker:%s'
+LATEST_FEATURED_KEY = 'CONFERENCE FEATURED SPEAKER'
+
+
+def speakerKey(conf_key, speaker):
+    """Return the key of a speaker's session index within a conference."""
+    return ndb.Key(SpeakerSessions, speaker, parent=conf_key)
+
+
+def featuredKey(conf_key):
+    """Return the key of a conference's featured speaker message."""
+    return ndb.Key(FeaturedSpeaker, FEATURED_ID, parent=conf_key)
+
+
+def sessionEntry(sesh):
+    """Return the (speaker, websafe key, name) index entry of a session."""
+    return (sesh.speaker, sesh.key.urlsafe(), sesh.name)
+
+
+@ndb.tasklet
+def indexSessionsAsync(conf_key, added=(), removed=()):
+    """Apply added and removed session entries to the speaker indexes and
+    return the changed SpeakerSessions entities for the caller to put; must
+    run in a transaction on the conference's entity group."""
+    added = [entry for entry in added if entry[0]]
+    removed = [entry for entry in removed if entry[0]]
+    speakers = sorted(set(entry[0] for entry in added + removed))
+    if not speakers:
+        raise ndb.Return([])
+    keys = [speakerKey(conf_key, speaker) for speaker in speakers]
+    found = yield ndb.get_multi_async(keys)
+    indexes = {}
+    for speaker, key, index in zip(speakers, keys, found):
+        if index is None:
+            # first write for this speaker since indexes existed; seed the
+            # index from the speaker's committed sessions, once.
+            sessions = yield Session.query(Session.speaker == speaker,
+                                           ancestor=conf_key).fetch_async()
+            index = SpeakerSessions(key=key)
+            for sesh in sessions:
+                _add(index, sesh.key.urlsafe(), sesh.name)
+        indexes[speaker] = index
+    for speaker, websafeKey, name in removed:
+        _remove(indexes[speaker], websafeKey)
+    for speaker, websafeKey, name in added:
+        _add(indexes[speaker], websafeKey, name)
+    raise ndb.Return(indexes.values())
+
+
+def _add(index, websafeKey, name):
+    """Add or rename a session in a speaker index."""
+    if websafeKey in index.sessionKeys:
+        index.sessionNames[index.sessionKeys.index(websafeKey)] = name
+    else:
+        index.sessionKeys.append(websafeKey)
+        index.sessionNames.append(name)
+
+
+def _remove(index, websafeKey):
+    """Remove a session from a speaker index."""
+    if websafeKey in index.sessionKeys:
+        i = index.sessionKeys.index(websafeKey)
+        del index.sessionKeys[i]
+        del index.sessionNames[i]
+
+
+def getFeatured(conf_key=None):
+    """Return the featured speaker message of a conference, or the latest of
+    any conference, from memcache or else the datastore."""
+    cache_key = FEATURED_KEY % conf_key.urlsafe() if conf_key else LATEST_FEATURED_KEY
+    message = memcache.get(cache_key)
+    if message is not None:
+        return message
+    if conf_key:
+        featured = featuredKey(conf_key).get()
+    else:
+        featured = FeaturedSpeaker.query().order(-FeaturedSpeaker.updated).get()
+    message = featured.message if featured else ""
+    # add, so a message set meanwhile is not overwritten.
+    memcache.add(cache_key, message)
+    return message
+
+
+def getFeaturedSpeaker(conf_key):
+    """Return the name of the conference's featured speaker, or None."""
+    featured = featuredKey(conf_key).get()
+    return featured.speaker if featured else None
+
+
+def setFeatured(conf_key, speaker, message):
+    """Store and cache the featured speaker message of a conference."""
+    FeaturedSpeaker(key=featuredKey(conf_key), speaker=speaker,
+                    message=message).put()
+    memcache.set_multi({FEATURED_KEY % conf_key.urlsafe(): message,
+                        LATEST_FEATURED_KEY: message})
+
+
+def clearFeatured(conf_key):
+    """Remove the featured speaker message of a conference."""
+    featuredKey(conf_key).delete()
+    # the latest message may have been this one; reload it on the next read.
+    memcache.delete_multi([FEATURED_KEY % conf_key.urlsafe(), LATEST_FEATURED_KEY])
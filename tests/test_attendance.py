@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""test_attendance.py
+
+Tests of the migration of Profile attendance lists into child entities.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import unittest
+
+from google.appengine.ext import ndb
+from protorpc import message_types
+
+import conference
+import testbase
+from conference import ConferenceApi
+from models import Conference, ConferenceRegistration, Profile, Session, SessionWish
+
+
+class AttendanceMigrationTest(testbase.TestbedTestCase):
+
+    def setUp(self):
+        super(AttendanceMigrationTest, self).setUp()
+        organizer = ndb.Key(Profile, 'organizer')
+        self.confs = [Conference(parent=organizer, name='Conference %d' % i)
+                      for i in range(2)]
+        ndb.put_multi(self.confs)
+        self.session = Session(parent=self.confs[0].key, name='Session')
+        self.session.put()
+        self.wscks = [conf.key.urlsafe() for conf in self.confs]
+        self.wssk = self.session.key.urlsafe()
+        self.batch_size = conference.MIGRATION_BATCH_SIZE
+
+    def tearDown(self):
+        conference.MIGRATION_BATCH_SIZE = self.batch_size
+        super(AttendanceMigrationTest, self).tearDown()
+
+    def legacyProfile(self, email):
+        # duplicates in the legacy lists become a single child each.
+        prof = Profile(id=email, mainEmail=email, displayName=email,
+                       conferenceKeysToAttend=self.wscks + self.wscks[:1],
+                       sessionKeysToAttend=[self.wssk])
+        prof.put()
+        return prof.key
+
+    def assertMigrated(self, p_key):
+        prof = p_key.get()
+        self.assertEqual(prof.conferenceKeysToAttend, [])
+        self.assertEqual(prof.sessionKeysToAttend, [])
+        regs = ConferenceRegistration.query(ancestor=p_key).fetch(keys_only=True)
+        self.assertEqual(sorted(key.id() for key in regs), sorted(self.wscks))
+        wishes = SessionWish.query(ancestor=p_key).fetch(keys_only=True)
+        self.assertEqual([key.id() for key in wishes], [self.wssk])
+
+    def testMigrateProfile(self):
+        p_key = self.legacyProfile('user@example.com')
+        ConferenceApi._migrateAttendanceAsync(p_key).get_result()
+        self.assertMigrated(p_key)
+
+    def testMigrationIsIdempotent(self):
+        p_key = self.legacyProfile('user@example.com')
+        ConferenceApi._migrateAttendanceAsync(p_key).get_result()
+        ConferenceApi._migrateAttendanceAsync(p_key).get_result()
+        self.assertMigrated(p_key)
+
+    def testBatchQueuesNextBatch(self):
+        conference.MIGRATION_BATCH_SIZE = 1
+        p_keys = [self.legacyProfile('user%d@example.com' % i) for i in range(2)]
+        self.assertEqual(ConferenceApi._migrateAttendance(), 1)
+        tasks = self.taskqueue.get_filtered_tasks(url='/tasks/migrate_attendance')
+        self.assertEqual(len(tasks), 1)
+        cursor = tasks[0].extract_params()['cursor']
+        self.assertEqual(ConferenceApi._migrateAttendance(cursor), 1)
+        for p_key in p_keys:
+            self.assertMigrated(p_key)
+
+    def testProfileMigratedOnFirstUse(self):
+        p_key = self.legacyProfile('user@example.com')
+        self.actAs('user@example.com')
+        forms = ConferenceApi().getConferencesToAttend(message_types.VoidMessage())
+        self.assertEqual(sorted(form.name for form in forms.items),
+                         sorted(conf.name for conf in self.confs))
+        self.assertMigrated(p_key)
+
+
+if __name__ == '__main__':
+    unittest.main()
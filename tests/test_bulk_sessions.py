@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""test_bulk_sessions.py
+
+Tests of bulk session creation and the featured speaker refreshes it
+queues.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import unittest
+
+import endpoints
+from google.appengine.ext import ndb
+
+import schedule
+import testbase
+from conference import ConferenceApi, SESSIONS_BULK_REQUEST
+from conference import FEATURED_SPEAKER_QUEUE
+from models import Conference, Profile, Session, SessionForm
+
+
+class BulkSessionsTest(testbase.TestbedTestCase):
+
+    def setUp(self):
+        super(BulkSessionsTest, self).setUp()
+        self.actAs('organizer@example.com')
+        self.conf_key = ndb.Key(Profile, 'organizer@example.com', Conference, 1)
+        ndb.put_multi([Conference(key=self.conf_key, name='Summit',
+                                  organizerUserId='organizer@example.com'),
+                       schedule.newSchedule(self.conf_key)])
+        self.wsck = self.conf_key.urlsafe()
+
+    def forms(self, count, speakers=3):
+        return [SessionForm(name='Session %d' % i, speaker='Speaker %d' % (i % speakers),
+                            date='2016-06-0%d' % (i % 2 + 1), startTime='%02d:00' % (i % 24),
+                            duration=60, typeOfSession='lecture')
+                for i in range(count)]
+
+    def createBulk(self, forms):
+        return ConferenceApi().createSessionsBulk(SESSIONS_BULK_REQUEST.combined_message_class(
+            items=forms, websafeConferenceKey=self.wsck))
+
+    def pullTasks(self):
+        return self.taskqueue.get_filtered_tasks(queue_names=[FEATURED_SPEAKER_QUEUE])
+
+    def testCreatesEverySession(self):
+        created = self.createBulk(self.forms(10))
+        self.assertEqual(len(created.items), 10)
+        self.assertEqual(Session.query(ancestor=self.conf_key).count(), 10)
+        groups = schedule.loadAsync(self.conf_key).get_result()
+        self.assertEqual(sorted(entry['websafeKey'] for entry in schedule.getEntries(groups)),
+                         sorted(form.websafeKey for form in created.items))
+
+    def testInvalidSessionWritesNothing(self):
+        forms = self.forms(5)
+        forms[3].name = None
+        self.assertRaises(endpoints.BadRequestException, self.createBulk, forms)
+        self.assertEqual(Session.query(ancestor=self.conf_key).count(), 0)
+        self.assertEqual(self.pullTasks(), [])
+
+    def testQueuesOneRefreshPerSpeaker(self):
+        self.createBulk(self.forms(10, speakers=3))
+        pulls = self.pullTasks()
+        self.assertEqual(sorted(task.payload for task in pulls),
+                         ['Speaker 0', 'Speaker 1', 'Speaker 2'])
+        self.assertTrue(all(task.tag == self.wsck for task in pulls))
+        drains = self.taskqueue.get_filtered_tasks(url='/tasks/get_featured_speaker')
+        self.assertEqual(len(drains), 1)
+        self.assertEqual(drains[0].extract_params(), {'wsck': self.wsck})
+
+    def testQueuesRefreshesInBatches(self):
+        # more speakers than one taskqueue add accepts.
+        speakers = ['Speaker %d' % i for i in range(150)]
+        ConferenceApi()._featuredSpeakerLaterAsync(self.wsck, speakers).get_result()
+        self.assertEqual(len(self.pullTasks()), 150)
+
+
+if __name__ == '__main__':
+    unittest.main()
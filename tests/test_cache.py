@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""test_cache.py
+
+Tests of the generation checked ConferenceForm/SessionForm cache.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import unittest
+
+from google.appengine.ext import ndb
+
+import cache
+import testbase
+from conference import ConferenceApi, CONF_GET_REQUEST
+from models import Conference, ConferenceForm, Profile, ProfileMiniForm
+
+
+class FormCacheTest(testbase.TestbedTestCase):
+
+    def get(self):
+        return cache.getFormAsync('conference', 'wsck', ConferenceForm).get_result()
+
+    def testFilledFormIsServedUntilInvalidated(self):
+        form, generation = self.get()
+        self.assertEqual(form, None)
+        cache.fillFormAsync('conference', 'wsck', ConferenceForm(name='Summit'),
+                            generation).get_result()
+        self.assertEqual(self.get()[0].name, 'Summit')
+        cache.invalidateFormAsync('conference', 'wsck').get_result()
+        self.assertEqual(self.get()[0], None)
+
+    def testFillLoadedBeforeWriteIsNotServed(self):
+        # a reader misses and loads the entity, then a write commits and
+        # invalidates the form before the reader fills the cache.
+        form, generation = self.get()
+        cache.invalidateFormAsync('conference', 'wsck').get_result()
+        cache.fillFormAsync('conference', 'wsck', ConferenceForm(name='Old'),
+                            generation).get_result()
+        self.assertEqual(self.get()[0], None)
+
+
+class ProfileDisplayNameTest(testbase.TestbedTestCase):
+
+    def setUp(self):
+        super(ProfileDisplayNameTest, self).setUp()
+        email = 'organizer@example.com'
+        p_key = ndb.Key(Profile, email)
+        Profile(key=p_key, displayName='Old', mainEmail=email).put()
+        self.conf_key = Conference(parent=p_key, name='Summit',
+                                   organizerUserId=email).put()
+        self.actAs(email)
+
+    def getConference(self):
+        request = CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=self.conf_key.urlsafe())
+        return ConferenceApi().getConference(request)
+
+    def testSaveProfileInvalidatesOrganizedConferences(self):
+        self.assertEqual(self.getConference().organizerDisplayName, 'Old')
+        ConferenceApi().saveProfile(ProfileMiniForm(displayName='New'))
+        self.assertEqual(self.getConference().organizerDisplayName, 'New')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""test_facets.py
+
+Tests of the incrementally maintained conference facet counts.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import unittest
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+import facets
+import testbase
+from models import Conference, Profile
+
+
+class FacetDeltaTest(unittest.TestCase):
+
+    def testFacetValues(self):
+        conf = Conference(name='Summit', city='London', topics=['Web', 'Data'], month=6)
+        self.assertEqual(facets.facetValues(conf),
+                         [u'CITY:London', u'TOPIC:Web', u'TOPIC:Data', u'MONTH:6'])
+        self.assertEqual(facets.facetValues(Conference(name='Summit', month=0)), [])
+        self.assertEqual(facets.facetValues(None), [])
+
+    def testDeltas(self):
+        before = ['CITY:London', 'TOPIC:Web']
+        after = ['CITY:Paris', 'TOPIC:Web']
+        self.assertEqual(facets.deltas(before, after),
+                         {'CITY:London': -1, 'CITY:Paris': 1})
+        self.assertEqual(facets.deltas(after, after), {})
+
+    def testCombineDropsZeroCounts(self):
+        self.assertEqual(facets.combine({'A': 2, 'B': 1}, {'A': -2, 'C': 1}, None),
+                         {'B': 1, 'C': 1})
+
+
+class FacetCountTest(testbase.TestbedTestCase):
+
+    def setUp(self):
+        super(FacetCountTest, self).setUp()
+        self.organizer = ndb.Key(Profile, 'organizer')
+        # one summary window for the whole test.
+        self.interval = facets.SUMMARY_INTERVAL
+        facets.SUMMARY_INTERVAL = 10 ** 6
+
+    def tearDown(self):
+        facets.SUMMARY_INTERVAL = self.interval
+        super(FacetCountTest, self).tearDown()
+
+    def create(self, **values):
+        conf = Conference(parent=self.organizer, name='Summit', **values)
+        conf.put()
+        facets.changedAsync([], facets.facetValues(conf)).get_result()
+        return conf
+
+    def testChangeQueuesOneSummary(self):
+        self.create(city='London')
+        self.create(city='Paris')
+        tasks = self.taskqueue.get_filtered_tasks(url='/tasks/summarize_facets')
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(facets.shardCounts(), {'CITY:London': 1, 'CITY:Paris': 1})
+
+    def testNoCountsBeforeBaseline(self):
+        self.create(city='London')
+        self.assertEqual(facets.summarize(), None)
+        self.assertEqual(facets.getCounts(), {})
+        tasks = self.taskqueue.get_filtered_tasks(url='/tasks/rebuild_facets')
+        self.assertEqual(len(tasks), 1)
+
+    def testRebuildCountsExistingConferences(self):
+        # a conference written before the shards existed, and one counted by
+        # them; the baseline must count the first once and not the second twice.
+        Conference(parent=self.organizer, name='Old', city='London', month=3).put()
+        self.create(city='London', topics=['Web'])
+        self.assertEqual(facets.rebuild(),
+                         {'CITY:London': 2, 'MONTH:3': 1, 'TOPIC:Web': 1})
+
+    def testChangesAfterRebuild(self):
+        conf = self.create(city='London')
+        facets.rebuild()
+        before = facets.facetValues(conf)
+        conf.city = 'Paris'
+        conf.put()
+        facets.changedAsync(before, facets.facetValues(conf)).get_result()
+        self.assertEqual(facets.summarize(), {'CITY:Paris': 1})
+        self.assertEqual(facets.getCounts(), {'CITY:Paris': 1})
+        self.assertEqual(facets.getFacets(),
+                         [('CITY', [(u'Paris', 1)]), ('TOPIC', []), ('MONTH', [])])
+
+    def testContendedChangeIsRetriedByTask(self):
+        @ndb.tasklet
+        def contended(shard_key, changes):
+            raise datastore_errors.TransactionFailedError('contention')
+        increment, facets._incrementTxn = facets._incrementTxn, contended
+        try:
+            self.create(city='London')
+        finally:
+            facets._incrementTxn = increment
+        self.assertEqual(facets.shardCounts(), {})
+        tasks = self.taskqueue.get_filtered_tasks(url='/tasks/count_facets')
+        self.assertEqual(len(tasks), 1)
+        facets.count(tasks[0].extract_params()['changes'])
+        self.assertEqual(facets.shardCounts(), {'CITY:London': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
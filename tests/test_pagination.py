@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""test_pagination.py
+
+Tests of cursor paginated conference queries.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import unittest
+
+import endpoints
+from google.appengine.ext import ndb
+
+import testbase
+from conference import ConferenceApi
+from models import Conference, ConferenceQueryForm, ConferenceQueryForms, Profile
+
+
+class QueryConferencesPaginationTest(testbase.TestbedTestCase):
+
+    def setUp(self):
+        super(QueryConferencesPaginationTest, self).setUp()
+        organizer = ndb.Key(Profile, 'organizer')
+        self.confs = [Conference(parent=organizer, name='Conference %02d' % i,
+                                 city='London' if i % 2 else 'Paris',
+                                 month=i % 12 + 1, maxAttendees=10 * (i + 1),
+                                 seatsAvailable=10 * (i + 1))
+                      for i in range(7)]
+        ndb.put_multi(self.confs)
+
+    def queryAll(self, filters, pageSize):
+        """Return the names of every page of a query, and the page count."""
+        names, pages, token = [], 0, None
+        while True:
+            forms = ConferenceApi().queryConferences(ConferenceQueryForms(
+                filters=filters, pageSize=pageSize, pageToken=token))
+            names.extend(form.name for form in forms.items)
+            pages += 1
+            token = forms.nextPageToken
+            if not token:
+                return names, pages
+
+    def testPagesListEveryConferenceOnce(self):
+        names, pages = self.queryAll([], 3)
+        self.assertEqual(names, sorted(conf.name for conf in self.confs))
+        self.assertEqual(pages, 3)
+
+    def testPagesOfFilteredQuery(self):
+        names, pages = self.queryAll(
+            [ConferenceQueryForm(field='CITY', operator='EQ', value='London')], 2)
+        self.assertEqual(names, sorted(conf.name for conf in self.confs
+                                       if conf.city == 'London'))
+        self.assertEqual(pages, 2)
+
+    def testPagesOfSeveralInequalities(self):
+        # the pushed field is pinned in the page token, so later pages
+        # continue the same plan.
+        filters = [ConferenceQueryForm(field='MONTH', operator='GT', value='2'),
+                   ConferenceQueryForm(field='MAX_ATTENDEES', operator='LT', value='70')]
+        names, pages = self.queryAll(filters, 2)
+        self.assertEqual(sorted(names), sorted(
+            conf.name for conf in self.confs if conf.month > 2 and conf.maxAttendees < 70))
+        self.assertEqual(len(names), len(set(names)))
+
+    def testInvalidPageToken(self):
+        self.assertRaises(endpoints.BadRequestException,
+                          ConferenceApi().queryConferences,
+                          ConferenceQueryForms(pageToken='not a cursor'))
+
+    def testInvalidPageSize(self):
+        self.assertRaises(endpoints.BadRequestException,
+                          ConferenceApi().queryConferences,
+                          ConferenceQueryForms(pageSize=1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
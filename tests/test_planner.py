@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""test_planner.py
+
+Tests of query planning, page tokens and residual filtering in planner.py.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import planner
+import testbase
+from models import Conference, Profile
+
+
+def inequality(field, operator, value):
+    return {'field': field, 'operator': operator, 'value': value}
+
+
+class PlanTest(testbase.TestbedTestCase):
+
+    def testSingleInequalityIsPushed(self):
+        filters = [inequality('city', '=', 'London'), inequality('month', '>', 3)]
+        plan = planner.plan(Conference, filters)
+        self.assertEqual(plan.field, 'month')
+        self.assertEqual(plan.pushed, filters)
+        self.assertEqual(plan.residual, [])
+        self.assertFalse(plan.pinned)
+
+    def testMostSelectiveFieldIsPushed(self):
+        memcache.set_multi({
+            planner.STATS_KEY % ('Conference', 'month'):
+                {'count': 100, 'distinct': 12, 'min': 1, 'max': 12},
+            planner.STATS_KEY % ('Conference', 'maxAttendees'):
+                {'count': 100, 'distinct': 100, 'min': 0, 'max': 1000}})
+        month = inequality('month', '>', 2)
+        attendees = inequality('maxAttendees', '<', 100)
+        plan = planner.plan(Conference, [month, attendees])
+        self.assertEqual(plan.field, 'maxAttendees')
+        self.assertEqual(plan.pushed, [attendees])
+        self.assertEqual(plan.residual, [month])
+        self.assertTrue(plan.pinned)
+
+    def testPinnedFieldIsKept(self):
+        month = inequality('month', '>', 2)
+        attendees = inequality('maxAttendees', '<', 100)
+        plan = planner.plan(Conference, [month, attendees], field='month')
+        self.assertEqual(plan.field, 'month')
+        self.assertEqual(plan.residual, [attendees])
+
+    def testNotEqualIsResidual(self):
+        not_london = inequality('city', '!=', 'London')
+        plan = planner.plan(Conference, [not_london])
+        self.assertEqual(plan.field, None)
+        self.assertEqual(plan.pushed, [])
+        self.assertEqual(plan.residual, [not_london])
+
+
+class TokenTest(testbase.TestbedTestCase):
+
+    def setUp(self):
+        super(TokenTest, self).setUp()
+        organizer = ndb.Key(Profile, 'organizer')
+        ndb.put_multi([Conference(parent=organizer, name='Conference %d' % i)
+                       for i in range(3)])
+        confs, self.cursor, more = Conference.query().order(
+            Conference.name).fetch_page(1)
+
+    def testEmptyToken(self):
+        self.assertEqual(planner.parseToken(None), (None, None))
+        self.assertEqual(planner.parseToken(''), (None, None))
+
+    def testUnpinnedToken(self):
+        plan = planner.Plan('month', [], [], False)
+        token = planner.makeToken(plan, self.cursor)
+        self.assertEqual(token, self.cursor.urlsafe())
+        self.assertEqual(planner.parseToken(token), (None, self.cursor))
+
+    def testPinnedToken(self):
+        plan = planner.Plan('month', [], [], True)
+        token = planner.makeToken(plan, self.cursor)
+        self.assertEqual(planner.parseToken(token), ('month', self.cursor))
+
+    def testNoMorePages(self):
+        self.assertEqual(planner.makeToken(planner.Plan(None, [], [], False), None), None)
+
+
+class ResidualFilterTest(testbase.TestbedTestCase):
+
+    def setUp(self):
+        super(ResidualFilterTest, self).setUp()
+        organizer = ndb.Key(Profile, 'organizer')
+        self.confs = [Conference(parent=organizer, name='Conference %02d' % i,
+                                 city=('London', 'Paris', 'Rome')[i % 3],
+                                 topics=['Web'] if i % 2 else ['Data', 'Web'],
+                                 month=i % 12 + 1, maxAttendees=10 * i)
+                      for i in range(24)]
+        ndb.put_multi(self.confs)
+        self.max_scan = planner.MAX_SCAN
+
+    def tearDown(self):
+        planner.MAX_SCAN = self.max_scan
+        super(ResidualFilterTest, self).tearDown()
+
+    def fetchAll(self, filters, page_size):
+        """Return every page of a plan's results, as lists of names."""
+        plan = planner.plan(Conference, filters)
+        pages, cursor = [], None
+        while True:
+            results, cursor = planner.fetchPage(Conference, plan, page_size, cursor)
+            pages.append([conf.name for conf in results])
+            if cursor is None:
+                return pages
+
+    def expected(self, test):
+        return sorted(conf.name for conf in self.confs if test(conf))
+
+    def testResidualFiltersApplied(self):
+        filters = [inequality('month', '>', 3), inequality('maxAttendees', '<', 150),
+                   inequality('city', '!=', 'Rome')]
+        names = sum(self.fetchAll(filters, 5), [])
+        self.assertEqual(sorted(names), self.expected(
+            lambda conf: conf.month > 3 and conf.maxAttendees < 150 and conf.city != 'Rome'))
+
+    def testRepeatedPropertyMatchesAnyValue(self):
+        matches = planner.matcher(Conference, [inequality('topics', '<', 'Web')])
+        self.assertTrue(matches(Conference(name='Data', topics=['Data', 'Web'])))
+        self.assertFalse(matches(Conference(name='Web', topics=['Web'])))
+        # a missing value matches nothing.
+        self.assertFalse(matches(Conference(name='None', topics=[])))
+
+    def testScanLimitEndsPageEarly(self):
+        planner.MAX_SCAN = 4
+        filters = [inequality('month', '>', 0), inequality('city', '!=', 'London')]
+        pages = self.fetchAll(filters, 10)
+        self.assertTrue(all(len(page) <= 4 for page in pages))
+        self.assertEqual(sorted(sum(pages, [])),
+                         self.expected(lambda conf: conf.city != 'London'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""test_search.py
+
+Tests of full text search ranking and matching in search.py.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import unittest
+
+from google.appengine.ext import ndb
+
+import search
+import testbase
+from models import Conference, Profile
+
+
+class SearchTest(testbase.TestbedTestCase):
+
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        self.organizer = ndb.Key(Profile, 'organizer')
+        self.max_matches = search.MAX_MATCHES
+
+    def tearDown(self):
+        search.MAX_MATCHES = self.max_matches
+        super(SearchTest, self).tearDown()
+
+    def conference(self, name, description=None, topics=()):
+        conf = Conference(parent=self.organizer, name=name,
+                          description=description, topics=list(topics))
+        conf.put()
+        search.document(conf).put()
+        return conf.key
+
+    def names(self, query, offset=0, limit=20):
+        keys, next_offset = search.search(Conference, query, offset, limit)
+        return [key.get().name for key in keys]
+
+    def testTokenize(self):
+        self.assertEqual(search.tokenize(u'The Future of Web-APIs'),
+                         [u'future', u'web', u'apis'])
+
+    def testNameRanksAboveDescription(self):
+        self.conference('Data Summit', description='python for data science')
+        self.conference('Python Summit')
+        self.assertEqual(self.names('python'), ['Python Summit', 'Data Summit'])
+
+    def testExactRanksAbovePrefix(self):
+        self.conference('Pythonic Days')
+        self.conference('Python Days')
+        self.assertEqual(self.names('python'), ['Python Days', 'Pythonic Days'])
+
+    def testEveryTermRequired(self):
+        self.conference('Web Summit')
+        self.conference('Web Data Summit')
+        self.assertEqual(self.names('web data'), ['Web Data Summit'])
+        self.assertEqual(self.names('the'), [])
+
+    def testRareTermFoundPastCommonTermLimit(self):
+        # 'web' matches more documents than MAX_MATCHES; the document also
+        # having the rare term must still be found.
+        search.MAX_MATCHES = 3
+        for i in range(6):
+            self.conference('Web Summit %d' % i)
+        self.conference('Web Graphs')
+        self.assertEqual(self.names('web graphs'), ['Web Graphs'])
+
+    def testPagesAreStable(self):
+        for i in range(7):
+            self.conference('Cloud Summit %d' % i, description='cloud' if i % 2 else None)
+        everything = self.names('cloud')
+        pages = []
+        offset = 0
+        while offset is not None:
+            keys, offset = search.search(Conference, 'cloud', offset, 3)
+            pages.extend(key.get().name for key in keys)
+        self.assertEqual(pages, everything)
+        self.assertEqual(len(everything), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
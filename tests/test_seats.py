@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""test_seats.py
+
+Tests of sharded seat counters and registration for sharded conferences.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import unittest
+
+from google.appengine.ext import ndb
+
+import seats
+import testbase
+from conference import ConferenceApi, CONF_GET_REQUEST
+from models import Conference, ConflictException, Profile
+
+
+class SeatShardTest(testbase.TestbedTestCase):
+
+    def setUp(self):
+        super(SeatShardTest, self).setUp()
+        self.conf_key = ndb.Key(Profile, 'organizer', Conference, 1)
+
+    def shardSeats(self):
+        return [shard.seatsAvailable for shard in
+                ndb.get_multi(seats.shardKeys(self.conf_key, 3))]
+
+    def testCreateShardsSplitsSeats(self):
+        shards = seats.createShards(self.conf_key, 11, 3)
+        self.assertEqual([shard.seatsAvailable for shard in shards], [4, 4, 3])
+        self.assertEqual([shard.key for shard in shards],
+                         seats.shardKeys(self.conf_key, 3))
+
+    def testPickShardsSkipsEmptyShards(self):
+        shards = seats.createShards(self.conf_key, 2, 3)
+        ndb.put_multi(shards)
+        picked = seats.pickShardsAsync(self.conf_key, 3).get_result()
+        self.assertEqual(sorted(picked), sorted(shard.key for shard in shards[:2]))
+
+    def testTakeSeatStopsAtZero(self):
+        ndb.put_multi(seats.createShards(self.conf_key, 1, 3))
+        shard_key = seats.shardKeys(self.conf_key, 3)[0]
+        take = lambda: seats.takeSeatAsync(shard_key).get_result()
+        self.assertTrue(ndb.transaction(take))
+        self.assertFalse(ndb.transaction(take))
+        self.assertEqual(self.shardSeats(), [0, 0, 0])
+
+    def testAdjustSeats(self):
+        ndb.put_multi(seats.createShards(self.conf_key, 9, 3))
+        def adjust(delta):
+            ndb.transaction(lambda: seats.adjustSeatsAsync(
+                self.conf_key, 3, delta).get_result(), xg=True)
+        adjust(-5)
+        self.assertEqual(sum(self.shardSeats()), 4)
+        self.assertTrue(min(self.shardSeats()) >= 0)
+        adjust(-10)
+        self.assertEqual(self.shardSeats(), [0, 0, 0])
+        adjust(6)
+        self.assertEqual(sum(self.shardSeats()), 6)
+
+
+class ShardedRegistrationTest(testbase.TestbedTestCase):
+
+    def setUp(self):
+        super(ShardedRegistrationTest, self).setUp()
+        self.conf_key = ndb.Key(Profile, 'organizer', Conference, 1)
+        ndb.put_multi([Conference(key=self.conf_key, name='Sharded', maxAttendees=3,
+                                  seatsAvailable=3, seatShards=2)] +
+                      seats.createShards(self.conf_key, 3, 2))
+
+    def register(self, email, reg=True):
+        self.actAs(email)
+        request = CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=self.conf_key.urlsafe())
+        api = ConferenceApi()
+        if reg:
+            return api.registerForConference(request).data
+        return api.unregisterForConference(request).data
+
+    def seatsLeft(self):
+        return seats.getSeatsAvailableAsync(self.conf_key, 2).get_result()
+
+    def testRegistrationTakesOneSeat(self):
+        self.assertTrue(self.register('user1@example.com'))
+        self.assertEqual(self.seatsLeft(), 2)
+
+    def testRegisteringTwiceConflicts(self):
+        self.register('user1@example.com')
+        self.assertRaises(ConflictException, self.register, 'user1@example.com')
+        self.assertEqual(self.seatsLeft(), 2)
+
+    def testNoSeatsLeft(self):
+        for i in range(3):
+            self.assertTrue(self.register('user%d@example.com' % i))
+        self.assertEqual(self.seatsLeft(), 0)
+        self.assertRaises(ConflictException, self.register, 'user3@example.com')
+        self.assertEqual(self.seatsLeft(), 0)
+
+    def testUnregisterReleasesSeat(self):
+        self.register('user1@example.com')
+        self.assertTrue(self.register('user1@example.com', reg=False))
+        self.assertEqual(self.seatsLeft(), 3)
+        self.assertFalse(self.register('user1@example.com', reg=False))
+        self.assertEqual(self.seatsLeft(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""test_session_filters.py
+
+Tests of the typed session start & end times and of session queries
+combining a date with start times.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import unittest
+from datetime import date, datetime
+
+from google.appengine.ext import ndb
+
+import testbase
+from conference import ConferenceApi
+from models import Conference, Profile, Session, SessionQueryForm, SessionQueryForms
+from models import parseStartTime
+
+
+class ComputedTimesTest(unittest.TestCase):
+
+    def testParseStartTime(self):
+        self.assertEqual(parseStartTime('09:30'), 570)
+        self.assertEqual(parseStartTime('9:30'), 570)
+        self.assertEqual(parseStartTime(' 14:05 '), 845)
+        self.assertEqual(parseStartTime('noon'), None)
+        self.assertEqual(parseStartTime(None), None)
+
+    def testStartAndEndDateTime(self):
+        sesh = Session(name='Talk', date=date(2016, 6, 1), startTime='23:30', duration=60)
+        self.assertEqual(sesh.startMinutes, 1410)
+        self.assertEqual(sesh.startDateTime, datetime(2016, 6, 1, 23, 30))
+        self.assertEqual(sesh.endDateTime, datetime(2016, 6, 2, 0, 30))
+
+    def testMissingDateOrTime(self):
+        self.assertEqual(Session(name='Talk', startTime='10:00').startDateTime, None)
+        sesh = Session(name='Talk', date=date(2016, 6, 1))
+        self.assertEqual(sesh.startMinutes, None)
+        self.assertEqual(sesh.startDateTime, None)
+        self.assertEqual(sesh.endDateTime, None)
+
+
+class DateAndTimeQueryTest(testbase.TestbedTestCase):
+
+    def setUp(self):
+        super(DateAndTimeQueryTest, self).setUp()
+        self.conf_key = ndb.Key(Profile, 'organizer', Conference, 1)
+        Conference(key=self.conf_key, name='Summit').put()
+        # two days of sessions, at 09:00, 13:00 and 17:00.
+        ndb.put_multi([Session(parent=self.conf_key, name='%s %s' % (day, hour),
+                               date=date(2016, 6, day), startTime=hour, duration=60)
+                       for day in (1, 2) for hour in ('9:00', '13:00', '17:00')])
+
+    def query(self, filters, websafeConferenceKey=None):
+        forms = ConferenceApi().querySessions(SessionQueryForms(
+            filters=[SessionQueryForm(field=field, operator=operator, value=value)
+                     for field, operator, value in filters],
+            pageSize=50, websafeConferenceKey=websafeConferenceKey))
+        return sorted(form.name for form in forms.items)
+
+    def testLowerTimeBoundKeepsDate(self):
+        filters = [('DATE', 'EQ', '2016-06-01'), ('TIME', 'GTEQ', '13:00')]
+        self.assertEqual(self.query(filters), ['1 13:00', '1 17:00'])
+
+    def testUpperTimeBoundKeepsDate(self):
+        filters = [('DATE', 'EQ', '2016-06-02'), ('TIME', 'LT', '13:00')]
+        self.assertEqual(self.query(filters), ['2 9:00'])
+
+    def testTimeRangeOnDate(self):
+        filters = [('DATE', 'EQ', '2016-06-02'), ('TIME', 'GT', '9:00'),
+                   ('TIME', 'LTEQ', '17:00')]
+        self.assertEqual(self.query(filters), ['2 13:00', '2 17:00'])
+
+    def testConferenceIndexKeepsDate(self):
+        filters = [('DATE', 'EQ', '2016-06-01'), ('TIME', 'GTEQ', '13:00')]
+        self.assertEqual(self.query(filters, self.conf_key.urlsafe()),
+                         ['1 13:00', '1 17:00'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""test_transfer.py
+
+Tests of the JSON Lines export & import round trip in transfer.py.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import json
+import unittest
+from datetime import date
+
+from google.appengine.ext import ndb
+
+import speakers
+import testbase
+import transfer
+from models import Conference, ConferenceRegistration, Profile, Session, SessionWish
+from models import SpeakerSessions
+
+
+class TransferTest(testbase.TestbedTestCase):
+
+    def setUp(self):
+        super(TransferTest, self).setUp()
+        p_key = ndb.Key(Profile, 'user@example.com')
+        self.conf = Conference(parent=p_key, name='Summit', city='London',
+                               startDate=date(2016, 6, 1), month=6,
+                               maxAttendees=10, seatsAvailable=9)
+        self.conf.put()
+        self.sessions = [Session(parent=self.conf.key, name='Talk %d' % i,
+                                 speaker='Speaker %d' % i, date=date(2016, 6, 1),
+                                 startTime='%d:00' % (9 + i), duration=60)
+                         for i in range(3)]
+        ndb.put_multi(self.sessions)
+        ndb.put_multi([
+            Profile(key=p_key, displayName='User', mainEmail='user@example.com'),
+            ConferenceRegistration(id=self.conf.key.urlsafe(), parent=p_key),
+            SessionWish(id=self.sessions[0].key.urlsafe(), parent=p_key)])
+
+    def exportAll(self, batch_size):
+        """Return every exported line, resuming from each checkpoint."""
+        lines, checkpoint = [], None
+        while True:
+            batch, checkpoint = transfer.exportBatch(checkpoint, batch_size)
+            lines.extend(batch)
+            if checkpoint is None:
+                return lines
+
+    def wipe(self):
+        for model in transfer.EXPORT_KINDS:
+            ndb.delete_multi(model.query().fetch(keys_only=True))
+
+    def testLinesKeepKeysAndProperties(self):
+        data = json.loads(transfer.toLine(self.sessions[0]))
+        self.assertEqual(data['kind'], 'Session')
+        self.assertEqual(data['key'], [list(pair) for pair in self.sessions[0].key.pairs()])
+        self.assertEqual(data['properties']['date'], '2016-06-01')
+        # computed properties are derived again on import.
+        self.assertNotIn('startDateTime', data['properties'])
+
+    def testExportResumesFromCheckpoints(self):
+        self.assertEqual(self.exportAll(2), self.exportAll(100))
+        self.assertEqual(len(self.exportAll(2)), 7)
+
+    def testRoundTrip(self):
+        lines = self.exportAll(2)
+        self.wipe()
+        for done in transfer.importLines(lines, batch_size=3):
+            pass
+        self.assertEqual(done, len(lines))
+        self.assertEqual(sorted(self.exportAll(100)), sorted(lines))
+        imported = Session.query(ancestor=self.conf.key).fetch()
+        self.assertEqual(sorted(sesh.startDateTime for sesh in imported),
+                         sorted(sesh.startDateTime for sesh in self.sessions))
+
+    def testImportResumesFromCheckpoint(self):
+        lines = self.exportAll(100)
+        self.wipe()
+        broken = lines[:3] + ['{"kind": "Unknown", "key": [], "properties": {}}']
+        committed = []
+        try:
+            for done in transfer.importLines(broken + lines[3:], batch_size=2):
+                committed.append(done)
+        except ValueError:
+            pass
+        self.assertEqual(committed, [2])
+        for done in transfer.importLines(lines, checkpoint=committed[-1], batch_size=2):
+            pass
+        self.assertEqual(done, len(lines))
+        self.assertEqual(sorted(self.exportAll(100)), sorted(lines))
+
+    def testReimportClearsOldAndNewSpeakerIndexes(self):
+        sesh = self.sessions[0]
+        old_key = speakers.speakerKey(self.conf.key, 'Speaker 0')
+        new_key = speakers.speakerKey(self.conf.key, 'Speaker 9')
+        ndb.put_multi([SpeakerSessions(key=old_key, sessionKeys=[sesh.key.urlsafe()],
+                                       sessionNames=[sesh.name]),
+                       SpeakerSessions(key=new_key, sessionKeys=[], sessionNames=[])])
+        sesh.speaker = 'Speaker 9'
+        line = transfer.toLine(sesh)
+        sesh.speaker = 'Speaker 0'
+        for done in transfer.importLines([line]):
+            pass
+        self.assertEqual(ndb.get_multi([old_key, new_key]), [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
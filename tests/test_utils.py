@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""test_utils.py
+
+Tests of the user id lookups in utils.py.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import hashlib
+import time
+import unittest
+
+from google.appengine.api import memcache
+from google.appengine.api import users
+from google.appengine.ext import testbed
+
+import testbase
+import utils
+from models import Profile
+
+
+class CustomUserIdTest(testbase.TestbedTestCase):
+
+    def testProfileIdForMainEmail(self):
+        Profile(id='abc123', mainEmail='user@example.com').put()
+        self.assertEqual(utils.getUserId(users.User('user@example.com'), 'custom'),
+                         'abc123')
+
+    def testNewIdWithoutProfile(self):
+        user_id = utils.getUserId(users.User('nobody@example.com'), 'custom')
+        self.assertEqual(len(user_id), 32)
+        self.assertNotEqual(user_id,
+                            utils.getUserId(users.User('nobody@example.com'), 'custom'))
+
+
+class TokenUserIdTest(testbase.TestbedTestCase):
+
+    def setUp(self):
+        super(TokenUserIdTest, self).setUp()
+        self.token_cache = utils._token_cache
+        utils._token_cache = utils.LRUCache(utils.TOKEN_CACHE_SIZE)
+        self.fetchTokenInfo = utils._fetchTokenInfo
+        utils._fetchTokenInfo = self.tokenInfo
+        self.lookups = []
+        self.expires_in = 600
+        # a memcache clock the test can move on.
+        self.now = time.time()
+        stub = self.testbed.get_stub(testbed.MEMCACHE_SERVICE_NAME)
+        stub._gettime = lambda: int(self.now)
+
+    def tearDown(self):
+        utils._token_cache = self.token_cache
+        utils._fetchTokenInfo = self.fetchTokenInfo
+        super(TokenUserIdTest, self).tearDown()
+
+    def tokenInfo(self, token):
+        self.lookups.append(token)
+        return {'user_id': 'id-' + token, 'expires_in': self.expires_in}
+
+    def memcached(self, token):
+        return memcache.get(utils.MEMCACHE_TOKEN_KEY % hashlib.sha1(token).hexdigest())
+
+    def testLruThenMemcacheThenTokenInfo(self):
+        self.assertEqual(utils.getUserIdForToken('tok'), 'id-tok')
+        self.assertEqual(utils.getUserIdForToken('tok'), 'id-tok')
+        self.assertEqual(self.lookups, ['tok'])
+        # another instance, without the token in its LRU, finds it in memcache.
+        utils._token_cache = utils.LRUCache(utils.TOKEN_CACHE_SIZE)
+        self.assertEqual(utils.getUserIdForToken('tok'), 'id-tok')
+        self.assertEqual(self.lookups, ['tok'])
+        utils._token_cache = utils.LRUCache(utils.TOKEN_CACHE_SIZE)
+        memcache.flush_all()
+        self.assertEqual(utils.getUserIdForToken('tok'), 'id-tok')
+        self.assertEqual(self.lookups, ['tok', 'tok'])
+
+    def testMemcacheExpiresWithToken(self):
+        self.expires_in = 60
+        utils.getUserIdForToken('tok')
+        self.now += 59
+        self.assertEqual(self.memcached('tok')[0], 'id-tok')
+        self.now += 2
+        self.assertEqual(self.memcached('tok'), None)
+
+    def testMemcacheTtlIsCapped(self):
+        self.expires_in = utils.TOKEN_CACHE_TTL * 2
+        utils.getUserIdForToken('tok')
+        self.now += utils.TOKEN_CACHE_TTL + 1
+        self.assertEqual(self.memcached('tok'), None)
+
+    def testExpiredTokenIsNotCached(self):
+        self.expires_in = 0
+        self.assertEqual(utils.getUserIdForToken('tok'), 'id-tok')
+        self.assertEqual(self.memcached('tok'), None)
+        utils.getUserIdForToken('tok')
+        self.assertEqual(self.lookups, ['tok', 'tok'])
+
+
+if __name__ == '__main__':
+    unittest.main()
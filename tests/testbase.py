@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""testbase.py
+
+Test case base class running each test against fresh App Engine testbed
+stubs.
+
+Run the tests from the repository root, with the App Engine SDK on the
+python path:
+    PYTHONPATH=$SDK:$SDK/lib/protorpc-1.0:$SDK/lib/webapp2-2.5.2:. \\
+        python -m unittest discover -s tests
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import os
+import unittest
+
+# Key.urlsafe() needs an application id, even outside a request.
+os.environ.setdefault('APPLICATION_ID', 'dev~conference-test')
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestbedTestCase(unittest.TestCase):
+    """TestbedTestCase -- test case with datastore, memcache, taskqueue and
+    user stubs"""
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # high replication stub that always applies writes, so queries see
+        # them at once.
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        # queue.yaml is read from the repository root.
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_user_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def actAs(self, email):
+        """Make endpoints.get_current_user() return the user for email."""
+        os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+        os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'gmail.com'
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""transfer.py
+
+JSON Lines import & export of Profile, Conference and Session entities,
+and of the ConferenceRegistration and SessionWish attendance children of
+profiles, for moving conferences between environments.
+
+Each line holds one entity:
+
+    {"kind": "Session",
+     "key": [["Profile", "1234"], ["Conference", 5], ["Session", 7]],
+     "properties": {"name": "Intro", "date": "2016-06-01", ...}}
+
+The key keeps the full Profile -> Conference -> Session ancestor path, so
+imported entities land in the same entity groups they were exported from.
+Attendance entities are keyed by the websafe key of their conference or
+session, which embeds the exporting app's id; imports rebuild those keys,
+and the websafe keys of the legacy Profile attendance lists, for the
+importing app.
+
+Export walks the kinds in that order with cursor paged queries, one batch
+at a time; its checkpoint is "<kind index>:<cursor>". Import writes lines
+with put_multi in batches and yields the number of lines committed after
+each batch, which is the checkpoint to resume from.
+
+"""
+
+__author__ = 'Benjamindavidfraser@gmail.com (Benjamin Fraser)'
+
+import json
+from datetime import datetime
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import announcements
+import cache
+import facets
+import schedule
+import search
+import seats
+import session_index
+import speakers
+from models import Profile, Conference, Session
+from models import ConferenceRegistration, SessionWish
+
+# Kinds in export order, parents before children.
+EXPORT_KINDS = (Profile, Conference, Session, ConferenceRegistration, SessionWish)
+KINDS_BY_NAME = dict((model._get_kind(), model) for model in EXPORT_KINDS)
+
+# Kinds whose ids, and properties whose values, are websafe keys.
+WEBSAFE_KEYED_KINDS = (ConferenceRegistration, SessionWish)
+WEBSAFE_KEY_PROPERTIES = {
+    Profile: ('conferenceKeysToAttend', 'sessionKeysToAttend'),
+}
+
+EXPORT_BATCH_SIZE = 200
+IMPORT_BATCH_SIZE = 200
+
+
+# - - - Entity <-> line - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _toJson(prop, value):
+    """Convert a property value into its JSON value."""
+    if value is not None and isinstance(prop, ndb.DateTimeProperty):
+        # DateProperty is a DateTimeProperty, so this covers both.
+        return value.isoformat()
+    return value
+
+
+def _fromJson(prop, value):
+    """Convert a JSON value back into a property value."""
+    if value is None:
+        return None
+    if isinstance(prop, ndb.DateProperty):
+        return datetime.strptime(value[:10], "%Y-%m-%d").date()
+    if isinstance(prop, ndb.DateTimeProperty):
+        fmt = "%Y-%m-%dT%H:%M:%S.%f" if '.' in value else "%Y-%m-%dT%H:%M:%S"
+        return datetime.strptime(value, fmt)
+    return value
+
+
+def localWebsafeKey(websafeKey):
+    """Return a websafe key of another app rebuilt for this one, from its
+    kind & id path."""
+    return ndb.Key(pairs=ndb.Key(urlsafe=websafeKey).pairs()).urlsafe()
+
+
+def toLine(entity):
+    """Return the JSON line of an entity."""
+    properties = {}
+    for prop in entity._properties.values():
+        # computed properties are derived again when the entity is put.
+        if isinstance(prop, ndb.ComputedProperty):
+            continue
+        value = getattr(entity, prop._code_name)
+        if prop._repeated:
+            value = [_toJson(prop, item) for item in value]
+        else:
+            value = _toJson(prop, value)
+        properties[prop._code_name] = value
+    return json.dumps({'kind': entity._get_kind(),
+                       'key': [list(pair) for pair in entity.key.pairs()],
+                       'properties': properties},
+                      sort_keys=True)
+
+
+def fromLine(line):
+    """Return the entity of a JSON line, keyed by its full ancestor path."""
+    data = json.loads(line)
+    model = KINDS_BY_NAME.get(data.get('kind'))
+    if model is None:
+        raise ValueError('Cannot import kind %r' % data.get('kind'))
+    values = {}
+    for name, value in data.get('properties', {}).items():
+        prop = model._properties.get(name)
+        # skip properties the current model no longer has or derives.
+        if prop is None or isinstance(prop, ndb.ComputedProperty):
+            continue
+        if prop._repeated:
+            value = [_fromJson(prop, item) for item in value or []]
+        else:
+            value = _fromJson(prop, value)
+        if name in WEBSAFE_KEY_PROPERTIES.get(model, ()):
+            value = [localWebsafeKey(item) for item in value]
+        values[prop._code_name] = value
+    pairs = [tuple(pair) for pair in data['key']]
+    if model in WEBSAFE_KEYED_KINDS:
+        kind, websafeKey = pairs[-1]
+        pairs[-1] = (kind, localWebsafeKey(websafeKey))
+    return model(key=ndb.Key(pairs=pairs), **values)
+
+
+# - - - Export - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def parseCheckpoint(checkpoint):
+    """Return the (kind index, Cursor or None) of an export checkpoint."""
+    if not checkpoint:
+        return 0, None
+    kind_index, _, cursor = checkpoint.partition(':')
+    return int(kind_index), Cursor(urlsafe=cursor) if cursor else None
+
+
+def exportBatch(checkpoint=None, batch_size=EXPORT_BATCH_SIZE):
+    """Return the JSON lines of the next batch after checkpoint, and the
+    checkpoint following it, or None once every kind is exported."""
+    kind_index, cursor = parseCheckpoint(checkpoint)
+    if kind_index >= len(EXPORT_KINDS):
+        return [], None
+    entities, next_cursor, more = EXPORT_KINDS[kind_index].query().fetch_page(
+        batch_size, start_cursor=cursor)
+    if more and next_cursor:
+        next_checkpoint = '%d:%s' % (kind_index, next_cursor.urlsafe())
+    elif kind_index + 1 < len(EXPORT_KINDS):
+        next_checkpoint = '%d:' % (kind_index + 1)
+    else:
+        next_checkpoint = None
+    return [toLine(entity) for entity in entities], next_checkpoint
+
+
+# - - - Import - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def importLines(lines, checkpoint=0, batch_size=IMPORT_BATCH_SIZE):
+    """Import JSON lines with put_multi, skipping the first checkpoint lines.
+    Yields the number of lines committed after each batch."""
+    done = checkpoint
+    batch = []
+    for number, line in enumerate(line for line in lines if line.strip()):
+        if number < checkpoint:
+            continue
+        batch.append(fromLine(line))
+        if len(batch) >= batch_size:
+            putBatch(batch)
+            done += len(batch)
+            batch = []
+            yield done
+    if batch:
+        putBatch(batch)
+        done += len(batch)
+        yield done
+
+
+def putBatch(entities):
+    """Write imported entities, then bring the data derived from them back
+    in line with what they replaced."""
+    extra = []
+    for entity in entities:
+        # seat shards aren't exported; split the seats left over new ones.
+        if isinstance(entity, Conference) and entity.seatShards:
+            extra += seats.createShards(entity.key, entity.seatsAvailable or 0,
+                                        entity.seatShards)
+    confs = [entity for entity in entities if isinstance(entity, Conference)]
+    sessions = [entity for entity in entities if isinstance(entity, Session)]
+    # search documents aren't exported either; write them from the text.
+    extra += [search.document(entity) for entity in confs + sessions]
+    # imported conferences & sessions may replace existing ones; count the
+    # facet difference, and find the speakers the sessions had before.
+    replaced = ndb.get_multi([conf.key for conf in confs])
+    replaced_sessions = ndb.get_multi([sesh.key for sesh in sessions])
+    ndb.put_multi(entities + extra)
+    facets.changedAsync([value for conf in replaced for value in facets.facetValues(conf)],
+                        [value for conf in confs for value in facets.facetValues(conf)]
+                        ).get_result()
+    reserveIds(entities)
+
+    # drop schedules & speaker indexes of conferences that gained sessions,
+    # both of the sessions' speakers and of those they replaced; both are
+    # rebuilt from the sessions on their next use.
+    derived = set(schedule.scheduleKey(sesh.key.parent()) for sesh in sessions)
+    derived.update(speakers.speakerKey(sesh.key.parent(), sesh.speaker)
+                   for sesh in sessions + replaced_sessions if sesh and sesh.speaker)
+    if derived:
+        ndb.delete_multi(list(derived))
+        session_index.bumpGenerations(sesh.key.parent().urlsafe() for sesh in sessions)
+    # and invalidate any cached forms and query results of the replaced
+    # entities.
+    ndb.Future.wait_all(
+        [cache.invalidateFormAsync('conference', conf.key.urlsafe()) for conf in confs] +
+        [cache.invalidateFormAsync('session', sesh.key.urlsafe()) for sesh in sessions])
+    if confs:
+        cache.bumpGeneration('conference')
+    # and bring the conferences' nearly sold out entries up to date.
+    futures = [announcements.seatsChangedAsync(conf.key, conf.seatsAvailable or 0)
+               for conf in confs]
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+
+
+def reserveIds(entities):
+    """Reserve the imported numeric ids, so allocate_ids never hands them out
+    again under the same parent."""
+    highest = {}
+    for entity in entities:
+        entity_id = entity.key.integer_id()
+        if entity_id:
+            group = (type(entity), entity.key.parent())
+            highest[group] = max(highest.get(group, 0), entity_id)
+    ndb.Future.wait_all([model.allocate_ids_async(max=entity_id, parent=parent)
+                         for (model, parent), entity_id in highest.items()])
@@ -1,45 +1,123 @@
+import collections
+import hashlib
 import json
+import logging
 import os
+import threading
 import time
 import uuid
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from models import Profile
 
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+TOKENINFO_DEADLINE = 5
+
+# Resolved OAuth tokens are cached in process and in memcache until they
+# expire, and for at most TOKEN_CACHE_TTL seconds.
+TOKEN_CACHE_SIZE = 1000
+TOKEN_CACHE_TTL = 3600
+MEMCACHE_TOKEN_KEY = 'user-id-token:%s'
+
+
+class LRUCache(object):
+    """LRUCache -- thread safe, size bounded, least recently used first out"""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, isValid=None):
+        """Return the value of key, or None if it is missing or isValid(value)
+        is false, dropping it then."""
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None or (isValid and not isValid(value)):
+                return None
+            # re-insert as the most recently used.
+            self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+# token digest -> (user_id, expiry)
+_token_cache = LRUCache(TOKEN_CACHE_SIZE)
+
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()
 
     if id_type == "oauth":
-        """A workaround implementation for getting userid."""
+        # resolve the request's bearer token, from cache where possible.
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
-        token_type = 'id_token'
-        if 'OAUTH_USER_ID' in os.environ:
-            token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return getUserIdForToken(token)
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm
-        # this is just a sample that queries datastore for an existing profile
-        # and generates an id if profile does not exist for an email
-        profile = Conference.query(Conference.mainEmail == user.email())
-        if profile:
-            return profile.id()
+        # this is just a sample that looks up the id of an existing profile
+        # for the email, and generates an id if profile does not exist
+        p_key = Profile.query(Profile.mainEmail == user.email()).get(keys_only=True)
+        if p_key:
+            return p_key.id()
         else:
             return str(uuid.uuid1().get_hex())
+
+
+def getUserIdForToken(token):
+    """Return the user id of an OAuth token, or '' if it can't be resolved,
+    looking in the process LRU, then memcache, then at tokeninfo."""
+    digest = hashlib.sha1(token).hexdigest()
+    cached = _token_cache.get(digest, lambda entry: entry[1] > time.time())
+    if cached:
+        return cached[0]
+
+    cached = memcache.get(MEMCACHE_TOKEN_KEY % digest)
+    if cached:
+        user_id, expiry = cached
+        _token_cache.set(digest, (user_id, expiry))
+        return user_id
+
+    info = _fetchTokenInfo(token)
+    user_id = info.get('user_id', '')
+    if user_id:
+        ttl = min(int(info.get('expires_in') or 0), TOKEN_CACHE_TTL)
+        if ttl > 0:
+            expiry = time.time() + ttl
+            _token_cache.set(digest, (user_id, expiry))
+            memcache.set(MEMCACHE_TOKEN_KEY % digest, (user_id, expiry), time=ttl)
+    return user_id
+
+
+def _fetchTokenInfo(token):
+    """Return the tokeninfo of a token, or {} if it is invalid or the lookup
+    fails. Never sleeps; a failed lookup is retried by the next request."""
+    token_type = 'id_token'
+    if 'OAUTH_USER_ID' in os.environ:
+        token_type = 'access_token'
+    # a token rejected as an id_token may still be a valid access token.
+    token_types = [token_type]
+    if token_type != 'access_token':
+        token_types.append('access_token')
+    for token_type in token_types:
+        try:
+            resp = urlfetch.fetch(TOKENINFO_URL % (token_type, token),
+                                  deadline=TOKENINFO_DEADLINE)
+        except urlfetch.Error:
+            logging.warning('tokeninfo lookup failed', exc_info=True)
+            return {}
+        if resp.status_code == 200:
+            return json.loads(resp.content)
+        if not (resp.status_code == 400 and 'invalid_token' in resp.content):
+            logging.warning('tokeninfo lookup returned %d', resp.status_code)
+            return {}
+    return {}